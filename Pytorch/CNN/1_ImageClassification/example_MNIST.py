@@ -1,9 +1,12 @@
 # %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import sys
 import numpy as np
 import torch
 import torch.nn as nn
 from torchvision import datasets
-from sklearn.metrics import accuracy_score
+sys.path.append(os.path.join(os.getcwd(), "..", ".."))
+from helpers.evaluation import evaluate, RunningMetrics, fixed_subset
 
 
 # %% --------------------------------------- Set-Up --------------------------------------------------------------------
@@ -17,17 +20,8 @@ torch.backends.cudnn.benchmark = False
 LR = 5e-2
 N_EPOCHS = 30
 BATCH_SIZE = 512
+TRAIN_EVAL_SIZE = None  # Also evaluates exactly on a fixed random sample of this many training images
 DROPOUT = 0.5
-# %% ----------------------------------- Helper Functions --------------------------------------------------------------
-def acc(x, y, return_labels=False):
-    with torch.no_grad():
-        logits = model(x)
-        pred_labels = np.argmax(logits.cpu().numpy(), axis=1)
-    if return_labels:
-        return pred_labels
-    else:
-        return 100*accuracy_score(y.cpu().numpy(), pred_labels)
-
 
 # %% -------------------------------------- CNN Class ------------------------------------------------------------------
 class CNN(nn.Module):
@@ -64,12 +58,13 @@ x_test, y_test = data_test.data.view(len(data_test), 1, 28, 28).float().to(devic
 model = CNN().to(device)
 optimizer = torch.optim.SGD(model.parameters(), lr=LR)
 criterion = nn.CrossEntropyLoss()
+train_eval_inds = fixed_subset(len(x_train), TRAIN_EVAL_SIZE) if TRAIN_EVAL_SIZE else None
 
 # %% -------------------------------------- Training Loop ----------------------------------------------------------
 print("Starting training loop...")
 for epoch in range(N_EPOCHS):
 
-    loss_train = 0
+    train_metrics = RunningMetrics()
     model.train()
     for batch in range(len(x_train)//BATCH_SIZE + 1):
         inds = slice(batch*BATCH_SIZE, (batch+1)*BATCH_SIZE)
@@ -78,13 +73,12 @@ for epoch in range(N_EPOCHS):
         loss = criterion(logits, y_train[inds])
         loss.backward()
         optimizer.step()
-        loss_train += loss.item()
+        train_metrics.update(logits, y_train[inds], loss)
 
     model.eval()
-    with torch.no_grad():
-        y_test_pred = model(x_test)
-        loss = criterion(y_test_pred, y_test)
-        loss_test = loss.item()
-
+    acc_test, loss_test, _ = evaluate(model, x_test, y_test, BATCH_SIZE, criterion)
     print("Epoch {} | Train Loss {:.5f}, Train Acc {:.2f} - Test Loss {:.5f}, Test Acc {:.2f}".format(
-        epoch, loss_train/BATCH_SIZE, acc(x_train, y_train), loss_test, acc(x_test, y_test)))
+        epoch, train_metrics.loss, train_metrics.accuracy, loss_test, acc_test))
+    if train_eval_inds is not None:  # Exact, but only on a fixed sample of the training data
+        acc_train_exact, _, _ = evaluate(model, x_train[train_eval_inds], y_train[train_eval_inds], BATCH_SIZE)
+        print("Exact Train Acc on {} images {:.2f}".format(len(train_eval_inds), acc_train_exact))
@@ -1,29 +1,32 @@
-# Download the Stanford Sentiment Treebank from https://gluebenchmark.com/tasks and unzip it in the current working dir
 # Download glove.6B.zip from https://nlp.stanford.edu/projects/glove/, unzip it and move glove.6B.50d.txt to the
 # current working directory.
 
 # %% --------------------------------------- Imports -------------------------------------------------------------------
 import os
+import time
+import sys
 import numpy as np
-import pandas as pd
-import json
 import torch
 import torch.nn as nn
-from sklearn.metrics import accuracy_score, confusion_matrix
 import nltk
+sys.path.append(os.path.join(os.getcwd(), "..", ".."))
+from helpers.sst import load_sst2
+from helpers.tokenization import load_tokenized_corpus, TOKENIZERS
+from helpers.vocab import build_vocab, n_embeddings
+from helpers.encoding import encode_sentences
+from helpers.prep_cache import PrepCache, fingerprint, row_hashes
+from helpers.glove import load_glove, get_glove_table, SubstituteLookup
+from helpers.evaluation import evaluate, RunningMetrics, fixed_subset
+from helpers.serving import serve
+from helpers.prediction_cache import PredictionCache
+from helpers.optim import build_optimizer, optimizer_memory_mb
+from helpers.batching import sequence_lengths, BucketBatchSampler, trim_padding
+from helpers.export import export_variants, benchmark_variants
+from helpers.pq_embedding import convert_checkpoint, print_quantization_report
+from helpers.distillation import distillation_loss, load_teacher_logits, cpu_latencies
 from tqdm import tqdm
 nltk.download('punkt')
 
-if "SST-2" not in os.listdir(os.getcwd()):
-    try:
-        os.system("wget https://dl.fbaipublicfiles.com/glue/data/SST-2.zip")
-        os.system("unzip SST-2.zip")
-    except:
-        print("There was a problem with the download!")
-        import sys
-
-        sys.exit()
-
 if "glove.6B.50d.txt" not in os.listdir(os.getcwd()):
     try:
         os.system("wget http://downloads.cs.stanford.edu/nlp/data/glove.6B.zip")
@@ -45,91 +48,59 @@ torch.backends.cudnn.benchmark = False
 # %% ----------------------------------- Hyper Parameters --------------------------------------------------------------
 class Args:
     def __init__(self):
+        self.train_level = "phrase"  # "phrase" trains on all the phrases of the train sentences (like GLUE's
+        # SST-2 train set) and "sentence" only on the whole sentences. The dev set always has whole sentences
+        self.tokenizer = "fast"  # "nltk" (nltk.word_tokenize) or "fast", which gives the same tokens much faster
         self.seq_len = "get_max_from_data"
+        self.model = "global_pool"  # "reshape" uses the CNN class below, whose convolutions reduce seq_len to
+        # exactly one position, so every batch has to be padded to seq_len. "global_pool" uses CNNGlobalPool, which
+        # takes batches of any length, so each one is only padded to its longest sentence (similar lengths go together)
         self.embedding_dim = 50
+        self.min_freq = 1
+        self.max_vocab_size = None
+        self.n_oov_buckets = 1
+        self.glove_substitutes = False  # Encodes the out-of-vocab tokens that have a GloVe vector as the vocab token
+        # with the most similar one (see helpers/glove.py) instead of as an out-of-vocab bucket, training and serving
+        self.substitute_min_similarity = 0.5  # Those less similar than this to all the vocab tokens stay out-of-vocab
+        self.sparse_embedding = False  # Trains the embedding with sparse gradients and SparseAdam (the rest with Adam),
+        # so that each step only updates the rows of the token ids on the batch instead of the whole embedding table
         self.n_epochs = 40
         self.lr = 1e-2
         self.batch_size = 512
+        self.train_eval_size = None  # Train Acc is the running accuracy of the training batches of each epoch. With a
+        # number, the model is also evaluated exactly on a fixed random sample of that many training sentences
+        self.distill = False  # Also learns from the soft targets of the LSTM of RNN/2_TextClassification (knowledge
+        # distillation), saved by running that example with TEACHER_LOGITS = True and the same train_level
+        self.teacher_logits = os.path.join("..", "..", "RNN", "2_TextClassification", "lstm_teacher_logits.npz")
+        self.temperature = 2.  # Softens the probabilities of the teacher, so that the student sees how sure it is
+        self.distill_alpha = 0.5  # Weight of the soft targets on the loss (1 - distill_alpha for the labels)
         self.train = True
         self.save_model = True
+        self.serve = False  # After the final test, keeps the model loaded and serves its predictions (see below)
+        self.cache_size = 10000  # Max number of predictions the server keeps in its cache (0 disables it)
+        self.export = False  # Exports the model to TorchScript (float32 and int8) and benchmarks it (see below)
+        self.pq_embedding = False  # Converts the trained model to a product-quantized embedding table (see below)
+        self.pq_subvectors = 25  # Pieces each row of the table is cut into (embedding_dim must be a multiple of it)
 
 
 args = Args()
 
 
 # %% ----------------------------------- Helper Functions --------------------------------------------------------------
-def acc(x, y, return_labels=False):
-    with torch.no_grad():
-        logits = torch.empty(len(x), 2)
-        for batch in range(len(x) // args.batch_size + 1):
-            inds = slice(batch * args.batch_size, (batch + 1) * args.batch_size)
-            logits[inds] = model(x[inds])
-        pred_labels = np.argmax(logits.cpu().numpy(), axis=1)
-    if return_labels:
-        return pred_labels
-    else:
-        return 100*accuracy_score(y.cpu().numpy(), pred_labels)
-
-
-def extract_vocab_dict_and_msl(sentences_train, sentences_dev):
-    """ Tokenizes all the sentences and gets a dictionary of unique tokens and also the maximum sequence length """
-    tokens, ms_len = [], 0
-    for sentence in list(sentences_train) + list(sentences_dev):
-        tokens_in_sentence = nltk.word_tokenize(sentence)
-        if ms_len < len(tokens_in_sentence):
-            ms_len = len(tokens_in_sentence)
-        tokens += tokens_in_sentence
-    token_vocab = {key: i for key, i in zip(set(tokens), range(1, len(set(tokens))+1))}
-    if len(np.unique(list(token_vocab.values()))) != len(token_vocab):
-        "There are some rep words..."
+def extract_vocab_dict_and_msl(corpus_train, corpus_dev):
+    """ Gets a dictionary of the tokens from the tokenized sentences and also the maximum sequence length """
+    ms_len = max(corpus_train.max_len(), corpus_dev.max_len())
+    token_vocab = build_vocab([corpus_train, corpus_dev], args.min_freq, args.max_vocab_size)
     return token_vocab, ms_len
 
 
-def convert_to_ids(raw_sentences, vocab_dict, pad_to):
-    """ Takes an NumPy array of raw text sentences and converts to a sequence of token ids """
-    x = np.empty((len(raw_sentences), pad_to))
-    for idx, sentence in enumerate(raw_sentences):
-        word_ids = []
-        for token in nltk.word_tokenize(sentence):
-            try:
-                word_ids.append(vocab_dict[token])
-            except:
-                word_ids.append(vocab_dict[token])
-        if pad_to < len(word_ids):
-            x[idx] = word_ids[:pad_to]
-        else:
-            x[idx] = word_ids + [0] * (pad_to - len(word_ids))
-    return x
-
-
-def get_glove_embeddings(vocab_dict):
-    with open("glove.6B.50d.txt", "r") as s:
-        glove = s.read()
-    embeddings_dict = {}
-    for line in glove.split("\n")[:-1]:
-        text = line.split()
-        if text[0] in vocab_dict:
-            embeddings_dict[vocab_dict[text[0]]] = torch.from_numpy(np.array(text[1:], dtype="float32"))
-    return embeddings_dict
-
-
-def get_glove_table(vocab_dict, glove_dict):
-    lookup_table = torch.empty((len(vocab_dict)+2, 50))
-    for token_id in sorted(vocab_dict.values()):
-        if token_id in glove_dict:
-            lookup_table[token_id] = glove_dict[token_id]
-        else:
-            lookup_table[token_id] = torch.zeros((1, 50))  # For unknown tokens
-    lookup_table[0] = torch.zeros((1, 50))
-    return lookup_table
-
-
 # %% -------------------------------------- CNN Class ------------------------------------------------------------------
 class CNN(nn.Module):
     def __init__(self, vocab_size):
         super(CNN, self).__init__()
 
-        self.embedding = nn.Embedding(vocab_size + 2, args.embedding_dim)
+        self.embedding = nn.Embedding(vocab_size + 1 + args.n_oov_buckets, args.embedding_dim,
+                                      sparse=args.sparse_embedding)
 
         self.conv1 = nn.Conv1d(args.embedding_dim, args.embedding_dim, 9)
         self.convnorm1 = nn.BatchNorm1d(args.embedding_dim)
@@ -151,48 +122,111 @@ class CNN(nn.Module):
         return self.linear(self.act(self.conv3(x)).reshape(-1, args.embedding_dim))
 
 
+class CNNGlobalPool(nn.Module):
+    """ Same layers as CNN, but the convolutions are zero-padded to keep the length (which each pooling halves) and a
+    global max pooling over time replaces the reshape, so the sentences can have any length. The padded positions are
+    masked after each layer, so a sentence gets the same logits no matter how much padding its batch has (when on eval
+    mode, as on training mode the batch norm statistics include the padded positions) """
+    def __init__(self, vocab_size):
+        super(CNNGlobalPool, self).__init__()
+
+        self.embedding = nn.Embedding(vocab_size + 1 + args.n_oov_buckets, args.embedding_dim,
+                                      sparse=args.sparse_embedding)
+
+        self.conv1 = nn.Conv1d(args.embedding_dim, args.embedding_dim, 9, padding=4)
+        self.convnorm1 = nn.BatchNorm1d(args.embedding_dim)
+        self.pool1 = nn.MaxPool1d(2, ceil_mode=True)  # ceil_mode keeps the last position of odd lengths
+
+        self.conv2 = nn.Conv1d(args.embedding_dim, args.embedding_dim, 9, padding=4)
+        self.convnorm2 = nn.BatchNorm1d(args.embedding_dim)
+        self.pool2 = nn.MaxPool1d(2, ceil_mode=True)
+
+        self.conv3 = nn.Conv1d(args.embedding_dim, args.embedding_dim, 7, padding=3)
+        self.linear = nn.Linear(args.embedding_dim, 2)
+        self.act = torch.relu
+
+    @staticmethod
+    def mask(lengths, length):
+        """ (batch_size, 1, length) bool tensor, True on the positions of each sentence and False on the padding """
+        return (torch.arange(length, device=lengths.device) < lengths[:, None])[:, None, :]
+
+    def forward(self, x):
+        lengths = (x != 0).sum(dim=1).clamp(min=1)  # An empty sentence keeps one position, so that it can be pooled
+        mask = self.mask(lengths, x.shape[1])
+        x = self.embedding(x).permute(0, 2, 1).masked_fill(~mask, 0)
+        for conv, convnorm, pool in ((self.conv1, self.convnorm1, self.pool1),
+                                     (self.conv2, self.convnorm2, self.pool2)):
+            # The padding is set to -inf before pooling, so that a window over the end of a sentence only takes its
+            # last position, and to 0 after, which is what the next convolution sees after the end of any sentence
+            x = pool(convnorm(self.act(conv(x))).masked_fill(~mask, -float("inf")))
+            lengths = (lengths + 1)//2
+            mask = self.mask(lengths, x.shape[2])
+            x = x.masked_fill(~mask, 0)
+        x = self.act(self.conv3(x)).masked_fill(~mask, -float("inf"))
+        return self.linear(x.amax(dim=2))
+
+
 # %% -------------------------------------- Data Prep ------------------------------------------------------------------
-data_train = pd.read_csv("SST-2/train.tsv", sep="\t")
-x_train_raw, y_train = data_train["sentence"].values, torch.LongTensor(data_train["label"].values).to(device)
-data_dev = pd.read_csv("SST-2/dev.tsv", sep="\t")
-x_dev_raw, y_dev = data_dev["sentence"].values, torch.LongTensor(data_dev["label"].values).to(device)
-
-try:
-    with open("example_prep_data/vocab_dict.json", "r") as s:
-        token_ids = json.load(s)
-    msl = np.load("example_prep_data/max_sequence_length.npy").item()
-except:
-    print("Tokenizing all the examples to get a vocab dict and the maximum sequence length...")
-    token_ids, msl = extract_vocab_dict_and_msl(x_train_raw, x_dev_raw)
-    os.mkdir("example_prep_data")
-    with open("example_prep_data/vocab_dict.json", "w") as s:
-        json.dump(token_ids, s)
-    np.save("example_prep_data/max_sequence_length.npy", np.array([msl]))
+# Builds the train and dev sets from the Stanford Sentiment Treebank files that come with the RNN example (only
+# the first time, later runs load them from its cache), so there is nothing to download
+x_train_raw, y_train = load_sst2("train", args.train_level)
+x_dev_raw, y_dev = load_sst2("dev", "sentence")
+y_train, y_dev = torch.from_numpy(y_train).to(device), torch.from_numpy(y_dev).to(device)
+tokens_train = load_tokenized_corpus(x_train_raw, TOKENIZERS[args.tokenizer])
+tokens_dev = load_tokenized_corpus(x_dev_raw, TOKENIZERS[args.tokenizer])
+
+# The prep cache only serves the files built from the same sentences, tokenizer and args, and logs its hits and misses
+prep_cache = PrepCache("example_prep_data")
+hashes_train = row_hashes(x_train_raw)  # Also find the teacher logits of each training sentence (see below)
+vocab_key = fingerprint(TOKENIZERS[args.tokenizer], hashes_train, row_hashes(x_dev_raw), args.min_freq,
+                        args.max_vocab_size)
+# The vocab is cached as a compact binary file that is memory-mapped on later runs, instead of a JSON dict that would
+# be parsed on every run (see helpers/binary_vocab.py). It behaves like the dict and looks up many tokens at once
+vocab_entry = prep_cache.get_vocab("vocab", vocab_key)
+if vocab_entry is None:
+    print("Getting a vocab dict and the maximum sequence length from the tokenized examples...")
+    token_ids, msl = extract_vocab_dict_and_msl(tokens_train, tokens_dev)
+    prep_cache.put_vocab("vocab", vocab_key, token_ids, {"msl": msl})
+else:
+    token_ids, msl = vocab_entry[0], vocab_entry[1]["msl"]
 if args.seq_len == "get_max_from_data":
     args.seq_len = msl
-del data_train, data_dev
-
-glove_embeddings = get_glove_embeddings(token_ids)
 
-try:
-    x_train = np.load("example_prep_data/prep_train_len{}.npy".format(args.seq_len))
-    x_dev = np.load("example_prep_data/prep_dev_len{}.npy".format(args.seq_len))
-except:
-    print("Converting all the sentences to sequences of token ids...")
-    x_train = convert_to_ids(x_train_raw, token_ids, args.seq_len)
-    np.save("example_prep_data/prep_train_len{}.npy".format(args.seq_len), x_train)
-    x_dev = convert_to_ids(x_dev_raw, token_ids, args.seq_len)
-    np.save("example_prep_data/prep_dev_len{}.npy".format(args.seq_len), x_dev)
-del x_train_raw, x_dev_raw
-
-x_train, x_dev = torch.LongTensor(x_train).to(device), torch.LongTensor(x_dev).to(device)
+# The first run converts the .txt file to a .npy matrix, which is memory-mapped from then on
+glove_vectors, glove_index = load_glove("glove.6B.50d.txt")
+substitute_lookup, substitutes = None, None
+if args.glove_substitutes:  # Searches the substitutes of all the out-of-vocab tokens of the data at once
+    substitute_lookup = SubstituteLookup(token_ids, glove_vectors, glove_index,
+                                         min_similarity=args.substitute_min_similarity)
+    substitutes = substitute_lookup.add(list(tokens_train.types) + list(tokens_dev.types))
+    print("{} out-of-vocab tokens are encoded as a similar vocab token".format(len(substitutes)))
+
+x_train, n_unknown_train = prep_cache.encode_padded("train", x_train_raw, tokens_train, token_ids, args.seq_len,
+                                                   args.n_oov_buckets, TOKENIZERS[args.tokenizer], substitutes)
+x_dev, n_unknown_dev = prep_cache.encode_padded("dev", x_dev_raw, tokens_dev, token_ids, args.seq_len,
+                                               args.n_oov_buckets, TOKENIZERS[args.tokenizer], substitutes)
+print("Unknown tokens encountered: {} (train), {} (dev)".format(n_unknown_train, n_unknown_dev))
+del tokens_train, tokens_dev, x_train_raw, x_dev_raw
+
+lengths_train = sequence_lengths(x_train)
+x_train = torch.from_numpy(x_train.astype(np.int32)).to(device)
+x_dev = torch.from_numpy(x_dev.astype(np.int32)).to(device)
 
 # %% -------------------------------------- Training Prep ----------------------------------------------------------
-model = CNN(len(token_ids)).to(device)
-look_up_table = get_glove_table(token_ids, glove_embeddings)
+model = (CNNGlobalPool if args.model == "global_pool" else CNN)(len(token_ids)).to(device)
+print("The embedding table has {} rows ({:.2f} MB, plus twice that for the Adam moments)".format(
+    n_embeddings(token_ids, args.n_oov_buckets), model.embedding.weight.numel()*4/1e6))
+look_up_table = get_glove_table(token_ids, glove_vectors, glove_index, n_oov_buckets=args.n_oov_buckets)
 model.embedding.weight.data.copy_(look_up_table)
-optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+optimizer = build_optimizer(model, args.lr, args.sparse_embedding)
 criterion = nn.CrossEntropyLoss()
+# Running train metrics, plus an optional exact evaluation on a fixed sample of the training data
+train_eval_inds = fixed_subset(len(x_train), args.train_eval_size) if args.train_eval_size else None
+model_path = "cnn_sentiment_distilled.pt" if args.distill else "cnn_sentiment.pt"
+if args.distill:  # Looks up the cached LSTM logits of each training sentence by its hash, so the LSTM never runs here
+    teacher_train, teacher_report = load_teacher_logits(args.teacher_logits, hashes_train)
+    teacher_train = torch.from_numpy(teacher_train).to(device)
+    print("Distilling {} (dev accuracy {:.2f})".format(teacher_report["model"], teacher_report["dev_acc"]))
 
 # %% -------------------------------------- Training Loop ----------------------------------------------------------
 labels_ditrib = torch.unique(y_dev, return_counts=True)
@@ -200,43 +234,136 @@ print("The no information rate is {:.2f}".format(100*labels_ditrib[1].max().item
 if args.train:
     acc_dev_best = 0
     print("Starting training loop...")
+    # Groups sentences of similar lengths, so that trimming the padding of each batch saves most of the convolutions.
+    # The sampler is built only once, so that its random state keeps going and each epoch gets a different shuffle
+    if args.model == "global_pool":
+        batches = BucketBatchSampler(lengths_train, args.batch_size)
+    else:
+        batches = [slice(batch*args.batch_size, (batch+1)*args.batch_size)
+                   for batch in range(len(x_train)//args.batch_size + 1)]
     for epoch in range(args.n_epochs):
 
-        loss_train, train_steps = 0, 0
+        loss_train, train_steps, step_time = 0, 0, 0
+        train_metrics = RunningMetrics()
         model.train()
-        total = len(x_train) // args.batch_size + 1  # Initiates a progress bar that will be updated for each batch
-        with tqdm(total=total, desc="Epoch {}".format(epoch)) as pbar:  # "Epoch" will be updated for each epoch
-            for batch in range(len(x_train)//args.batch_size + 1):
-                inds = slice(batch*args.batch_size, (batch+1)*args.batch_size)
+        # Initiates a progress bar that will be updated for each batch ("Epoch" will be updated for each epoch)
+        with tqdm(total=len(batches), desc="Epoch {}".format(epoch)) as pbar:
+            for inds in batches:
                 optimizer.zero_grad()
-                logits = model(x_train[inds])
-                loss = criterion(logits, y_train[inds])
+                if args.model == "global_pool":
+                    logits = model(trim_padding(x_train[inds], lengths_train[inds]))
+                else:
+                    logits = model(x_train[inds])
+                if args.distill:
+                    loss = distillation_loss(logits, teacher_train[inds], y_train[inds], args.temperature,
+                                             args.distill_alpha)
+                else:
+                    loss = criterion(logits, y_train[inds])
                 loss.backward()
+                step_start = time.time()
                 optimizer.step()
+                step_time += time.time() - step_start
                 loss_train += loss.item()
+                train_metrics.update(logits, y_train[inds], loss)
                 train_steps += 1
                 pbar.update(1)  # Updates the progress and the training loss
                 pbar.set_postfix_str("Training Loss: {:.5f}".format(loss_train / train_steps))
 
         model.eval()
-        with torch.no_grad():
-            y_dev_pred = model(x_dev)
-            loss = criterion(y_dev_pred, y_dev)
-            loss_test = loss.item()
-
-        acc_dev = acc(x_dev, y_dev)
+        acc_dev, loss_test, _ = evaluate(model, x_dev, y_dev, args.batch_size, criterion)
         print("Epoch {} | Train Loss {:.5f}, Train Acc {:.2f} - Test Loss {:.5f}, Test Acc {:.2f}".format(
-            epoch, loss_train/train_steps, acc(x_train, y_train), loss_test, acc_dev))
+            epoch, train_metrics.loss, train_metrics.accuracy, loss_test, acc_dev))
+        if train_eval_inds is not None:  # Exact, but only on a fixed sample of the training data
+            acc_train_exact, _, _ = evaluate(model, x_train[train_eval_inds], y_train[train_eval_inds], args.batch_size)
+            print("Exact Train Acc on {} sentences {:.2f}".format(len(train_eval_inds), acc_train_exact))
+        if epoch == 0:  # The optimizer state and the gradients take the same memory on every step
+            print("Optimizer state {:.2f} MB, gradients {:.2f} MB - {:.2f} ms per optimizer step".format(
+                *optimizer_memory_mb(model, optimizer), 1000*step_time/train_steps))
 
         if acc_dev > acc_dev_best and args.save_model:
-            torch.save(model.state_dict(), "cnn_sentiment.pt")
+            torch.save(model.state_dict(), model_path)
             print("The model has been saved!")
             acc_dev_best = acc_dev
 
 # %% ------------------------------------------ Final test -------------------------------------------------------------
-model.load_state_dict(torch.load("cnn_sentiment.pt"))
+model.load_state_dict(torch.load(model_path))
 model.eval()
-y_test_pred = acc(x_dev, y_dev, return_labels=True)
-print("The accuracy on the test set is {:.2f}".format(100*accuracy_score(y_dev.cpu().numpy(), y_test_pred), "%"))
+acc_test, _, confusion_test = evaluate(model, x_dev, y_dev, args.batch_size)
+print("The accuracy on the test set is {:.2f}".format(acc_test, "%"))
 print("The confusion matrix is")
-print(confusion_matrix(y_dev.cpu().numpy(), y_test_pred))
+print(confusion_test)
+
+# %% ---------------------------------- Distillation Report -----------------------------------------------------------
+# Compares the dev accuracy and the CPU latency of a forward at batch sizes 1 and 64 of the teacher, of the CNN trained
+# on the labels only (if cnn_sentiment.pt is there) and of the distilled CNN. The CNN batches are trimmed like when
+# serving. Tokenizing and encoding the sentences takes the same time for all of them, so it is left out
+if args.distill:
+    def collate(batch):
+        return (trim_padding(batch[0], sequence_lengths(batch[0])),) if args.model == "global_pool" else batch
+    reports = [teacher_report]
+    if os.path.exists("cnn_sentiment.pt"):
+        baseline = (CNNGlobalPool if args.model == "global_pool" else CNN)(len(token_ids)).to(device)
+        baseline.load_state_dict(torch.load("cnn_sentiment.pt"))
+        baseline.eval()
+        reports.append({"model": "CNN (labels only)", "dev_acc": evaluate(baseline, x_dev, y_dev, args.batch_size)[0],
+                        "latency_ms": cpu_latencies(baseline, x_dev, (1, 64), collate)})
+    reports.append({"model": "CNN (distilled)", "dev_acc": acc_test,
+                    "latency_ms": cpu_latencies(model, x_dev, (1, 64), collate)})
+    print("{:<20} {:>8} {:>11} {:>12} {:>18}".format("Model", "Dev Acc", "ms batch 1", "ms batch 64",
+                                                    "Speed-up batch 64"))
+    for report in reports:
+        print("{:<20} {:>8.2f} {:>11.3f} {:>12.3f} {:>17.1f}x".format(
+            report["model"], report["dev_acc"], report["latency_ms"]["1"], report["latency_ms"]["64"],
+            teacher_report["latency_ms"]["64"]/report["latency_ms"]["64"]))
+
+# %% ---------------------------------------- Export -------------------------------------------------------------------
+# Saves the model as TorchScript, with float32 weights and with int8 weights on the Linear layer (dynamic quantization,
+# the convolutions stay in float32, so expect little gain), and compares their CPU latency, throughput, file size and
+# dev accuracy with the eager float32 model
+if args.export:
+    variants = export_variants(model, (x_dev[:8],), model_path[:-len(".pt")], model_path)
+    benchmark_variants(variants, (x_dev,), y_dev, batch_sizes=(1, 8, 64, 512))
+    # So that helpers/bulk_scoring.py loads this model (distilled or not) and encodes its inputs as it was trained
+    prep_cache.update_extra("vocab", export={
+        "file": variants["torchscript fp32"][1], "inputs": "trimmed" if args.model == "global_pool" else "padded",
+        "tokenizer": args.tokenizer, "seq_len": args.seq_len, "n_oov_buckets": args.n_oov_buckets,
+        "substitute_min_similarity": args.substitute_min_similarity if args.glove_substitutes else None})
+
+# %% ----------------------------------- Embedding Quantization --------------------------------------------------------
+# Converts the trained checkpoint to one whose embedding table is product-quantized (see helpers/pq_embedding.py): each
+# row is cut into args.pq_subvectors pieces, each stored as the uint8 index of one of 256 centroids, and each batch
+# only decodes the rows of its own ids. Compares the memory of the table and the dev accuracy with the float32 model
+if args.pq_embedding:
+    pq_path = model_path[:-len(".pt")] + "_pq.pt"
+    pq_model, pq_report = convert_checkpoint(model, model_path, pq_path, args.pq_subvectors)
+    acc_pq, _, _ = evaluate(pq_model, x_dev, y_dev, args.batch_size)
+    print_quantization_report(pq_report, acc_test, acc_pq, model_path, pq_path)
+
+# %% --------------------------------------------- Serving -------------------------------------------------------------
+def predict_ids(x):
+    """ Classifies a padded array of token ids, returning the label and the class probabilities of each row """
+    if args.model == "global_pool":  # A few sentences are usually much shorter than the longest one on the data
+        x = trim_padding(x, sequence_lengths(x))
+    x = torch.from_numpy(x.astype(np.int32)).to(device)
+    with torch.inference_mode():
+        logits = model(x)
+    probs = torch.softmax(logits, dim=1).cpu().numpy()
+    return [{"label": int(p.argmax()), "probs": p.tolist()} for p in probs]
+
+# Repeated sentences (also those that only differ on their spacing or on out-of-vocab words) are answered from an
+# LRU cache keyed by their token ids, without going through the model. GET /stats adds its hit rate and memory
+prediction_cache = PredictionCache(max_entries=args.cache_size)
+def predict_sentences(sentences):
+    """ Classifies a list of raw sentences, returning the label and the class probabilities of each of them """
+    x, _ = encode_sentences(sentences, token_ids, args.seq_len, args.n_oov_buckets, TOKENIZERS[args.tokenizer],
+                            substitutes=substitute_lookup and substitute_lookup.add)  # Also searches the new words
+    if args.cache_size == 0:
+        return predict_ids(x)
+    return prediction_cache.predict(x, predict_ids)
+
+# Scores the sentences sent with e.g. curl -d '{"sentence": "a great movie"}' http://127.0.0.1:8000/predict. The
+# concurrent requests are put together on batches of up to 64 sentences that wait for at most 5 ms for each other,
+# and GET /stats returns the p50/p99 latencies and the histograms of the latencies and the batch sizes
+if args.serve:
+    serve(predict_sentences, port=8000, max_batch_size=64, max_latency_ms=5,
+          extra_stats=lambda: {"prediction_cache": prediction_cache.summary()})
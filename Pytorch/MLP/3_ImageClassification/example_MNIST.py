@@ -1,9 +1,12 @@
 # %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import sys
 import numpy as np
 import torch
 import torch.nn as nn
 from torchvision import datasets
-from sklearn.metrics import accuracy_score
+sys.path.append(os.path.join(os.getcwd(), "..", ".."))  # To import the helpers shared by all the examples
+from helpers.evaluation import evaluate, RunningMetrics, fixed_subset
 
 
 # %% --------------------------------------- Set-Up --------------------------------------------------------------------
@@ -21,21 +24,10 @@ LR = 1e-3
 N_NEURONS = (100, 200, 100)
 N_EPOCHS = 20
 BATCH_SIZE = 512
+TRAIN_EVAL_SIZE = None  # Also evaluates exactly on a fixed random sample of this many training images
 DROPOUT = 0.2
 
 
-# %% ----------------------------------- Helper Functions --------------------------------------------------------------
-def acc(x, y, return_labels=False):
-    """ Simple function to get the accuracy or the predicted labels. The label with the highest logit is chosen """
-    with torch.no_grad():  # Explained on the training loop
-        logits = model(x)  # (n_examples, n_labels) --> Need to operate on columns, so axis=1
-        pred_labels = np.argmax(logits.cpu().numpy(), axis=1)
-    if return_labels:
-        return pred_labels
-    else:
-        return 100*accuracy_score(y.cpu().numpy(), pred_labels)
-
-
 # %% -------------------------------------- MLP Class ------------------------------------------------------------------
 class MLP(nn.Module):
     """ MLP with 3 hidden layers """
@@ -100,12 +92,14 @@ model = MLP(*N_NEURONS).to(device)
 # model = MLPModuleList(N_NEURONS).to(device)
 optimizer = torch.optim.Adam(model.parameters(), lr=LR)
 criterion = nn.CrossEntropyLoss()
+train_eval_inds = fixed_subset(len(x_train), TRAIN_EVAL_SIZE) if TRAIN_EVAL_SIZE else None
 
 # %% -------------------------------------- Training Loop ----------------------------------------------------------
 print("Starting training loop...")
 for epoch in range(N_EPOCHS):
 
-    loss_train = 0  # Initializes train loss which will be added up after going forward on each batch
+    # Accumulates the train loss and accuracy from the logits of each batch, instead of going forward again on all
+    train_metrics = RunningMetrics()  # the training data after the epoch, which would take almost as long as training
     model.train()  # Activates Dropout and makes BatchNorm use the actual training data to compute the mean and std
     # (this is the default behaviour but will be changed later on the evaluation phase)
     for batch in range(len(x_train)//BATCH_SIZE + 1):  # Loops over the number of batches (n_examples//batch_size)
@@ -115,13 +109,16 @@ for epoch in range(N_EPOCHS):
         loss = criterion(logits, y_train[inds])
         loss.backward()
         optimizer.step()
-        loss_train += loss.item()
+        train_metrics.update(logits, y_train[inds], loss)
 
     model.eval()  # Deactivates Dropout and makes BatchNorm use mean and std estimates computed during training
-    with torch.no_grad():  # The code inside will run without Autograd, which reduces memory usage, speeds up
-        y_test_pred = model(x_test)  # computations and makes sure the model can't use the test data to learn
-        loss = criterion(y_test_pred, y_test)
-        loss_test = loss.item()
-
+    # evaluate goes forward on batches of BATCH_SIZE and accumulates the accuracy (the label with the highest logit is
+    # chosen), the loss and the confusion matrix, so the memory used does not grow with the size of the data. It runs
+    # without Autograd (torch.inference_mode()), which reduces memory usage, speeds up computations and makes sure the
+    # model can't use the test data to learn
+    acc_test, loss_test, _ = evaluate(model, x_test, y_test, BATCH_SIZE, criterion)
     print("Epoch {} | Train Loss {:.5f}, Train Acc {:.2f} - Test Loss {:.5f}, Test Acc {:.2f}".format(
-        epoch, loss_train/batch, acc(x_train, y_train), loss_test, acc(x_test, y_test)))
+        epoch, train_metrics.loss, train_metrics.accuracy, loss_test, acc_test))
+    if train_eval_inds is not None:  # Exact, but only on a fixed sample of the training data
+        acc_train_exact, _, _ = evaluate(model, x_train[train_eval_inds], y_train[train_eval_inds], BATCH_SIZE)
+        print("Exact Train Acc on {} images {:.2f}".format(len(train_eval_inds), acc_train_exact))
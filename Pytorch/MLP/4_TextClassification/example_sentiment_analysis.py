@@ -1,26 +1,26 @@
 # %% --------------------------------------- Imports -------------------------------------------------------------------
 import os
+import sys
 import numpy as np
-import pandas as pd
-import json
+import time
 import torch
 import torch.nn as nn
-from sklearn.metrics import accuracy_score, confusion_matrix
 import nltk
+sys.path.append(os.path.join(os.getcwd(), "..", ".."))  # To import the helpers shared by all the examples
+from helpers.sst import load_sst2
+from helpers.tokenization import load_tokenized_corpus, TOKENIZERS
+from helpers.vocab import build_vocab, n_embeddings
+from helpers.encoding import encode_sentences
+from helpers.prep_cache import PrepCache, fingerprint, row_hashes
+from helpers.batching import ragged_from_padded, ragged_batch
+from helpers.evaluation import evaluate, RunningMetrics, fixed_subset
+from helpers.serving import serve
+from helpers.prediction_cache import PredictionCache
+from helpers.optim import build_optimizer, optimizer_memory_mb
+from helpers.export import export_variants, benchmark_variants
+from helpers.pq_embedding import convert_checkpoint, print_quantization_report
 nltk.download('punkt')
 
-if "SST-2" not in os.listdir(os.getcwd()):
-    try:
-        os.system("wget https://dl.fbaipublicfiles.com/glue/data/SST-2.zip")
-        os.system("unzip SST-2.zip")
-    except:
-        print("There was a problem with the download!")
-        # Download the Stanford Sentiment Treebank from https://gluebenchmark.com/tasks and unzip it in the current working dir
-    if "SST-2" not in os.listdir(os.getcwd()):
-        print("There was a problem with the download!")
-        import sys
-        sys.exit()
-
 # %% --------------------------------------- Set-Up --------------------------------------------------------------------
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 torch.manual_seed(42)
@@ -31,66 +31,50 @@ torch.backends.cudnn.benchmark = False
 # %% ----------------------------------- Hyper Parameters --------------------------------------------------------------
 class Args:
     def __init__(self):
+        self.train_level = "phrase"  # "phrase" trains on all the phrases of the train sentences (like GLUE's
+        # SST-2 train set) and "sentence" only on the whole sentences. The dev set always has whole sentences
+        self.tokenizer = "fast"  # "nltk" (nltk.word_tokenize) or "fast", which gives the same tokens much faster
         self.seq_len = "get_max_from_data"
         # self.seq_len = 30
+        self.model = "flatten"  # "flatten" uses the MLP class below, and "bag" uses MLPBag, whose input size does not
+        self.bag_mode = "mean"  # depend on seq_len because it averages ("mean") or adds up ("sum") the word embeddings
         self.embedding_dim = 100
+        self.min_freq = 1  # Tokens that appear less than min_freq times are left out of the vocab, and so are
+        self.max_vocab_size = None  # all but the max_vocab_size most frequent ones (None means no limit)
+        self.n_oov_buckets = 1  # Out-of-vocab tokens are hashed into this number of extra token ids
+        self.sparse_embedding = False  # Trains the embedding with sparse gradients and SparseAdam (the rest with Adam),
+        # so that each step only updates the rows of the token ids on the batch instead of the whole embedding table
         self.n_neurons = (100, 200, 100)
         self.n_epochs = 10
         self.lr = 1e-2
         self.batch_size = 512
+        self.train_eval_size = None  # Train Acc is the running accuracy of the training batches of each epoch. With a
+        # number, the model is also evaluated exactly on a fixed random sample of that many training sentences
         self.dropout = 0.2
         self.train = True
         self.save_model = True
+        self.serve = False  # After the final test, keeps the model loaded and serves its predictions (see below)
+        self.cache_size = 10000  # Max number of predictions the server keeps in its cache (0 disables it)
+        self.export = False  # Exports the model to TorchScript (float32 and int8) and benchmarks it (see below)
+        self.pq_embedding = False  # Converts the trained model to a product-quantized embedding table (see below)
+        self.pq_subvectors = 50  # Pieces each row of the table is cut into (embedding_dim must be a multiple of it)
 
 args = Args()
 
 # %% ----------------------------------- Helper Functions --------------------------------------------------------------
-def acc(x, y, return_labels=False):
-    with torch.no_grad():
-        logits = model(x)
-        pred_labels = np.argmax(logits.cpu().numpy(), axis=1)
-    if return_labels:
-        return pred_labels
-    else:
-        return 100*accuracy_score(y.cpu().numpy(), pred_labels)
-
-def extract_vocab_dict_and_msl(sentences_train, sentences_dev):
-    """ Tokenizes all the sentences and gets a dictionary of unique tokens and also the maximum sequence length """
-    tokens, ms_len = [], 0
-    for sentence in list(sentences_train) + list(sentences_dev):
-        tokens_in_sentence = nltk.word_tokenize(sentence)
-        if ms_len < len(tokens_in_sentence):
-            ms_len = len(tokens_in_sentence)
-        tokens += tokens_in_sentence
-    # We reserve the 0 id for padded 0s
-    token_vocab = {key: i for key, i in zip(set(tokens), range(1, len(set(tokens))+1))}
-    if len(np.unique(list(token_vocab.values()))) != len(token_vocab):
-        "There are some rep words..."
+def extract_vocab_dict_and_msl(corpus_train, corpus_dev):
+    """ Gets a dictionary of the tokens from the tokenized sentences and also the maximum sequence length """
+    ms_len = max(corpus_train.max_len(), corpus_dev.max_len())
+    token_vocab = build_vocab([corpus_train, corpus_dev], args.min_freq, args.max_vocab_size)
     return token_vocab, ms_len
 
-def convert_to_ids(raw_sentences, vocab_dict, pad_to):
-    """ Takes an NumPy array of raw text sentences and converts to a sequence of token ids """
-    x = np.empty((len(raw_sentences), pad_to))
-    for idx, sentence in enumerate(raw_sentences):
-        word_ids = []
-        for token in nltk.word_tokenize(sentence):
-            try:
-                word_ids.append(vocab_dict[token])
-            except:  # This option is to handle out-of-vocab words, which will be assigned the same token id. There are
-                print("Unknown token encountered:", token)  # better ways of handling this, like WordPiece embeddings.
-                word_ids.append(len(vocab_dict))  # Adds one more unique id which will stand for unknown tokens
-        if pad_to < len(word_ids):
-            x[idx] = word_ids[:pad_to]
-        else:
-            x[idx] = word_ids + [0] * (pad_to - len(word_ids))
-    return x
-
 # %% -------------------------------------- MLP Class ------------------------------------------------------------------
 class MLP(nn.Module):
     def __init__(self, vocab_size, neurons_per_layer):
         super(MLP, self).__init__()
-        # Maps token ids (integers) to a embedding_dim dimensional space (vocab_size+2 to account for unknown and padded tokens)
-        self.embedding = nn.Embedding(vocab_size+2, args.embedding_dim)
+        # Maps token ids (integers) to a embedding_dim dimensional space (vocab_size+1+n_oov_buckets to account for the
+        self.embedding = nn.Embedding(vocab_size+1+args.n_oov_buckets, args.embedding_dim,  # padded and unknown tokens)
+                                      sparse=args.sparse_embedding)
         # MLP part, the input dim to the first layer must be seq_len * embedding_dim
         dims = (args.seq_len*args.embedding_dim, *neurons_per_layer)
         self.layers = nn.ModuleList([
@@ -110,42 +94,75 @@ class MLP(nn.Module):
             x = layer(x)
         return x
 
+class MLPBag(nn.Module):
+    def __init__(self, vocab_size, neurons_per_layer):
+        super(MLPBag, self).__init__()
+        # nn.EmbeddingBag looks up the embeddings of all the tokens of each sentence and reduces them to a single
+        # embedding_dim vector, without ever materializing the (batch_size, seq_len, embedding_dim) tensor.
+        # padding_idx=0 leaves the padded 0s out of the reduction, in case the input is zero-padded instead of ragged
+        self.embedding = nn.EmbeddingBag(vocab_size+1+args.n_oov_buckets, args.embedding_dim, mode=args.bag_mode,
+                                         padding_idx=0, sparse=args.sparse_embedding)
+        dims = (args.embedding_dim, *neurons_per_layer)  # So the input dim to the first layer is just embedding_dim
+        self.layers = nn.ModuleList([
+            nn.Sequential(
+                nn.Linear(dims[i], dims[i+1]),
+                nn.ReLU(),
+                nn.BatchNorm1d(dims[i+1]),
+                nn.Dropout(args.dropout)
+            ) for i in range(len(dims)-1)
+        ])
+        self.layers.extend(nn.ModuleList([nn.Linear(neurons_per_layer[-1], 2)]))
+
+    def forward(self, x, offsets=None):
+        # x can be either a (batch_size, seq_len) zero-padded tensor, or the ids of all the sentences of the batch one
+        x = self.embedding(x, offsets)  # after the other, with offsets holding the position where each sentence starts
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
 # %% -------------------------------------- Data Prep ------------------------------------------------------------------
-# Loads all the data
-data_train = pd.read_csv("SST-2/train.tsv", sep="\t")
-x_train_raw, y_train = data_train["sentence"].values, torch.LongTensor(data_train["label"].values).to(device)
-data_dev = pd.read_csv("SST-2/dev.tsv", sep="\t")
-x_dev_raw, y_dev = data_dev["sentence"].values, torch.LongTensor(data_dev["label"].values).to(device)
-
-try:  # Tries to open the vocab dict and the maximum sequence length
-    with open("example_prep_data/vocab_dict.json", "r") as s:
-        token_ids = json.load(s)
-    msl = np.load("example_prep_data/max_sequence_length.npy").item()
-except:  # If it fails, gets them from the corpus and saves them
-    print("Tokenizing all the examples to get a vocab dict and the maximum sequence length...")
-    token_ids, msl = extract_vocab_dict_and_msl(x_train_raw, x_dev_raw)
-    # Saves the dict to json so that we can just load it the next time
-    os.mkdir("example_prep_data")
-    with open("example_prep_data/vocab_dict.json", "w") as s:
-        json.dump(token_ids, s)
-    np.save("example_prep_data/max_sequence_length.npy", np.array([msl]))  # Saves msl to numpy
+# Builds the train and dev sets from the Stanford Sentiment Treebank files that come with the RNN example (only
+# the first time, later runs load them from its cache), so there is nothing to download
+x_train_raw, y_train = load_sst2("train", args.train_level)
+x_dev_raw, y_dev = load_sst2("dev", "sentence")
+y_train, y_dev = torch.from_numpy(y_train).to(device), torch.from_numpy(y_dev).to(device)
+# Tokenizes all the sentences only once, using a process pool, and caches the result as a ragged array of int32
+# ids on Pytorch/.token_cache. This cache is shared with the CNN and RNN examples, so later runs just load it
+tokens_train = load_tokenized_corpus(x_train_raw, TOKENIZERS[args.tokenizer])
+tokens_dev = load_tokenized_corpus(x_dev_raw, TOKENIZERS[args.tokenizer])
+
+# The vocab (and so the token ids) depends on the sentences, the tokenizer and these args, so the prep cache keys it by
+# their hashes, and only serves it (and the arrays below) when they are the same. Its hits and misses are logged
+prep_cache = PrepCache("example_prep_data")
+vocab_key = fingerprint(TOKENIZERS[args.tokenizer], row_hashes(x_train_raw), row_hashes(x_dev_raw), args.min_freq,
+                        args.max_vocab_size)
+# The vocab is cached as a compact binary file that is memory-mapped on later runs, instead of a JSON dict that would
+# be parsed on every run (see helpers/binary_vocab.py). It behaves like the dict and looks up many tokens at once
+vocab_entry = prep_cache.get_vocab("vocab", vocab_key)
+if vocab_entry is None:
+    print("Getting a vocab dict and the maximum sequence length from the tokenized examples...")
+    token_ids, msl = extract_vocab_dict_and_msl(tokens_train, tokens_dev)
+    prep_cache.put_vocab("vocab", vocab_key, token_ids, {"msl": msl})
+else:
+    token_ids, msl = vocab_entry[0], vocab_entry[1]["msl"]
 if args.seq_len == "get_max_from_data":
     args.seq_len = msl
-del data_train, data_dev  # Deletes the variables we don't need anymore
-
-# Loads or tokenizes all the sentences and converts to the token ids using the vocab dict
-try:
-    x_train = np.load("example_prep_data/prep_train_len{}.npy".format(args.seq_len))
-    x_dev = np.load("example_prep_data/prep_dev_len{}.npy".format(args.seq_len))
-except:
-    print("Converting all the sentences to sequences of token ids...")
-    x_train = convert_to_ids(x_train_raw, token_ids, args.seq_len)
-    np.save("example_prep_data/prep_train_len{}.npy".format(args.seq_len), x_train)
-    x_dev = convert_to_ids(x_dev_raw, token_ids, args.seq_len)
-    np.save("example_prep_data/prep_dev_len{}.npy".format(args.seq_len), x_dev)
-del x_train_raw, x_dev_raw  # Deletes the variables we don't need anymore
-
-x_train, x_dev = torch.LongTensor(x_train).to(device), torch.LongTensor(x_dev).to(device)
+
+# Maps all the tokens to their ids with a single vectorized look-up, and zero-pads/truncates them to seq_len. The ids
+# are stored as int16 when the vocab is small enough (int32 otherwise), instead of float64. Out-of-vocab tokens are
+# hashed into args.n_oov_buckets extra token ids. There are better ways of handling this, like WordPiece embeddings.
+# The prep cache saves the hash of each sentence with its ids, so when some sentences are added or changed, only those
+# are encoded again (the rest of the ids are just mapped to the new vocab, if it changed)
+x_train, n_unknown_train = prep_cache.encode_padded("train", x_train_raw, tokens_train, token_ids, args.seq_len,
+                                                   args.n_oov_buckets, TOKENIZERS[args.tokenizer])
+x_dev, n_unknown_dev = prep_cache.encode_padded("dev", x_dev_raw, tokens_dev, token_ids, args.seq_len,
+                                               args.n_oov_buckets, TOKENIZERS[args.tokenizer])
+print("Unknown tokens encountered: {} (train), {} (dev)".format(n_unknown_train, n_unknown_dev))
+del tokens_train, tokens_dev, x_train_raw, x_dev_raw  # Deletes the variables we don't need anymore
+
+# nn.Embedding takes int32 or int64 ids, so the int16 arrays are widened to int32, which still takes half the memory
+x_train = torch.from_numpy(x_train.astype(np.int32)).to(device)  # of torch.LongTensor
+x_dev = torch.from_numpy(x_dev.astype(np.int32)).to(device)
 # In this case we don't set x_train.requires_grad = True because the embedding layer acts as a trainable look-up table,
 # i.e, the output of the embedding layer has grad_fn=EmbeddingBackward, so the weight of the embedding
 # layer is being updated by the gradient computed from this function when going backwards, instead of the usual
@@ -153,11 +170,20 @@ x_train, x_dev = torch.LongTensor(x_train).to(device), torch.LongTensor(x_dev).t
 # because we have 1 row of the model.embedding.weight for each id in our vocabulary. The rest of the multiplications
 # would be by 0s if we used a one-hot-encoded input vector instead of a token id. Mathematically, however,
 # it's the exact same weight update.
+if args.model == "bag":  # MLPBag takes ragged batches, i.e, the token ids without the padding plus the sentence offsets
+    ids_train, offsets_train = ragged_from_padded(x_train)
 
 # %% -------------------------------------- Training Prep ----------------------------------------------------------
-model = MLP(len(token_ids), args.n_neurons).to(device)
-optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+model = (MLPBag if args.model == "bag" else MLP)(len(token_ids), args.n_neurons).to(device)
+print("The embedding table has {} rows ({:.2f} MB, plus twice that for the Adam moments)".format(
+    n_embeddings(token_ids, args.n_oov_buckets), model.embedding.weight.numel()*4/1e6))
+n_params = sum(p.numel() for p in model.parameters())
+print("The model has {} parameters ({:.2f} MB)".format(n_params, sum(
+    p.numel()*p.element_size() for p in list(model.parameters()) + list(model.buffers()))/1e6))
+optimizer = build_optimizer(model, args.lr, args.sparse_embedding)
 criterion = nn.CrossEntropyLoss()
+# Running train metrics, plus an optional exact evaluation on a fixed sample of the training data
+train_eval_inds = fixed_subset(len(x_train), args.train_eval_size) if args.train_eval_size else None
 
 # %% -------------------------------------- Training Loop ----------------------------------------------------------
 labels_ditrib = torch.unique(y_dev, return_counts=True)
@@ -167,26 +193,36 @@ if args.train:
     print("Starting training loop...")
     for epoch in range(args.n_epochs):
 
-        loss_train = 0
+        train_metrics, step_time = RunningMetrics(), 0
         model.train()
-        for batch in range(len(x_train)//args.batch_size + 1):
-            inds = slice(batch*args.batch_size, (batch+1)*args.batch_size)
+        start = time.time()
+        for batch_start in range(0, len(x_train), args.batch_size):
+            inds = slice(batch_start, batch_start + args.batch_size)
             optimizer.zero_grad()
-            logits = model(x_train[inds])
+            if args.model == "bag":
+                logits = model(*ragged_batch(ids_train, offsets_train, inds))
+            else:
+                logits = model(x_train[inds])
             loss = criterion(logits, y_train[inds])
             loss.backward()
+            step_start = time.time()
             optimizer.step()
-            loss_train += loss.item()
+            step_time += time.time() - step_start
+            train_metrics.update(logits, y_train[inds], loss)  # Instead of evaluating on x_train after the epoch
+        samples_per_sec = len(x_train)/(time.time() - start)
 
         model.eval()
-        with torch.no_grad():
-            y_dev_pred = model(x_dev)
-            loss = criterion(y_dev_pred, y_dev)
-            loss_test = loss.item()
-
-        acc_dev = acc(x_dev, y_dev)
-        print("Epoch {} | Train Loss {:.5f}, Train Acc {:.2f} - Test Loss {:.5f}, Test Acc {:.2f}".format(
-            epoch, loss_train/args.batch_size, acc(x_train, y_train), loss_test, acc_dev))
+        # Goes forward on batches of the data and accumulates the metrics, instead of on all the data at once
+        acc_dev, loss_test, _ = evaluate(model, x_dev, y_dev, args.batch_size, criterion)
+        print("Epoch {} | Train Loss {:.5f}, Train Acc {:.2f} - Test Loss {:.5f}, Test Acc {:.2f} - {:.0f} samples/sec"
+              .format(epoch, train_metrics.loss, train_metrics.accuracy, loss_test, acc_dev, samples_per_sec))
+        if train_eval_inds is not None:  # Exact, but only on a fixed sample of the training data
+            acc_train_exact, _, _ = evaluate(model, x_train[train_eval_inds], y_train[train_eval_inds], args.batch_size)
+            print("Exact Train Acc on {} sentences {:.2f}".format(len(train_eval_inds), acc_train_exact))
+        if epoch == 0:  # The optimizer state and the gradients take the same memory on every step
+            print("Optimizer state {:.2f} MB, gradients {:.2f} MB - {:.2f} ms per optimizer step".format(
+                *optimizer_memory_mb(model, optimizer),
+                1000*step_time/((len(x_train) + args.batch_size - 1)//args.batch_size)))
 
         if acc_dev > acc_dev_best and args.save_model:
             torch.save(model.state_dict(), "mlp_sentiment.pt")
@@ -196,7 +232,53 @@ if args.train:
 # %% ------------------------------------------ Final test -------------------------------------------------------------
 model.load_state_dict(torch.load("mlp_sentiment.pt"))
 model.eval()
-y_test_pred = acc(x_dev, y_dev, return_labels=True)
-print("The accuracy on the test set is {:.2f}".format(100*accuracy_score(y_dev.cpu().numpy(), y_test_pred), "%"))
+acc_test, _, confusion_test = evaluate(model, x_dev, y_dev, args.batch_size)
+print("The accuracy on the test set is {:.2f}".format(acc_test, "%"))
 print("The confusion matrix is")
-print(confusion_matrix(y_dev.cpu().numpy(), y_test_pred))
+print(confusion_test)
+
+# %% ---------------------------------------- Export -------------------------------------------------------------------
+# Saves the model as TorchScript, with float32 weights and with int8 weights on the Linear layers (dynamic
+# quantization), and compares their CPU latency, throughput, file size and dev accuracy with the eager float32 model
+if args.export:
+    variants = export_variants(model, (x_dev[:8],), "mlp_sentiment", "mlp_sentiment.pt")
+    benchmark_variants(variants, (x_dev,), y_dev, batch_sizes=(1, 8, 64, 512))
+    # So that helpers/bulk_scoring.py loads the model and encodes its inputs as it was trained (MLPBag takes them
+    prep_cache.update_extra("vocab", export={  # zero-padded too)
+        "file": variants["torchscript fp32"][1], "inputs": "padded", "tokenizer": args.tokenizer,
+        "seq_len": args.seq_len, "n_oov_buckets": args.n_oov_buckets})
+
+# %% ----------------------------------- Embedding Quantization --------------------------------------------------------
+# Converts the trained checkpoint to one whose embedding table is product-quantized (see helpers/pq_embedding.py): each
+# row is cut into args.pq_subvectors pieces, each stored as the uint8 index of one of 256 centroids, and each batch
+# only decodes the rows of its own ids. Compares the memory of the table and the dev accuracy with the float32 model
+if args.pq_embedding:
+    pq_model, pq_report = convert_checkpoint(model, "mlp_sentiment.pt", "mlp_sentiment_pq.pt", args.pq_subvectors)
+    acc_pq, _, _ = evaluate(pq_model, x_dev, y_dev, args.batch_size)
+    print_quantization_report(pq_report, acc_test, acc_pq, "mlp_sentiment.pt", "mlp_sentiment_pq.pt")
+
+# %% --------------------------------------------- Serving -------------------------------------------------------------
+def predict_ids(x):
+    """ Classifies a padded array of token ids, returning the label and the class probabilities of each row """
+    x = torch.from_numpy(x.astype(np.int32)).to(device)
+    with torch.inference_mode():
+        logits = model(*ragged_from_padded(x)) if args.model == "bag" else model(x)
+    probs = torch.softmax(logits, dim=1).cpu().numpy()
+    return [{"label": int(p.argmax()), "probs": p.tolist()} for p in probs]
+
+# Repeated sentences (also those that only differ on their spacing or on out-of-vocab words) are answered from an
+# LRU cache keyed by their token ids, without going through the model. GET /stats adds its hit rate and memory
+prediction_cache = PredictionCache(max_entries=args.cache_size)
+def predict_sentences(sentences):
+    """ Classifies a list of raw sentences, returning the label and the class probabilities of each of them """
+    x, _ = encode_sentences(sentences, token_ids, args.seq_len, args.n_oov_buckets, TOKENIZERS[args.tokenizer])
+    if args.cache_size == 0:
+        return predict_ids(x)
+    return prediction_cache.predict(x, predict_ids)
+
+# Scores the sentences sent with e.g. curl -d '{"sentence": "a great movie"}' http://127.0.0.1:8000/predict. The
+# concurrent requests are put together on batches of up to 64 sentences that wait for at most 5 ms for each other,
+# and GET /stats returns the p50/p99 latencies and the histograms of the latencies and the batch sizes
+if args.serve:
+    serve(predict_sentences, port=8000, max_batch_size=64, max_latency_ms=5,
+          extra_stats=lambda: {"prediction_cache": prediction_cache.summary()})
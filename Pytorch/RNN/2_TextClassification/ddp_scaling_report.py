@@ -0,0 +1,40 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import re
+import sys
+import subprocess
+
+# Trains the LSTM example with 1, 2, 4 and 8 data-parallel processes (torchrun with the gloo backend on localhost) and
+# reports the training throughput of each, its speed-up over a single process and the final dev accuracy.
+# Run it from this folder, after the example has run once on its own so that all the caches are built
+
+# %% ----------------------------------- Hyper Parameters --------------------------------------------------------------
+class Args:
+    def __init__(self):
+        self.n_procs = (1, 2, 4, 8)
+        self.n_epochs = 3  # The throughput is taken from the last one, once everything is warmed up
+
+args = Args()
+
+# %% -------------------------------------- Scaling Runs ---------------------------------------------------------------
+results = []
+for n_procs in args.n_procs:
+    print("Training on {} process(es)...".format(n_procs))
+    run = subprocess.run([sys.executable, "-m", "torch.distributed.run", "--standalone",
+                          "--nproc_per_node={}".format(n_procs), "example_LSTM_sentiment_analysis.py"],
+                         env=dict(os.environ, N_EPOCHS=str(args.n_epochs)), capture_output=True, text=True)
+    if run.returncode != 0:
+        print(run.stderr[-2000:])
+        raise RuntimeError("The run with {} processes failed".format(n_procs))
+    samples_per_sec = [float(x) for x in re.findall(r"^Epoch \d+ \|.* - (\d+) samples/sec$", run.stdout, re.M)]
+    acc_dev = float(re.search(r"The accuracy on the test set is ([\d.]+)", run.stdout).group(1))
+    results.append((n_procs, samples_per_sec[-1], acc_dev))
+
+# %% ---------------------------------------- Report -------------------------------------------------------------------
+print("\n{} cores. Training throughput on the last of {} epochs (global batch size unchanged)".format(
+    os.cpu_count(), args.n_epochs))
+print("{:>10} {:>15} {:>9} {:>11} {:>8}".format("Processes", "Sentences/sec", "Speed-up", "Efficiency", "Dev Acc"))
+for n_procs, samples_per_sec, acc_dev in results:
+    speed_up = samples_per_sec/results[0][1]
+    print("{:>10} {:>15.0f} {:>8.2f}x {:>10.0f}% {:>8.2f}".format(
+        n_procs, samples_per_sec, speed_up, 100*speed_up*results[0][0]/n_procs, acc_dev))
@@ -1,26 +1,31 @@
 # %% --------------------------------------- Imports -------------------------------------------------------------------
 import os
+import time
+import sys
 import numpy as np
-import pandas as pd
-import json
 import torch
 import torch.nn as nn
-from sklearn.metrics import accuracy_score, confusion_matrix
+import torch.distributed as dist
 import nltk
+sys.path.append(os.path.join(os.getcwd(), "..", ".."))
+from helpers.sst import load_sst2
+from helpers.tokenization import load_tokenized_corpus, TOKENIZERS
+from helpers.vocab import build_vocab, n_embeddings
+from helpers.encoding import encode_sentences, encode_padded
+from helpers.prep_cache import PrepCache, fingerprint, row_hashes
+from helpers.glove import load_glove, get_glove_table, SubstituteLookup
+from helpers.evaluation import evaluate, RunningMetrics, fixed_subset
+from helpers.serving import serve
+from helpers.prediction_cache import PredictionCache
+from helpers.optim import build_optimizer, optimizer_memory_mb
+from helpers.export import export_variants, benchmark_variants
+from helpers.pq_embedding import convert_checkpoint, print_quantization_report
+from helpers.distillation import predict_logits, cpu_latencies, save_teacher_logits
+from helpers.batching import sequence_lengths, BucketBatchSampler
+from helpers.prefix_trie import PrefixTrie, trie_lstm_levels
 from tqdm import tqdm
 nltk.download('punkt')
 
-if "SST-2" not in os.listdir(os.getcwd()):
-    try:
-        os.system("wget https://dl.fbaipublicfiles.com/glue/data/SST-2.zip")
-        os.system("unzip SST-2.zip")
-    except:
-        print("There was a problem with the download!")
-        # Download the Stanford Sentiment Treebank from https://gluebenchmark.com/tasks and unzip it in the current working dir
-    if "SST-2" not in os.listdir(os.getcwd()):
-        print("There was a problem with the download!")
-        import sys
-        sys.exit()
 if "glove.6B.50d.txt" not in os.listdir(os.getcwd()):
     try:
         os.system("wget http://nlp.stanford.edu/data/glove.6B.zip")
@@ -36,16 +41,36 @@ if "glove.6B.50d.txt" not in os.listdir(os.getcwd()):
         # current working directory.
 
 # %% --------------------------------------- Set-Up --------------------------------------------------------------------
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# Data-parallel training on several CPU processes, launched from this folder with
+# torchrun --standalone --nproc_per_node=4 example_LSTM_sentiment_analysis.py
+# Each process trains on its own shard of every batch, and DistributedDataParallel averages the gradients of all of
+# them (all-reduce) during the backward pass, so all the copies of the model take the same steps
+DISTRIBUTED = "WORLD_SIZE" in os.environ  # Set by torchrun
+if DISTRIBUTED:
+    dist.init_process_group("gloo")  # The CPU backend. torchrun --standalone sets up the rendezvous on localhost
+    torch.set_num_threads(max(1, (os.cpu_count() or 1)//dist.get_world_size()))  # So the processes share the cores
+RANK, WORLD_SIZE = (dist.get_rank(), dist.get_world_size()) if DISTRIBUTED else (0, 1)
+if RANK != 0:  # Only rank 0 prints (the errors still go to stderr)
+    sys.stdout = open(os.devnull, "w")
+device = torch.device("cuda" if torch.cuda.is_available() and not DISTRIBUTED else "cpu")
 torch.manual_seed(42)
 np.random.seed(42)
 torch.backends.cudnn.deterministic = True
 torch.backends.cudnn.benchmark = False
 TRAIN, SAVE_MODEL = True, True
+SERVE = False  # After the final test, keeps the model loaded and serves its predictions (see below)
+CACHE_SIZE = 10000  # Max number of predictions the server keeps in its cache (0 disables it)
+EXPORT = False  # Exports the model to TorchScript (float32 and int8) and benchmarks it (see below)
+TEACHER_LOGITS = False  # Saves the logits of the model on the training sentences for the 1D CNN to distill (see below)
+SCORE_PHRASES = False  # Scores all the phrases of the treebank, sharing the LSTM states of their prefixes (see below)
+PQ_EMBEDDING = False  # Converts the trained model to a product-quantized embedding table (see below)
 
 # %% ----------------------------------- Hyper Parameters --------------------------------------------------------------
 class Args:
     def __init__(self):
+        self.train_level = "phrase"  # "phrase" trains on all the phrases of the train sentences (like GLUE's
+        # SST-2 train set) and "sentence" only on the whole sentences. The dev set always has whole sentences
+        self.tokenizer = "fast"  # "nltk" (nltk.word_tokenize) or "fast", which gives the same tokens much faster
         self.seq_len = "get_max_from_data"  # Important Note: LSTMs can process variable length sequences, so we do not
         # need to zero-pad all the sentences to a fixed length value. However, if we want to do vectorized mini-batching
         # we do need to do so. Otherwise, we could still do mini-batch GD by aggregating the gradients but we would need
@@ -53,83 +78,42 @@ class Args:
         self.use_packed_sequence = True  # Another way (and probably better) of processing variable length sequences is by
         # using torch.nn.utils.rnn.PackedSequence. This way we are still padding BUT the padded zeros are not shown to the LSTM.
         self.embedding_dim = 50
-        self.n_epochs = 10
+        self.min_freq = 1
+        self.max_vocab_size = None
+        self.n_oov_buckets = 1
+        self.glove_substitutes = False  # Encodes the out-of-vocab tokens that have a GloVe vector as the vocab token
+        # with the most similar one (see helpers/glove.py) instead of as an out-of-vocab bucket, training and serving
+        self.substitute_min_similarity = 0.5  # Those less similar than this to all the vocab tokens stay out-of-vocab
+        self.sparse_embedding = False  # Trains the embedding with sparse gradients and SparseAdam (the rest with Adam),
+        # so that each step only updates the rows of the token ids on the batch instead of the whole embedding table
+        self.pq_subvectors = 25  # With PQ_EMBEDDING, pieces each row of the table is cut into (see below)
+        self.n_epochs = int(os.environ.get("N_EPOCHS", 10))  # ddp_scaling_report.py sets N_EPOCHS to run fewer epochs
         self.lr = 1e-3
         self.batch_size = 512
+        self.train_eval_size = None  # Train Acc is the running accuracy of the training batches of each epoch. With a
+        # number, the model is also evaluated exactly on a fixed random sample of that many training sentences
         self.hidden_size = 16
         self.n_layers = 3
         self.lstm_drop = 0.5
         self.lin_drop = 0.5
+        self.bucket_batches = True  # Groups sentences with similar lengths on the same batch (see BucketBatchSampler),
+        # so that the packed LSTM runs for fewer time steps on each batch
 
 args = Args()
 
 # %% ----------------------------------- Helper Functions --------------------------------------------------------------
-def acc(x, y, return_labels=False):
-    with torch.no_grad():
-        logits = torch.empty(len(x), 2)
-        for batch in range(len(x) // args.batch_size + 1):
-            inds = slice(batch * args.batch_size, (batch + 1) * args.batch_size)
-            logits[inds] = model(x[inds])
-        pred_labels = np.argmax(logits.cpu().numpy(), axis=1)
-    if return_labels:
-        return pred_labels
-    else:
-        return 100*accuracy_score(y.cpu().numpy(), pred_labels)
-
-def extract_vocab_dict_and_msl(sentences_train, sentences_dev):
-    """ Tokenizes all the sentences and gets a dictionary of unique tokens and also the maximum sequence length """
-    tokens, ms_len = [], 0
-    for sentence in list(sentences_train) + list(sentences_dev):
-        tokens_in_sentence = nltk.word_tokenize(sentence)
-        if ms_len < len(tokens_in_sentence):
-            ms_len = len(tokens_in_sentence)
-        tokens += tokens_in_sentence
-    token_vocab = {key: i for key, i in zip(set(tokens), range(1, len(set(tokens))+1))}
-    if len(np.unique(list(token_vocab.values()))) != len(token_vocab):
-        "There are some rep words..."
+def extract_vocab_dict_and_msl(corpus_train, corpus_dev):
+    """ Gets a dictionary of the tokens from the tokenized sentences and also the maximum sequence length """
+    ms_len = max(corpus_train.max_len(), corpus_dev.max_len())
+    token_vocab = build_vocab([corpus_train, corpus_dev], args.min_freq, args.max_vocab_size)
     return token_vocab, ms_len
 
-def convert_to_ids(raw_sentences, vocab_dict, pad_to):
-    """ Takes an NumPy array of raw text sentences and converts to a sequence of token ids """
-    x = np.empty((len(raw_sentences), pad_to))
-    for idx, sentence in enumerate(raw_sentences):
-        word_ids = []
-        for token in nltk.word_tokenize(sentence):
-            try:
-                word_ids.append(vocab_dict[token])
-            except:
-                word_ids.append(vocab_dict[token])
-        if pad_to < len(word_ids):
-            x[idx] = word_ids[:pad_to]
-        else:
-            x[idx] = word_ids + [0] * (pad_to - len(word_ids))
-    return x
-
-def get_glove_embeddings(vocab_dict):
-    with open("glove.6B.50d.txt", "r") as s:
-        glove = s.read()
-    embeddings_dict = {}
-    for line in glove.split("\n")[:-1]:
-        text = line.split()
-        if text[0] in vocab_dict:
-            embeddings_dict[vocab_dict[text[0]]] = torch.from_numpy(np.array(text[1:], dtype="float32"))
-    return embeddings_dict
-
-def get_glove_table(vocab_dict, glove_dict):
-    lookup_table = torch.empty((len(vocab_dict)+2, 50))
-    for token_id in sorted(vocab_dict.values()):
-        if token_id in glove_dict:
-            lookup_table[token_id] = glove_dict[token_id]
-        else:
-            lookup_table[token_id] = torch.ones((1, 50))  # For unknown tokens (we change it to ones due to the packed sequence)
-    lookup_table[0] = torch.zeros((1, 50))
-    return lookup_table
-
 # %% -------------------------------------- LSTM Class -----------------------------------------------------------------
 class SentimentLSTM(nn.Module):
     def __init__(self, vocab_size, hidden_size=args.hidden_size, n_layers=args.n_layers):
         super(SentimentLSTM, self).__init__()
-        self.embedding = nn.Embedding(vocab_size + 2, args.embedding_dim, padding_idx=0)
+        self.embedding = nn.Embedding(vocab_size + 1 + args.n_oov_buckets, args.embedding_dim, padding_idx=0,
+                                      sparse=args.sparse_embedding)
         # padding_idx=0 makes the embedding table assign a vector of zeros to the padded 0s, i.e, this embedding is not learnt
         self.lstm = nn.LSTM(input_size=args.embedding_dim, hidden_size=hidden_size, num_layers=n_layers, dropout=args.lstm_drop)
         # This layer will act as a learnable weighted average over time of all the outputs of the LSTM along the input
@@ -138,67 +122,107 @@ class SentimentLSTM(nn.Module):
         self.out = nn.Linear(hidden_size, 2)  # This final layer maps this average to classify positive/negative reviews
         self.drop = nn.Dropout(args.lin_drop)
 
-    def forward(self, x):
+    def forward(self, x, lengths):
+        # lengths holds the actual length of each sentence before padding, which is computed once at the preprocessing step
+        # The padding after the longest sentence of the batch is not needed at all. torch.jit.trace would record the
+        if args.use_packed_sequence and not torch.jit.is_tracing():  # length of the example batch as a constant
+            x = x[:, :int(lengths.max())]
         # The output of embedding is (batch, seq_len, embedding_dim) but we want shape (seq_len, batch, embedding_dim)
         x = self.embedding(x).permute(1, 0, 2)  # to input to our LSTM
+        # The initial states are zeros, which is also the default, but the int8 LSTM (see Export) would take the batch
+        # size of its zeros from the example batch when traced, so they are created here from the actual batch
+        h_0 = x.new_zeros(self.lstm.num_layers, x.shape[1], self.lstm.hidden_size)
         if args.use_packed_sequence:
-            lenghts = []  # Gets a list of the actual length of each sentence before padding. This is definitely better done
-            for sentence_idx in range(x.shape[1]):  # at the preprocessing step, but I did not want to change it too much
-                n_zeros = torch.sum(x[:, sentence_idx, :] == 0) / 50
-                lenghts.append(args.seq_len - n_zeros.item())
             # Converts the input padded batched tensor into a packed sequence so that the 0s will be ignored
-            x = nn.utils.rnn.pack_padded_sequence(x, lenghts, enforce_sorted=False)
-        lstm_out, _ = self.lstm(x)  # Note that in this case (compared to 1_ChirpApprox), we completely forget
-        # about h_state and c_state because it makes no sense to use an stateful LSTM, i.e, it makes no sense to pass
-        # the memory of previous batches to the next batches, as they are not related at all
+            x = nn.utils.rnn.pack_padded_sequence(x, lengths.cpu(), enforce_sorted=False)
+        lstm_out, _ = self.lstm(x, (h_0, h_0))  # Note that in this case (compared to 1_ChirpApprox), we completely
+        # forget about h_state and c_state because it makes no sense to use an stateful LSTM, i.e, it makes no sense to
+        # pass the memory of previous batches to the next batches, as they are not related at all
         if args.use_packed_sequence:
             # Converts back to the padded tensor, we use total_length=args.seq_len to be able to use a linear layer after this
             lstm_out, _ = nn.utils.rnn.pad_packed_sequence(lstm_out, total_length=args.seq_len)
         mean_over_t = self.drop(self.bn_mean(self.mean(lstm_out.permute(1, 0, 2).reshape(lstm_out.shape[1], -1))))
         return self.out(mean_over_t)
 
+    def forward_prefix_trie(self, trie):
+        """ Same logits as forward (on eval mode) for the rows of a PrefixTrie, but the LSTM only goes once over each
+        prefix the rows share. The outputs after the end of each sentence are zeros, so self.mean is the sum over time
+        of the output at each step times the weights of that step, which also builds up along the trie """
+        hidden_size = self.lstm.hidden_size
+        logits = self.out.weight.new_empty(trie.n_rows, self.out.out_features)
+        for depth, parents, lstm_out in trie_lstm_levels(self.embedding, self.lstm, trie):
+            step = lstm_out @ self.mean.weight[:, depth*hidden_size:(depth + 1)*hidden_size].T
+            mean_sum = step if depth == 0 else mean_sum[parents] + step
+            rows, nodes = trie.ends[depth]
+            rows, nodes = torch.from_numpy(rows), torch.from_numpy(nodes)
+            logits[rows] = self.out(self.drop(self.bn_mean(mean_sum[nodes] + self.mean.bias)))
+        return logits
+
 # %% -------------------------------------- Data Prep ------------------------------------------------------------------
-data_train = pd.read_csv(os.getcwd() + os.sep + "SST-2/train.tsv", sep="\t")
-x_train_raw, y_train = data_train["sentence"].values, torch.LongTensor(data_train["label"].values).to(device)
-data_dev = pd.read_csv("SST-2/dev.tsv", sep="\t")
-x_dev_raw, y_dev = data_dev["sentence"].values, torch.LongTensor(data_dev["label"].values).to(device)
-
-try:
-    with open("example_prep_data/vocab_dict.json", "r") as s:
-        token_ids = json.load(s)
-    msl = np.load("example_prep_data/max_sequence_length.npy").item()
-except:
-    print("Tokenizing all the examples to get a vocab dict and the maximum sequence length...")
-    token_ids, msl = extract_vocab_dict_and_msl(x_train_raw, x_dev_raw)
-    os.mkdir("example_prep_data")
-    with open("example_prep_data/vocab_dict.json", "w") as s:
-        json.dump(token_ids, s)
-    np.save("example_prep_data/max_sequence_length.npy", np.array([msl]))
+if RANK != 0:  # Rank 0 builds all the caches first, and then the other processes just load them
+    dist.barrier()
+# Builds the train and dev sets from the Stanford Sentiment Treebank files that come with the RNN example (only
+# the first time, later runs load them from its cache), so there is nothing to download
+x_train_raw, y_train = load_sst2("train", args.train_level)
+x_dev_raw, y_dev = load_sst2("dev", "sentence")
+y_train, y_dev = torch.from_numpy(y_train).to(device), torch.from_numpy(y_dev).to(device)
+tokens_train = load_tokenized_corpus(x_train_raw, TOKENIZERS[args.tokenizer])
+tokens_dev = load_tokenized_corpus(x_dev_raw, TOKENIZERS[args.tokenizer])
+
+# The prep cache only serves the files built from the same sentences, tokenizer and args, and logs its hits and misses
+prep_cache = PrepCache("example_prep_data")
+hashes_train = row_hashes(x_train_raw)  # Also identify the training sentences on the teacher logits (see below)
+vocab_key = fingerprint(TOKENIZERS[args.tokenizer], hashes_train, row_hashes(x_dev_raw), args.min_freq,
+                        args.max_vocab_size)
+# The vocab is cached as a compact binary file that is memory-mapped on later runs, instead of a JSON dict that would
+# be parsed on every run (see helpers/binary_vocab.py). It behaves like the dict and looks up many tokens at once
+vocab_entry = prep_cache.get_vocab("vocab", vocab_key)
+if vocab_entry is None:
+    print("Getting a vocab dict and the maximum sequence length from the tokenized examples...")
+    token_ids, msl = extract_vocab_dict_and_msl(tokens_train, tokens_dev)
+    prep_cache.put_vocab("vocab", vocab_key, token_ids, {"msl": msl})
+else:
+    token_ids, msl = vocab_entry[0], vocab_entry[1]["msl"]
 if args.seq_len == "get_max_from_data":
     args.seq_len = msl
-del data_train, data_dev
 
-glove_embeddings = get_glove_embeddings(token_ids)
+glove_vectors, glove_index = load_glove("glove.6B.50d.txt")
+substitute_lookup, substitutes = None, None
+if args.glove_substitutes:  # Searches the substitutes of all the out-of-vocab tokens of the data at once
+    substitute_lookup = SubstituteLookup(token_ids, glove_vectors, glove_index,
+                                         min_similarity=args.substitute_min_similarity)
+    substitutes = substitute_lookup.add(list(tokens_train.types) + list(tokens_dev.types))
+    print("{} out-of-vocab tokens are encoded as a similar vocab token".format(len(substitutes)))
 
-try:
-    x_train = np.load("example_prep_data/prep_train_len{}.npy".format(args.seq_len))
-    x_dev = np.load("example_prep_data/prep_dev_len{}.npy".format(args.seq_len))
-except:
-    print("Converting all the sentences to sequences of token ids...")
-    x_train = convert_to_ids(x_train_raw, token_ids, args.seq_len)
-    np.save("example_prep_data/prep_train_len{}.npy".format(args.seq_len), x_train)
-    x_dev = convert_to_ids(x_dev_raw, token_ids, args.seq_len)
-    np.save("example_prep_data/prep_dev_len{}.npy".format(args.seq_len), x_dev)
-del x_train_raw, x_dev_raw
+x_train, n_unknown_train = prep_cache.encode_padded("train", x_train_raw, tokens_train, token_ids, args.seq_len,
+                                                   args.n_oov_buckets, TOKENIZERS[args.tokenizer], substitutes)
+x_dev, n_unknown_dev = prep_cache.encode_padded("dev", x_dev_raw, tokens_dev, token_ids, args.seq_len,
+                                               args.n_oov_buckets, TOKENIZERS[args.tokenizer], substitutes)
+print("Unknown tokens encountered: {} (train), {} (dev)".format(n_unknown_train, n_unknown_dev))
+del tokens_train, tokens_dev, x_train_raw, x_dev_raw
 
-x_train, x_dev = torch.LongTensor(x_train).to(device), torch.LongTensor(x_dev).to(device)
+lengths_train, lengths_dev = sequence_lengths(x_train), sequence_lengths(x_dev)  # Kept on the CPU for packing
+x_train = torch.from_numpy(x_train.astype(np.int32)).to(device)
+x_dev = torch.from_numpy(x_dev.astype(np.int32)).to(device)
+if DISTRIBUTED and RANK == 0:
+    dist.barrier()
 
 # %% -------------------------------------- Training Prep ----------------------------------------------------------
 model = SentimentLSTM(len(token_ids)).to(device)
-look_up_table = get_glove_table(token_ids, glove_embeddings)
+print("The embedding table has {} rows ({:.2f} MB, plus twice that for the Adam moments)".format(
+    n_embeddings(token_ids, args.n_oov_buckets), model.embedding.weight.numel()*4/1e6))
+# Unknown tokens get vectors of ones instead of zeros, due to the packed sequence
+look_up_table = get_glove_table(token_ids, glove_vectors, glove_index, unk_value=1.,
+                                n_oov_buckets=args.n_oov_buckets)
 model.embedding.weight.data.copy_(look_up_table)
-optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+optimizer = build_optimizer(model, args.lr, args.sparse_embedding)
 criterion = nn.CrossEntropyLoss()
+# Running train metrics, plus an optional exact evaluation on a fixed sample of the training data
+train_eval_inds = fixed_subset(len(x_train), args.train_eval_size) if args.train_eval_size else None
+# Training goes through the DDP wrapper, which all-reduces the gradients, while evaluating and saving use the model
+# itself, as only rank 0 does them (a forward through DDP is a collective operation that every process must join).
+# Note that each process normalizes its shard with its own batch norm statistics
+train_model = nn.parallel.DistributedDataParallel(model) if DISTRIBUTED else model
 
 # %% -------------------------------------- Training Loop ----------------------------------------------------------
 labels_ditrib = torch.unique(y_dev, return_counts=True)
@@ -206,43 +230,169 @@ print("The no information rate is {:.2f}".format(100*labels_ditrib[1].max().item
 if TRAIN:
     acc_dev_best = 0
     print("Starting training loop...")
+    # Each process gets every WORLD_SIZE-th sentence of each batch, so the batch size is the same with any number of
+    # processes (and the batches are the same, as they all reseed the sampler with the same seed + epoch)
+    if args.bucket_batches:
+        batches = BucketBatchSampler(lengths_train, args.batch_size, rank=RANK, world_size=WORLD_SIZE)
+    else:
+        batches = [slice(batch_start + RANK, min(batch_start + args.batch_size, len(x_train)), WORLD_SIZE)
+                   for batch_start in range(0, len(x_train) - WORLD_SIZE + 1, args.batch_size)]
     for epoch in range(args.n_epochs):
 
-        loss_train, train_steps = 0, 0
-        model.train()
-        total = len(x_train) // args.batch_size
-        with tqdm(total=total, desc="Epoch {}".format(epoch)) as pbar:
-            for batch in range(len(x_train)//args.batch_size + 1):
-                inds = slice(batch*args.batch_size, (batch+1)*args.batch_size)
+        loss_train, train_steps, step_time = 0, 0, 0
+        train_metrics = RunningMetrics()  # Of the shard of this process
+        train_model.train()
+        start = time.time()
+        if args.bucket_batches:
+            batches.set_epoch(epoch)
+        with tqdm(total=len(batches), desc="Epoch {}".format(epoch), disable=RANK != 0) as pbar:
+            for inds in batches:
                 optimizer.zero_grad()
-                logits = model(x_train[inds])
+                logits = train_model(x_train[inds], lengths_train[inds])
                 loss = criterion(logits, y_train[inds])
                 loss.backward()
+                step_start = time.time()
                 optimizer.step()
+                step_time += time.time() - step_start
                 loss_train += loss.item()
+                train_metrics.update(logits, y_train[inds], loss)
                 train_steps += 1
                 pbar.update(1)
                 pbar.set_postfix_str("Training Loss: {:.5f}".format(loss_train / train_steps))
+        samples_per_sec = len(x_train)/(time.time() - start)
+        if RANK != 0:  # Goes on with the next epoch, and waits on its first all-reduce for rank 0 to catch up
+            continue
 
         model.eval()
-        with torch.no_grad():
-            y_dev_pred = model(x_dev)
-            loss = criterion(y_dev_pred, y_dev)
-            loss_test = loss.item()
-
-        acc_dev = acc(x_dev, y_dev)
-        print("Epoch {} | Train Loss {:.5f}, Train Acc {:.2f} - Test Loss {:.5f}, Test Acc {:.2f}".format(
-            epoch, loss_train/train_steps, acc(x_train, y_train), loss_test, acc_dev))
+        acc_dev, loss_test, _ = evaluate(model, (x_dev, lengths_dev), y_dev, args.batch_size, criterion)
+        print("Epoch {} | Train Loss {:.5f}, Train Acc {:.2f} - Test Loss {:.5f}, Test Acc {:.2f} - {:.0f} samples/sec"
+              .format(epoch, train_metrics.loss, train_metrics.accuracy, loss_test, acc_dev, samples_per_sec))
+        if train_eval_inds is not None:  # Exact, but only on a fixed sample of the training data
+            acc_train_exact, _, _ = evaluate(model, (x_train[train_eval_inds], lengths_train[train_eval_inds]),
+                                             y_train[train_eval_inds], args.batch_size)
+            print("Exact Train Acc on {} sentences {:.2f}".format(len(train_eval_inds), acc_train_exact))
+        if epoch == 0:  # The optimizer state and the gradients take the same memory on every step
+            print("Optimizer state {:.2f} MB, gradients {:.2f} MB - {:.2f} ms per optimizer step".format(
+                *optimizer_memory_mb(model, optimizer), 1000*step_time/train_steps))
 
         if acc_dev > acc_dev_best and SAVE_MODEL:
             torch.save(model.state_dict(), "lstm_sentiment.pt")
             print("The model has been saved!")
             acc_dev_best = acc_dev
 
+if DISTRIBUTED:  # Only rank 0 goes on to the final test (and to export or serve the model)
+    dist.destroy_process_group()
+    if RANK != 0:
+        sys.exit()
+
 # %% ------------------------------------------ Final test -------------------------------------------------------------
 model.load_state_dict(torch.load("lstm_sentiment.pt"))
 model.eval()
-y_test_pred = acc(x_dev, y_dev, return_labels=True)
-print("The accuracy on the test set is {:.2f}".format(100*accuracy_score(y_dev.cpu().numpy(), y_test_pred), "%"))
+acc_test, _, confusion_test = evaluate(model, (x_dev, lengths_dev), y_dev, args.batch_size)
+print("The accuracy on the test set is {:.2f}".format(acc_test, "%"))
 print("The confusion matrix is")
-print(confusion_matrix(y_dev.cpu().numpy(), y_test_pred))
+print(confusion_test)
+
+# %% ------------------------------------- Teacher Logits --------------------------------------------------------------
+# Saves the logits of the LSTM on all the training sentences (with the hash of each sentence, as the student has its
+# own vocab and encoding) for the 1D CNN example to learn from with args.distill = True. This way the LSTM only goes
+# over the training data once, however many times the student is trained. The dev accuracy and the CPU latencies of
+# the LSTM are saved with them, so that the student can report how it compares
+if TEACHER_LOGITS:
+    report = {"model": "LSTM (teacher)", "dev_acc": acc_test,
+              "latency_ms": cpu_latencies(model, (x_dev, lengths_dev), batch_sizes=(1, 64))}
+    save_teacher_logits("lstm_teacher_logits.npz", hashes_train,
+                        predict_logits(model, (x_train, lengths_train), args.batch_size), report)
+    print("The teacher logits of {} sentences have been saved!".format(len(x_train)))
+
+# %% ---------------------------------------- Export -------------------------------------------------------------------
+# Saves the model as TorchScript, with float32 weights and with int8 weights on the LSTM and Linear layers (dynamic
+# quantization), and compares their CPU latency, throughput, file size and dev accuracy with the eager float32 model
+if EXPORT:
+    variants = export_variants(model, (x_dev[:8], lengths_dev[:8]), "lstm_sentiment", "lstm_sentiment.pt")
+    benchmark_variants(variants, (x_dev, lengths_dev), y_dev, batch_sizes=(1, 8, 64, 512))
+    # So that helpers/bulk_scoring.py loads the model and encodes its inputs as it was trained
+    prep_cache.update_extra("vocab", export={
+        "file": variants["torchscript fp32"][1], "inputs": "lengths", "tokenizer": args.tokenizer,
+        "seq_len": args.seq_len, "n_oov_buckets": args.n_oov_buckets,
+        "substitute_min_similarity": args.substitute_min_similarity if args.glove_substitutes else None})
+
+# %% ------------------------------------- Phrase Scoring --------------------------------------------------------------
+# Scores every phrase of the parse trees of the treebank (all the splits, neutral ones included). Going over each of
+# them on its own, the LSTM would run again over the prefixes they share, e.g. all the phrases that start where their
+# parent does, or with the same words. A token trie of all the phrases runs the LSTM once per distinct prefix instead
+if SCORE_PHRASES:
+    def score_by_length(x, lengths):
+        """ Logits of the padded rows x, going over them from the shortest to the longest so each batch is packed """
+        order = torch.argsort(lengths, stable=True)
+        logits = torch.empty(len(x), 2)
+        logits[order] = torch.from_numpy(predict_logits(model, (x[order], lengths[order]), args.batch_size))
+        return logits
+
+    def encode_level(level):
+        texts = np.concatenate([load_sst2(split, level, drop_neutral=False)[0] for split in ("train", "dev", "test")])
+        x, _ = encode_padded(load_tokenized_corpus(texts, TOKENIZERS[args.tokenizer]), token_ids, args.seq_len,
+                             args.n_oov_buckets, substitutes=substitute_lookup and substitute_lookup.add)
+        return torch.from_numpy(x.astype(np.int32)).to(device), sequence_lengths(x).clamp(min=1)
+
+    (x_sentences, lengths_sentences), (x_phrases, lengths_phrases) = encode_level("sentence"), encode_level("phrase")
+    start = time.time()
+    score_by_length(x_sentences, lengths_sentences)
+    sentences_time = time.time() - start
+    start = time.time()
+    logits_phrases = score_by_length(x_phrases, lengths_phrases)
+    phrases_time = time.time() - start
+    start = time.time()
+    trie = PrefixTrie(x_phrases.cpu().numpy(), lengths_phrases.numpy())
+    build_time = time.time() - start
+    start = time.time()  # The trie is timed on its own, as it only needs to be built once for the same phrases
+    with torch.inference_mode():
+        logits_trie = model.forward_prefix_trie(trie).cpu()
+    trie_time = time.time() - start
+    print("{:<28} {:>8} {:>11} {:>9}".format("Scoring", "Rows", "LSTM steps", "Seconds"))
+    print("{:<28} {:>8} {:>11} {:>9.2f}".format("Sentences", len(x_sentences), int(lengths_sentences.sum()),
+                                               sentences_time))
+    print("{:<28} {:>8} {:>11} {:>9.2f}".format("Phrases one by one", len(x_phrases), trie.n_tokens, phrases_time))
+    print("{:<28} {:>8} {:>11} {:>9.2f}".format("Building the prefix trie", len(x_phrases), 0, build_time))
+    print("{:<28} {:>8} {:>11} {:>9.2f}".format("Phrases on a prefix trie", len(x_phrases), trie.n_nodes, trie_time))
+    print("Max logit difference {:.2e}, {} different labels".format(
+        (logits_trie - logits_phrases).abs().max().item(),
+        int((logits_trie.argmax(dim=1) != logits_phrases.argmax(dim=1)).sum())))
+
+# %% ----------------------------------- Embedding Quantization --------------------------------------------------------
+# Converts the trained checkpoint to one whose embedding table is product-quantized (see helpers/pq_embedding.py): each
+# row is cut into args.pq_subvectors pieces, each stored as the uint8 index of one of 256 centroids, and each batch
+# only decodes the rows of its own ids. Compares the memory of the table and the dev accuracy with the float32 model
+if PQ_EMBEDDING:
+    pq_model, pq_report = convert_checkpoint(model, "lstm_sentiment.pt", "lstm_sentiment_pq.pt", args.pq_subvectors)
+    acc_pq, _, _ = evaluate(pq_model, (x_dev, lengths_dev), y_dev, args.batch_size)
+    print_quantization_report(pq_report, acc_test, acc_pq, "lstm_sentiment.pt", "lstm_sentiment_pq.pt")
+
+# %% --------------------------------------------- Serving -------------------------------------------------------------
+def predict_ids(x):
+    """ Classifies a padded array of token ids, returning the label and the class probabilities of each row """
+    # Empty sentences would have length 0, which the packed sequence does not allow, so they just get the padding
+    lengths = sequence_lengths(x).clamp(min=1)
+    x = torch.from_numpy(x.astype(np.int32)).to(device)
+    with torch.inference_mode():
+        logits = model(x, lengths)
+    probs = torch.softmax(logits, dim=1).cpu().numpy()
+    return [{"label": int(p.argmax()), "probs": p.tolist()} for p in probs]
+
+# Repeated sentences (also those that only differ on their spacing or on out-of-vocab words) are answered from an
+# LRU cache keyed by their token ids, without going through the model. GET /stats adds its hit rate and memory
+prediction_cache = PredictionCache(max_entries=CACHE_SIZE)
+def predict_sentences(sentences):
+    """ Classifies a list of raw sentences, returning the label and the class probabilities of each of them """
+    x, _ = encode_sentences(sentences, token_ids, args.seq_len, args.n_oov_buckets, TOKENIZERS[args.tokenizer],
+                            substitutes=substitute_lookup and substitute_lookup.add)  # Also searches the new words
+    if CACHE_SIZE == 0:
+        return predict_ids(x)
+    return prediction_cache.predict(x, predict_ids)
+
+# Scores the sentences sent with e.g. curl -d '{"sentence": "a great movie"}' http://127.0.0.1:8000/predict. The
+# concurrent requests are put together on batches of up to 64 sentences that wait for at most 5 ms for each other,
+# and GET /stats returns the p50/p99 latencies and the histograms of the latencies and the batch sizes
+if SERVE:
+    serve(predict_sentences, port=8000, max_batch_size=64, max_latency_ms=5,
+          extra_stats=lambda: {"prediction_cache": prediction_cache.summary()})
@@ -0,0 +1 @@
+""" Shared helpers for the PyTorch examples. The scripts add the Pytorch directory to sys.path to import them """
@@ -0,0 +1,121 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import numpy as np
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def normalize(vectors):
+    """ float32 copy of vectors with unit norm rows, so that the dot product is the cosine similarity. The all zero
+    rows stay zeros """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors/np.where(norms > 0, norms, 1)
+
+
+def chunk_rows(n_columns, max_elements=2**24):
+    """ Number of query rows whose similarities with n_columns vectors take at most max_elements (64 MB of float32) """
+    return max(1, max_elements//max(n_columns, 1))
+
+
+def nearest_rows(queries, vectors, bias=0.):
+    """ Index of the row of vectors with the highest dot product (plus bias, one per row of vectors) with each row of
+    queries, a chunk of rows at a time so that the similarity matrix never gets too big """
+    chunk_size = chunk_rows(len(vectors))
+    return np.concatenate([(queries[start:start + chunk_size] @ vectors.T + bias).argmax(axis=1)
+                           for start in range(0, len(queries), chunk_size)] or [np.zeros(0, dtype=np.int64)])
+
+
+def exact_search(vectors, queries, k=1):
+    """ Brute-force cosine similarity search: the rows of vectors most similar to each of the queries, from the most to
+    the least similar. Returns the (n_queries, k) indices and similarities """
+    vectors, queries = normalize(vectors), normalize(queries)
+    k, chunk_size = min(k, len(vectors)), chunk_rows(len(vectors))
+    ids, sims = np.zeros((len(queries), k), dtype=np.int64), np.zeros((len(queries), k), dtype=np.float32)
+    for start in range(0, len(queries), chunk_size):
+        chunk_sims = queries[start:start + chunk_size] @ vectors.T
+        top = np.argpartition(-chunk_sims, k - 1, axis=1)[:, :k]
+        top_sims = np.take_along_axis(chunk_sims, top, axis=1)
+        order = np.argsort(-top_sims, axis=1, kind="stable")
+        ids[start:start + chunk_size] = np.take_along_axis(top, order, axis=1)
+        sims[start:start + chunk_size] = np.take_along_axis(top_sims, order, axis=1)
+    return ids, sims
+
+
+def kmeans(vectors, n_clusters, n_iter=10, seed=0, spherical=False):
+    """ k-means: each vector goes to its closest centroid, and each centroid is the mean of its vectors. With spherical
+    it runs on the unit sphere instead (vectors must have unit norm rows): the closest centroid is the one with the
+    highest cosine similarity, and the means are normalized. The clusters that end up empty start again from a random
+    vector. Returns the centroids """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    rng = np.random.RandomState(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)]
+    for _ in range(n_iter):
+        # The closest centroid c minimizes |x - c|^2, i.e. maximizes x.c - |c|^2/2 (on the sphere, just x.c)
+        bias = 0. if spherical else -0.5*(centroids**2).sum(axis=1)
+        assignments = nearest_rows(vectors, centroids, bias)
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=n_clusters)
+        starts = np.cumsum(counts) - counts
+        # Sums the vectors of each cluster at once (reduceat needs valid starts, so the empty ones are fixed after)
+        sums = np.add.reduceat(vectors[order], np.minimum(starts, len(vectors) - 1), axis=0)
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = normalize(sums) if spherical else sums/np.maximum(counts, 1)[:, None]
+    return centroids
+
+
+def recall(approximate_ids, exact_ids):
+    """ Fraction of the exact k nearest neighbours of the queries that the approximate search also found """
+    k = exact_ids.shape[1]
+    found = (approximate_ids[:, :, None] == exact_ids[:, None, :]).any(axis=1)
+    return found.sum()/(len(exact_ids)*k)
+
+
+# %% -------------------------------------- IVF Index ------------------------------------------------------------------
+class IVFIndex:
+    """ Inverted file index for approximate cosine similarity search, only with NumPy. The vectors are clustered with
+    spherical k-means (on a sample of sample_size of them) into n_lists lists (by default ~4*sqrt(n_vectors)), and each
+    query is only compared with the vectors of the n_probe lists whose centroids are the most similar to it. The
+    vectors are kept sorted by list, so each list is a contiguous block. ids gives the id returned for each vector
+    (by default its row) """
+    def __init__(self, vectors, ids=None, n_lists=None, n_iter=10, sample_size=50000, seed=0):
+        vectors = normalize(vectors)
+        ids = np.arange(len(vectors)) if ids is None else np.asarray(ids, dtype=np.int64)
+        rng = np.random.RandomState(seed)
+        sample = vectors[rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)]
+        n_lists = min(n_lists or max(1, int(4*np.sqrt(len(vectors)))), len(sample))
+        self.centroids = kmeans(sample, n_lists, n_iter, seed, spherical=True)
+        assignments = nearest_rows(vectors, self.centroids)
+        order = np.argsort(assignments, kind="stable")
+        self.vectors, self.ids = vectors[order], ids[order]
+        self.offsets = np.append(0, np.cumsum(np.bincount(assignments, minlength=n_lists)))  # List i is offsets[i:i+2]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, queries, k=1, n_probe=8):
+        """ Approximate exact_search: the ids of the k vectors most similar to each query among those on its n_probe
+        closest lists, with their similarities. All the queries that probe a list are compared with it at once, so
+        the Python loop runs once per list. When the probed lists have less than k vectors, the rest of the ids are
+        -1 (and their similarities -inf) """
+        queries = normalize(queries)
+        n_lists = len(self.centroids)
+        n_probe = min(n_probe, n_lists)
+        probes = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        # (query, list) pairs sorted by list, so that the queries of each list are a contiguous block
+        pair_lists = probes.ravel()
+        order = np.argsort(pair_lists, kind="stable")
+        pair_queries = np.repeat(np.arange(len(queries)), n_probe)[order]
+        bounds = np.searchsorted(pair_lists[order], np.arange(n_lists + 1))
+        for lst in np.flatnonzero((np.diff(bounds) > 0) & (np.diff(self.offsets) > 0)):
+            rows = pair_queries[bounds[lst]:bounds[lst + 1]]  # Each query probes a list only once
+            start, stop = self.offsets[lst], self.offsets[lst + 1]
+            # Merges the best k so far with the vectors of this list, and keeps the best k of them
+            all_sims = np.concatenate((sims[rows], queries[rows] @ self.vectors[start:stop].T), axis=1)
+            all_ids = np.concatenate((ids[rows], np.broadcast_to(self.ids[start:stop], (len(rows), stop - start))),
+                                     axis=1)
+            top = np.argpartition(-all_sims, k - 1, axis=1)[:, :k]
+            sims[rows], ids[rows] = np.take_along_axis(all_sims, top, axis=1), np.take_along_axis(all_ids, top, axis=1)
+        order = np.argsort(-sims, axis=1, kind="stable")
+        return np.take_along_axis(ids, order, axis=1), np.take_along_axis(sims, order, axis=1)
@@ -0,0 +1,39 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import shutil
+from contextlib import contextmanager
+
+# Every cache, checkpoint and converted file of the helpers is written through these: the data goes to path + ".tmp"
+# first, and only once it is complete is it moved to path with os.replace, which is atomic. An interrupted run thus
+# never leaves a broken file behind that a later run would take for a finished one: path is either the old version
+# or the complete new one, and a leftover .tmp is simply overwritten by the next run
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+@contextmanager
+def atomic_path(path):
+    """ Yields the temporary path to write a file (or build a directory) on, and moves it to path when the block ends.
+    If the block fails, the temporary file is removed and path is left as it was """
+    tmp_path = path + ".tmp"
+    _remove(tmp_path)
+    try:
+        yield tmp_path
+    except BaseException:
+        _remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def atomic_open(path, mode="wb", **kwargs):
+    """ Like open(path, mode) for writing, but through atomic_path """
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, mode, **kwargs) as s:
+            yield s
@@ -0,0 +1,74 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def sequence_lengths(x):
+    """ Actual length of each zero-padded sequence of token ids (0 is reserved for the padding) """
+    return torch.from_numpy(np.count_nonzero(np.asarray(x), axis=1)).long()
+
+
+# %% ----------------------------------- Batch Sampler -----------------------------------------------------------------
+class BucketBatchSampler(Sampler):
+    """ Yields batches of indices of sentences with similar lengths, so that each batch needs very little padding.
+    The data is shuffled, split into buckets of bucket_size batches, each bucket is sorted by length and cut into
+    batches, and then the order of all the batches is shuffled. For data-parallel training, each of the world_size
+    processes passes its rank and gets its shard of every batch (all of them must use the same seed, and call
+    set_epoch before each epoch, like with DistributedSampler) """
+    def __init__(self, lengths, batch_size, bucket_size=100, shuffle=True, seed=42, rank=0, world_size=1):
+        self.lengths = np.asarray(lengths)
+        self.batch_size, self.bucket_size, self.shuffle = batch_size, bucket_size, shuffle
+        self.rank, self.world_size, self.seed = rank, world_size, seed
+        self.rng = np.random.RandomState(seed)
+
+    def set_epoch(self, epoch):
+        """ Reseeds the shuffle with seed + epoch, so that all the processes get the same batches on each epoch (and
+        thus disjoint shards of them), and a different order from one epoch to the next """
+        self.rng = np.random.RandomState(self.seed + epoch)
+
+    def __len__(self):
+        n_batches = (len(self.lengths) + self.batch_size - 1) // self.batch_size
+        # The last batch is dropped if it is too small to give every process at least one sentence
+        last_size = len(self.lengths) - (n_batches - 1)*self.batch_size
+        return n_batches - (1 if n_batches and last_size < self.world_size else 0)
+
+    def __iter__(self):
+        inds = self.rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(inds), self.batch_size*self.bucket_size):
+            bucket = inds[start:start + self.batch_size*self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches += [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+        if self.shuffle:  # Otherwise the model would see the short sentences first and the long ones last, per bucket
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+        for batch in batches:
+            if len(batch) >= self.world_size:  # So that all the processes take the same number of steps
+                yield torch.from_numpy(batch[self.rank::self.world_size])
+
+
+# %% ----------------------------------- Ragged Batches ----------------------------------------------------------------
+def ragged_from_padded(x):
+    """ Drops the zero-padding of a (n_sequences, seq_len) tensor of token ids. Returns the ids of all the sequences
+    one after the other and the offsets where each of them starts (plus the total number of ids at the end) """
+    lengths = (x != 0).sum(dim=1)
+    # int64 whatever the dtype of x, as the total number of ids can overflow a small integer type
+    offsets = torch.zeros(len(x) + 1, dtype=torch.long, device=x.device)
+    offsets[1:] = torch.cumsum(lengths, dim=0)
+    return x[x != 0], offsets
+
+
+def ragged_batch(ids, offsets, inds):
+    """ Gets the ids of the sequences on the slice inds and their start offsets inside the batch, which is the input
+    nn.EmbeddingBag takes """
+    starts, stops = offsets[:-1][inds], offsets[1:][inds]
+    if len(starts) == 0:  # An empty slice is an empty batch
+        return ids[:0], starts
+    return ids[starts[0]:stops[-1]], starts - starts[0]
+
+
+def trim_padding(x, lengths):
+    """ Collates a batch of zero-padded sequences, whose actual lengths are lengths, by cutting off the padding after
+    the longest one, so the batch is only padded to its own longest sequence instead of to the longest on the data """
+    return x[:, :max(int(lengths.max()), 1)]
@@ -0,0 +1,93 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import sys
+import time
+import numpy as np
+sys.path.append(os.path.join(os.getcwd(), ".."))  # Run from Pytorch/helpers
+from helpers.sst import load_sst2
+from helpers.tokenization import load_tokenized_corpus, TOKENIZERS
+from helpers.vocab import build_vocab
+from helpers.encoding import encode_ragged
+from helpers.glove import load_glove, vocab_glove_index, glove_substitutes
+from helpers.ann import IVFIndex, exact_search, recall
+
+# Benchmarks the NumPy IVF index of ann.py on the GloVe vectors: build time, queries per second and recall against the
+# exact (brute-force) search for several n_probe. It does the same on args.n_synthetic random vectors with the size of
+# the full GloVe vocab, which have no clusters at all, so their recall is the worst case, and on as many vectors drawn
+# around args.n_clusters random centers, whose recall shows the best case. Then it uses the index to
+# substitute the out-of-vocab tokens of the SST-2 dev set with their nearest tokens of a vocab built from the training
+# set (glove_substitutes). It uses the GloVe file of the RNN example, so run any of the SST-2 examples first
+
+# %% ----------------------------------- Hyper Parameters --------------------------------------------------------------
+class Args:
+    def __init__(self):
+        self.glove_path = os.path.join(os.getcwd(), "..", "RNN", "2_TextClassification", "glove.6B.50d.txt")
+        self.n_synthetic = 400000
+        self.n_clusters = 1000  # Of the clustered synthetic vectors
+        self.cluster_noise = 0.3  # Standard deviation of the clustered vectors around their center, relative to it
+        self.n_queries = 10000  # Vectors left out of the index and searched (at most a tenth of them)
+        self.k = 10
+        self.n_lists = None  # None means ~4*sqrt(n_vectors)
+        self.n_probes = (1, 2, 4, 8, 16, 32)
+        self.tokenizer = "fast"
+        self.min_freq = 2  # Of the vocab of the substitution, so that the rare training tokens are out of vocab too
+        self.n_probe = 8  # For the substitution
+        self.min_similarity = 0.5
+
+args = Args()
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def search_report(name, vectors):
+    """ Builds an index over all the vectors but n_queries random ones, and searches these exactly and with it """
+    rng = np.random.RandomState(0)
+    is_query = np.zeros(len(vectors), dtype=bool)
+    is_query[rng.choice(len(vectors), min(args.n_queries, len(vectors)//10), replace=False)] = True
+    queries, indexed = np.asarray(vectors[is_query]), np.asarray(vectors[~is_query])
+    start = time.perf_counter()
+    index = IVFIndex(indexed, n_lists=args.n_lists)
+    print("{}: built an IVF index with {} lists over {} vectors in {:.2f} s".format(
+        name, len(index.centroids), len(index), time.perf_counter() - start))
+    start = time.perf_counter()
+    exact_ids, _ = exact_search(indexed, queries, args.k)
+    exact_time = time.perf_counter() - start
+    print("{:<10} {:>14} {:>10} {:>11}".format("Search", "Queries/sec", "Recall@1", "Recall@" + str(args.k)))
+    print("{:<10} {:>14.0f} {:>10.3f} {:>11.3f}".format("exact", len(queries)/exact_time, 1, 1))
+    for n_probe in args.n_probes:
+        start = time.perf_counter()
+        ivf_ids, _ = index.search(queries, args.k, n_probe)
+        ivf_time = time.perf_counter() - start
+        print("{:<10} {:>14.0f} {:>10.3f} {:>11.3f}".format(
+            "n_probe={}".format(n_probe), len(queries)/ivf_time, recall(ivf_ids[:, :1], exact_ids[:, :1]),
+            recall(ivf_ids, exact_ids)))
+
+# %% ---------------------------------------- Search -------------------------------------------------------------------
+vectors, word_index = load_glove(args.glove_path)
+search_report("GloVe", vectors)
+rng = np.random.RandomState(0)
+search_report("Random", rng.standard_normal((args.n_synthetic, vectors.shape[1])))
+centers = rng.standard_normal((args.n_clusters, vectors.shape[1]))
+search_report("Clustered", centers[rng.randint(args.n_clusters, size=args.n_synthetic)]
+              + args.cluster_noise*rng.standard_normal((args.n_synthetic, vectors.shape[1])))
+
+# %% ------------------------------------- OOV Substitution ------------------------------------------------------------
+tokens_train = load_tokenized_corpus(load_sst2("train", "sentence")[0], TOKENIZERS[args.tokenizer])
+tokens_dev = load_tokenized_corpus(load_sst2("dev", "sentence")[0], TOKENIZERS[args.tokenizer])
+vocab = build_vocab([tokens_train], args.min_freq)
+start = time.perf_counter()
+vocab_index = vocab_glove_index(vocab, vectors, word_index)
+substitutes = glove_substitutes(tokens_dev.types, vocab, vectors, word_index, vocab_index, args.n_probe,
+                                args.min_similarity)
+substitution_time = time.perf_counter() - start
+_, _, n_oov = encode_ragged(tokens_dev, vocab)
+_, _, n_oov_left = encode_ragged(tokens_dev, vocab, substitutes=substitutes)
+print("{} of the {} out-of-vocab tokens of the dev set (vocab of {} tokens) get a substitute ({:.2f} s)".format(
+    n_oov - n_oov_left, n_oov, len(vocab), substitution_time))
+if substitutes:
+    # How many substitutes are the exact nearest neighbour among the vocab tokens with a GloVe vector
+    tokens = list(substitutes)
+    vocab_tokens = [token for token in vocab if token in word_index]
+    exact, _ = exact_search(vectors[[word_index[t] for t in vocab_tokens]], vectors[[word_index[t] for t in tokens]])
+    n_exact = sum(vocab[vocab_tokens[i]] == substitutes[token] for token, i in zip(tokens, exact[:, 0]))
+    id_to_token = {i: token for token, i in vocab.items()}
+    print("{:.1f}% of them are the exact nearest neighbour. Some of them: {}".format(100*n_exact/len(tokens), ", ".join(
+        "{} -> {}".format(token, id_to_token[substitutes[token]]) for token in tokens[:5])))
@@ -0,0 +1,87 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import sys
+import time
+import numpy as np
+import torch
+sys.path.append(os.path.join(os.getcwd(), ".."))  # Run from Pytorch/helpers
+from helpers.sst import load_sst2
+from helpers.tokenization import load_tokenized_corpus, TOKENIZERS
+from helpers.bulk_scoring import EXPORTED_MODELS, load_scorer
+from helpers.cascade import cascade_predict, calibrate_thresholds
+
+# Cascade of the three SST-2 models: the MLP answers the sentences it is sure about, the CNN the ones the MLP was not
+# sure about but it is, and the LSTM all the rest. The margin thresholds are calibrated on the dev set to get the dev
+# accuracy of the LSTM at the lowest cost, and the throughput of the cascade is compared with the LSTM on everything.
+# It uses the TorchScript float32 models and the cached vocabs of the examples, so run each of them first with
+# args.export = True (EXPORT = True on the RNN one)
+
+# %% ----------------------------------- Hyper Parameters --------------------------------------------------------------
+class Args:
+    def __init__(self):
+        self.stages = ("MLP", "CNN", "LSTM")  # From the cheapest to the most expensive model (see EXPORTED_MODELS)
+        self.target_acc = None  # Dev accuracy the cascade has to get. None means that of the last stage (the LSTM)
+        self.batch_size = 512
+        self.n_copies = 10  # The throughput is measured on this many copies of the dev set
+        self.n_repeats = 3  # Each timing is the best of n_repeats runs
+
+args = Args()
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def best_time(fn):
+    best = float("inf")
+    for _ in range(args.n_repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+# %% -------------------------------------- Calibration ----------------------------------------------------------------
+torch.set_num_threads(1)  # The same for every model, so that the costs are comparable
+x_dev_raw, y_dev = load_sst2("dev", "sentence")
+names = list(args.stages)
+stages = [load_scorer(EXPORTED_MODELS[name], args.batch_size) for name in names]
+tokenizers = {stage.tokenizer for stage in stages}  # Of their export metadata. The stages share the tokenized corpus
+if len(tokenizers) > 1:
+    sys.exit("The models were exported with different tokenizers ({}). Export them with the same one".format(
+        ", ".join(sorted(tokenizers))))
+corpus = load_tokenized_corpus(x_dev_raw, TOKENIZERS[tokenizers.pop()])
+timing_corpus = corpus.select(np.tile(np.arange(len(corpus)), args.n_copies))
+stage_logits = [stage(corpus) for stage in stages]
+stage_accs = [100*np.mean(logits.argmax(axis=1) == y_dev) for logits in stage_logits]
+# Seconds per sentence of each model on its own
+stage_costs = [best_time(lambda: stage(timing_corpus))/len(timing_corpus) for stage in stages]
+for name, acc, cost in zip(names, stage_accs, stage_costs):
+    print("{:<6} dev accuracy {:.2f}, {:.0f} sentences/sec".format(name, acc, 1/cost))
+
+target_acc = args.target_acc if args.target_acc is not None else stage_accs[-1]
+calibration = calibrate_thresholds(stage_logits, y_dev, target_acc, stage_costs)
+if calibration is None:
+    sys.exit("No thresholds get a dev accuracy of {:.2f}".format(target_acc))
+thresholds, acc, reached, cost = calibration
+print("Thresholds {} get {:.2f} dev accuracy (target {:.2f}). {} of the sentences reach each stage".format(
+    np.round(thresholds, 4).tolist(), acc, target_acc,
+    ", ".join("{:.1f}% {}".format(100*r, name) for r, name in zip(reached, names))))
+
+# As the thresholds are picked on the dev set, this is optimistic. Picking them on one half and checking them on the
+# other tells how well they hold on new sentences
+halves = np.array_split(np.random.RandomState(0).permutation(len(y_dev)), 2)
+for pick, check in (halves, halves[::-1]):
+    picked = calibrate_thresholds([logits[pick] for logits in stage_logits], y_dev[pick], target_acc, stage_costs)
+    if picked is not None:
+        check = np.sort(check)
+        labels, _ = cascade_predict(corpus.select(check), stages, picked[0])
+        print("Thresholds picked on half of the dev set get {:.2f} on the other half (the {} gets {:.2f})".format(
+            100*np.mean(labels == y_dev[check]), names[-1],
+            100*np.mean(stage_logits[-1][check].argmax(axis=1) == y_dev[check])))
+
+# %% -------------------------------------- Throughput -----------------------------------------------------------------
+labels, answered_by = cascade_predict(corpus, stages, thresholds)
+cascade_time = best_time(lambda: cascade_predict(timing_corpus, stages, thresholds))
+lstm_time = best_time(lambda: stages[-1](timing_corpus))
+print("{:<16} {:>8} {:>15}".format("Predictor", "Dev Acc", "Sentences/sec"))
+print("{:<16} {:>8.2f} {:>15.0f}".format(names[-1] + " only", stage_accs[-1], len(timing_corpus)/lstm_time))
+print("{:<16} {:>8.2f} {:>15.0f}".format("Cascade", 100*np.mean(labels == y_dev), len(timing_corpus)/cascade_time))
+print("The cascade is {:.2f}x as fast as the {} on everything (answered by {})".format(
+    lstm_time/cascade_time, names[-1], ", ".join("{} {}".format(name, np.count_nonzero(answered_by == i))
+                                                 for i, name in enumerate(names))))
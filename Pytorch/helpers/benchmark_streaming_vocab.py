@@ -0,0 +1,64 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import sys
+import time
+import tracemalloc
+from itertools import chain
+sys.path.append(os.path.join(os.getcwd(), ".."))  # Run from Pytorch/helpers
+from helpers.streaming import read_tsv_chunks, stream_vocab
+from helpers.tokenization import tokenize
+from helpers.vocab import build_vocab
+from helpers.fast_tokenizer import fast_word_tokenize
+
+# Compares the exact vocab (all the sentences in memory, tokenized at once) with the one stream_vocab builds by reading
+# the file in chunks, on SST-2 read args.n_passes times (as a stand-in for a corpus that many times larger): peak
+# memory, time, and how many of the most frequent tokens of the exact vocab the sketches keep
+
+# %% ----------------------------------- Hyper Parameters --------------------------------------------------------------
+class Args:
+    def __init__(self):
+        self.path = os.path.join(os.getcwd(), "..", "RNN", "2_TextClassification", "SST-2", "train.tsv")
+        self.n_passes = 10
+        self.chunk_size = 10000
+        self.capacities = (100000, 10000, 5000)  # Number of counters of the sketches
+        self.top_n = 1000  # Checks the overlap of the top_n most frequent tokens
+
+args = Args()
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def text_chunks():
+    """ The chunks of args.path, args.n_passes times """
+    return chain.from_iterable((texts for texts, _ in read_tsv_chunks(args.path, args.chunk_size))
+                               for _ in range(args.n_passes))
+
+
+def measure(fn):
+    """ Runs fn and returns its result, its time and its peak memory (MB) """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    duration = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]/1e6
+    tracemalloc.stop()
+    return result, duration, peak
+
+
+def exact_vocab():
+    corpus = tokenize(list(chain.from_iterable(text_chunks())), fast_word_tokenize)
+    return build_vocab([corpus]), corpus.max_len()
+
+
+def top(vocab, n):
+    return set(sorted(vocab, key=vocab.get)[:n])
+
+# %% -------------------------------------- Comparison -----------------------------------------------------------------
+(exact, msl), duration, peak = measure(exact_vocab)
+print("{:<16} {:>10} {:>8} {:>9} {:>10} {:>12} {:>6}".format(
+    "Vocab", "Tokens", "Max Len", "Time s", "Peak MB", "Top {} kept".format(args.top_n), "Error"))
+print("{:<16} {:>10} {:>8} {:>9.1f} {:>10.1f} {:>12} {:>6}".format(
+    "exact", len(exact), msl, duration, peak, args.top_n, 0))
+for capacity in args.capacities:
+    (vocab, msl, sketch), duration, peak = measure(lambda: stream_vocab(text_chunks(), fast_word_tokenize, capacity))
+    n_kept = len(top(vocab, args.top_n) & top(exact, args.top_n))
+    print("{:<16} {:>10} {:>8} {:>9.1f} {:>10.1f} {:>12} {:>6}".format(
+        "sketch {}".format(capacity), len(vocab), msl, duration, peak, n_kept, sketch.max_error))
@@ -0,0 +1,54 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import sys
+import time
+import numpy as np
+import nltk
+sys.path.append(os.path.join(os.getcwd(), ".."))  # Run from Pytorch/helpers
+from helpers.sst import load_sst2
+from helpers.fast_tokenizer import fast_word_tokenize, _tokenize, _tokenize_word
+nltk.download('punkt')
+
+# Checks that fast_word_tokenize gives exactly the same tokens as nltk.word_tokenize on all the SST-2 sentences,
+# and compares how many sentences per second each of them tokenizes. The data comes from load_sst2, which builds it
+# from the treebank files that come with the RNN example
+
+# %% ----------------------------------- Hyper Parameters --------------------------------------------------------------
+class Args:
+    def __init__(self):
+        self.splits = ("train", "dev", "test")
+        self.level = "phrase"  # "phrase" has every phrase of the parse trees (the whole sentences included)
+        self.n_repeats = 3  # Each timing is the best of n_repeats runs
+
+args = Args()
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def sentences_per_second(tokenizer, sentences, clear_cache=False):
+    """ Best throughput over args.n_repeats runs. With clear_cache the memoized tokens are forgotten before each run """
+    best = float("inf")
+    for _ in range(args.n_repeats):
+        if clear_cache:
+            _tokenize.cache_clear()
+            _tokenize_word.cache_clear()
+        start = time.perf_counter()
+        for sentence in sentences:
+            tokenizer(sentence)
+        best = min(best, time.perf_counter() - start)
+    return len(sentences)/best
+
+# %% -------------------------------------- Equivalence ----------------------------------------------------------------
+sentences = list(np.concatenate([load_sst2(split, args.level, drop_neutral=False)[0] for split in args.splits]))
+print("Comparing the tokens of {} sentences...".format(len(sentences)))
+mismatches = [s for s in sentences if fast_word_tokenize(s) != nltk.word_tokenize(s)]
+for sentence in mismatches[:10]:
+    print(repr(sentence), fast_word_tokenize(sentence), nltk.word_tokenize(sentence), sep="\n", end="\n\n")
+print("{} sentences are tokenized differently".format(len(mismatches)))
+
+# %% -------------------------------------- Throughput -----------------------------------------------------------------
+nltk_sps = sentences_per_second(nltk.word_tokenize, sentences)
+cold_sps = sentences_per_second(fast_word_tokenize, sentences, clear_cache=True)
+warm_sps = sentences_per_second(fast_word_tokenize, sentences)  # Every sentence has been seen already
+print("nltk.word_tokenize: {:.0f} sentences/sec".format(nltk_sps))
+print("fast_word_tokenize: {:.0f} sentences/sec ({:.1f}x), {:.0f} sentences/sec with all of them memoized ({:.1f}x)"
+      .format(cold_sps, cold_sps/nltk_sps, warm_sps, warm_sps/nltk_sps))
+assert not mismatches, "fast_word_tokenize is not equivalent to nltk.word_tokenize on SST-2"
@@ -0,0 +1,93 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+import numpy as np
+sys.path.append(os.path.join(os.getcwd(), ".."))  # Run from Pytorch/helpers
+from helpers.streaming import read_tsv_chunks
+from helpers.tokenization import tokenize
+from helpers.vocab import build_vocab
+from helpers.binary_vocab import BinaryVocab, save_binary_vocab
+from helpers.fast_tokenizer import fast_word_tokenize
+
+# Compares the vocab saved as a JSON dict with the binary format of binary_vocab.py: file size, start-up time and the
+# resident memory the loaded vocab takes (each measured on a fresh process), and the throughput of the look-ups. Uses
+# the SST-2 vocab and a synthetic one args.n_synthetic tokens long, as a stand-in for the vocab of a much larger corpus
+
+# %% ----------------------------------- Hyper Parameters --------------------------------------------------------------
+class Args:
+    def __init__(self):
+        self.path = os.path.join(os.getcwd(), "..", "RNN", "2_TextClassification", "SST-2", "train.tsv")
+        self.n_synthetic = 2000000
+        self.n_lookups = 200000  # Number of tokens looked up, half of them on the vocab
+        self.n_repeats = 5  # Each load time is the best of n_repeats fresh processes
+
+args = Args()
+
+# Loads a vocab on a fresh process and prints the time it took and how much the resident memory grew, in MB
+LOAD_CODE = """
+import sys, time, json
+sys.path.append({root!r})
+import numpy as np
+from helpers.binary_vocab import BinaryVocab
+def rss_mb():
+    with open("/proc/self/status") as s:
+        return int([line for line in s if line.startswith("VmRSS")][0].split()[1])/1e3
+before = rss_mb()
+start = time.perf_counter()
+if {path!r}.endswith(".json"):
+    with open({path!r}, "r") as s:
+        vocab = json.load(s)
+else:
+    vocab = BinaryVocab({path!r})
+duration = time.perf_counter() - start
+vocab.get("the")
+print(json.dumps({{"time": duration, "rss": rss_mb() - before}}))
+"""
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def load_stats(path):
+    """ Best load time (ms) and the resident memory (MB) of the loaded vocab, on fresh processes """
+    runs = [json.loads(subprocess.run([sys.executable, "-c", LOAD_CODE.format(root=os.path.join(os.getcwd(), ".."),
+                                                                              path=path)],
+                                      check=True, capture_output=True, text=True).stdout)
+            for _ in range(args.n_repeats)]
+    return 1000*min(run["time"] for run in runs), min(run["rss"] for run in runs)
+
+
+def lookups_per_second(fn, tokens):
+    start = time.perf_counter()
+    fn(tokens)
+    return len(tokens)/(time.perf_counter() - start)
+
+
+def compare(name, vocab_dict, tmp_dir):
+    json_path, binary_path = os.path.join(tmp_dir, name + ".json"), os.path.join(tmp_dir, name + ".bvocab")
+    with open(json_path, "w") as s:
+        json.dump(vocab_dict, s)
+    save_binary_vocab(vocab_dict, binary_path)
+    binary_vocab = BinaryVocab(binary_path)
+    rng = np.random.RandomState(0)
+    tokens = list(vocab_dict)
+    queries = [tokens[i] for i in rng.randint(len(tokens), size=args.n_lookups//2)]
+    queries += ["{}#oov".format(token) for token in queries]  # Tokens that are not on the vocab
+    dict_lps = lookups_per_second(lambda ts: [vocab_dict.get(t, -1) for t in ts], queries)
+    binary_lps = lookups_per_second(binary_vocab.lookup, queries)
+    for fmt, path, lps in (("json dict", json_path, dict_lps), ("binary", binary_path, binary_lps)):
+        load_ms, rss = load_stats(path)
+        print("{:<12} {:<10} {:>10} {:>9.2f} {:>9.1f} {:>12.1f} {:>14.0f}".format(
+            name, fmt, len(vocab_dict), os.path.getsize(path)/1e6, load_ms, rss, lps))
+
+# %% -------------------------------------- Comparison -----------------------------------------------------------------
+texts = [text for chunk, _ in read_tsv_chunks(args.path) for text in chunk]
+sst2_vocab = build_vocab([tokenize(texts, fast_word_tokenize)])
+synthetic_vocab = {"tok{:x}".format(i): i for i in range(1, args.n_synthetic + 1)}
+print("{:<12} {:<10} {:>10} {:>9} {:>9} {:>12} {:>14}".format(
+    "Vocab", "Format", "Tokens", "Size MB", "Load ms", "Resident MB", "Lookups/sec"))
+with tempfile.TemporaryDirectory() as tmp_dir:
+    compare("sst2", sst2_vocab, tmp_dir)
+    compare("synthetic", synthetic_vocab, tmp_dir)
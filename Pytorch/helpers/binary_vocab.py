@@ -0,0 +1,128 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+from collections.abc import Mapping
+import numpy as np
+from helpers.atomic import atomic_open
+
+MAGIC = b"BVOCAB01"
+FNV_OFFSET, FNV_PRIME = np.uint64(0xcbf29ce484222325), np.uint64(0x100000001b3)
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("n_tokens", "<u8"), ("blob_size", "<u8")])
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def _ragged_bytes(tokens):
+    """ The utf-8 bytes of all the tokens one after the other ("\n" separated), with the start and length of each """
+    buffer = np.frombuffer("\n".join(tokens).encode("utf-8"), dtype=np.uint8)
+    ends = np.append(np.flatnonzero(buffer == ord("\n")), len(buffer)) if len(tokens) else np.zeros(0, dtype=np.int64)
+    starts = np.concatenate(([0], ends[:-1] + 1)) if len(tokens) else ends
+    return buffer, starts, ends - starts
+
+
+def token_hashes(tokens):
+    """ 64-bit FNV-1a hash of the utf-8 bytes of each token. Unlike hash(), it is the same on every run, and it is
+    computed for all the tokens at once: the loop goes over the positions of the characters instead of the tokens """
+    buffer, starts, lengths = _ragged_bytes(tokens)
+    order = np.argsort(-lengths, kind="stable")  # So that the tokens that still have bytes left are always a prefix
+    starts, lengths = starts[order], lengths[order]
+    hashes = np.full(len(tokens), FNV_OFFSET, dtype=np.uint64)
+    for position in range(int(lengths.max()) if len(tokens) else 0):
+        n = np.searchsorted(-lengths, -position, side="left")  # Number of tokens longer than position
+        hashes[:n] = (hashes[:n] ^ buffer[starts[:n] + position]) * FNV_PRIME  # Wraps around, as it should
+    result = np.empty_like(hashes)
+    result[order] = hashes
+    return result
+
+
+def vocab_buffer(vocab_dict):
+    """ The tokens of a vocab (a dict or a BinaryVocab) in id order, as a single "\\n" separated utf-8 buffer (the
+    tokens never contain whitespace). It identifies the vocab, and it is how the vocab is stored """
+    if isinstance(vocab_dict, BinaryVocab):
+        return vocab_dict.blob
+    return np.frombuffer("\n".join(sorted(vocab_dict, key=vocab_dict.get)).encode("utf-8"), dtype=np.uint8)
+
+
+def save_binary_vocab(vocab_dict, path):
+    """ Saves a vocab dict {token: id}, with the ids going from 1 to len(vocab_dict), as a single binary file: a
+    header, the hashes of the tokens in sorted order, the id of each of these, the offset of each token on the blob
+    and the blob (the tokens in id order, separated by "\\n"). All the arrays are 8-byte aligned so they can be viewed
+    straight from the memory-mapped file """
+    blob = vocab_buffer(vocab_dict)
+    n_tokens = len(vocab_dict)
+    if sorted(vocab_dict.values()) != list(range(1, n_tokens + 1)):
+        raise ValueError("The vocab ids must go from 1 to len(vocab_dict)")
+    tokens = blob.tobytes().decode("utf-8").split("\n") if n_tokens else []
+    hashes = token_hashes(tokens)
+    order = np.argsort(hashes, kind="stable")
+    if n_tokens and (np.diff(hashes[order]) == 0).any():
+        raise ValueError("Two tokens of the vocab have the same hash")
+    # Token i (id i+1) is blob[offsets[i]:offsets[i+1]-1]
+    offsets = np.append(_ragged_bytes(tokens)[1], len(blob) + 1).astype(np.uint64)
+    header = np.array([(MAGIC, n_tokens, len(blob))], dtype=HEADER_DTYPE)
+    with atomic_open(path) as s:
+        for array in (header, hashes[order], (order + 1).astype(np.uint64), offsets, blob):
+            s.write(array.tobytes())
+
+
+# %% -------------------------------------- Binary Vocab ---------------------------------------------------------------
+class BinaryVocab(Mapping):
+    """ Read-only vocab {token: id} memory-mapped from a file written by save_binary_vocab. Loading only reads the
+    header, and a look-up only touches a few pages of the file, so neither the start-up time nor the memory grow with
+    the size of the vocab the way they do when parsing it into a dict. It behaves like the dict it was saved from
+    (iterating it gives the tokens in id order), and lookup gets the ids of many tokens with a single binary search """
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        header = self.data[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+        if header["magic"] != MAGIC:
+            raise ValueError("{} is not a binary vocab file".format(path))
+        self.n_tokens, blob_size = int(header["n_tokens"]), int(header["blob_size"])
+        sizes = (8*self.n_tokens, 8*self.n_tokens, 8*(self.n_tokens + 1), blob_size)
+        bounds = np.cumsum((HEADER_DTYPE.itemsize,) + sizes)  # Where each array starts and ends on the file
+        self.hashes = self.data[bounds[0]:bounds[1]].view(np.uint64)  # Sorted
+        self.ids = self.data[bounds[1]:bounds[2]].view(np.uint64)  # Of each hash
+        self.offsets = self.data[bounds[2]:bounds[3]].view(np.uint64)
+        self.blob = self.data[bounds[3]:bounds[4]]
+
+    def token(self, token_id):
+        """ Token of an id (1, ..., len(self)) """
+        start, stop = int(self.offsets[token_id - 1]), int(self.offsets[token_id]) - 1
+        return self.blob[start:stop].tobytes().decode("utf-8")
+
+    def lookup(self, tokens):
+        """ int64 array with the id of each token, or -1 for the tokens that are not on the vocab """
+        if not self.n_tokens:
+            return np.full(len(tokens), -1, dtype=np.int64)
+        hashes = token_hashes(tokens)
+        pos = np.minimum(np.searchsorted(self.hashes, hashes), self.n_tokens - 1)
+        ids = np.where(self.hashes[pos] == hashes, self.ids[pos].astype(np.int64), -1)
+        # The hash matches are checked against the tokens themselves (with all their bytes compared at once), so that
+        # a token that is not on the vocab but has the same hash as one that is never gets its id
+        candidates = np.flatnonzero(ids >= 0)
+        buffer, starts, lengths = _ragged_bytes(tokens)
+        vocab_starts = self.offsets[ids[candidates] - 1].astype(np.int64)
+        vocab_lengths = self.offsets[ids[candidates]].astype(np.int64) - 1 - vocab_starts
+        n_bytes = np.minimum(lengths[candidates], vocab_lengths)
+        within = np.arange(n_bytes.sum()) - np.repeat(np.cumsum(n_bytes) - n_bytes, n_bytes)  # Position in each token
+        differs = (buffer[np.repeat(starts[candidates], n_bytes) + within] !=
+                   self.blob[np.repeat(vocab_starts, n_bytes) + within])
+        n_differ = np.bincount(np.repeat(np.arange(len(candidates)), n_bytes)[differs], minlength=len(candidates))
+        ids[candidates[(n_differ > 0) | (lengths[candidates] != vocab_lengths)]] = -1
+        return ids
+
+    def __getitem__(self, token):
+        token_id = int(self.lookup([token])[0])
+        if token_id < 0:
+            raise KeyError(token)
+        return token_id
+
+    def __contains__(self, token):
+        return self.lookup([token])[0] >= 0
+
+    def __iter__(self):
+        text = self.blob.tobytes().decode("utf-8")
+        return iter(text.split("\n") if text else [])
+
+    def values(self):
+        return range(1, self.n_tokens + 1)  # Same order as the tokens
+
+    def __len__(self):
+        return self.n_tokens
@@ -0,0 +1,37 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import sys
+import time
+sys.path.append(os.path.join(os.getcwd(), ".."))  # Run from Pytorch/helpers
+from helpers.tokenization import TOKENIZERS
+from helpers.bulk_scoring import EXPORTED_MODELS, load_scorer, score_file
+
+# Scores a large file of unlabeled sentences with one of the SST-2 models, e.g. overnight with
+# INPUT=dump.tsv OUTPUT=dump_scores.tsv MODEL=CNN python bulk_score.py
+# The input is a .tsv file with a "sentence" column or a text file with a sentence per line, and the output has the
+# label and the probability of the positive class of each sentence, on the same line (plus a header). It streams the
+# input in chunks, so the memory does not grow with its size, and running it again after an interruption resumes it
+# from the last chunk it finished. It uses the TorchScript float32 model and the cached vocab of the example, so run it
+# first with args.export = True (EXPORT = True on the RNN one)
+
+# %% ----------------------------------- Hyper Parameters --------------------------------------------------------------
+class Args:
+    def __init__(self):
+        self.input_path = os.environ.get("INPUT", os.path.join("..", "RNN", "2_TextClassification", "SST-2",
+                                                               "train.tsv"))
+        self.output_path = os.environ.get("OUTPUT", "scores.tsv")
+        self.model = os.environ.get("MODEL", "CNN")  # "MLP", "CNN" or "LSTM" (see EXPORTED_MODELS)
+        self.text_column = "sentence"  # Of the .tsv files
+        self.chunk_size = 100000  # Sentences read, tokenized and scored at a time
+        self.batch_size = 2048  # No gradients are kept, so the batches can be much larger than when training
+        self.n_workers = None  # Of the tokenization pool. None means one per core
+
+args = Args()
+
+# %% ---------------------------------------- Scoring ------------------------------------------------------------------
+scorer = load_scorer(EXPORTED_MODELS[args.model], args.batch_size)
+start = time.time()  # The sentences are tokenized as the example did (the tokenizer is on its export metadata)
+n_scored = score_file(scorer, TOKENIZERS[scorer.tokenizer], args.input_path, args.output_path, args.chunk_size,
+                      args.text_column, args.n_workers)
+print("Scored {} sentences in {:.1f} s. The results are on {}".format(n_scored, time.time() - start,
+                                                                     args.output_path))
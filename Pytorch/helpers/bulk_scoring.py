@@ -0,0 +1,142 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import json
+import time
+import hashlib
+import warnings
+import multiprocessing
+import numpy as np
+import torch
+from helpers.tokenization import to_corpus, tokenizer_key
+from helpers.streaming import read_text_chunks
+from helpers.encoding import encode_padded
+from helpers.prep_cache import PrepCache, fingerprint
+from helpers.batching import sequence_lengths, trim_padding
+from helpers.distillation import predict_logits
+from helpers.glove import load_glove, SubstituteLookup
+from helpers.atomic import atomic_open
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+# The folders of the SST-2 examples. When they export their model (with args.export = True, or EXPORT = True on the RNN
+# one), they record on the extra fields of their cached vocab the file of the TorchScript float32 model, its inputs,
+# and the tokenizer (its name on TOKENIZERS), seq_len and n_oov_buckets it was trained with. The inputs are "padded"
+# (to seq_len, for the MLPs and the "reshape" 1D CNN), "trimmed" (each batch only padded to its longest sentence, for
+# the "global_pool" 1D CNN) or "lengths" (padded plus the length of each sentence, for the packed LSTM).
+# substitute_min_similarity is None, or the min_similarity of the GloVe substitutes the model was trained with (with
+# args.glove_substitutes, see glove.py)
+EXPORTED_MODELS = {"MLP": os.path.join(ROOT, "MLP", "4_TextClassification"),
+                   "CNN": os.path.join(ROOT, "CNN", "2_TextClassification_1D"),
+                   "LSTM": os.path.join(ROOT, "RNN", "2_TextClassification")}
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def load_scorer(folder, batch_size):
+    """ Loads the TorchScript model and the cached vocab of an example, encoded as the example did when it exported
+    the model, and returns a function that takes a TokenizedCorpus and returns the logits of the model on it, in the
+    same order. The corpus has to be tokenized with TOKENIZERS[scorer.tokenizer], and scorer.key is a hash of the model
+    file, its vocab and its export metadata, which changes whenever the model does """
+    prep_cache = PrepCache(os.path.join(folder, "example_prep_data"))
+    vocab_entry = prep_cache.get_vocab("vocab")
+    if vocab_entry is None or "tokenizer" not in vocab_entry[1].get("export", {}):
+        raise ValueError("No exported model on {}. Run the example with the export on first".format(folder))
+    vocab, extra = vocab_entry
+    export = extra["export"]
+    model_path = os.path.join(folder, export["file"])
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", ".*deprecated")  # Recent versions deprecate TorchScript
+        model = torch.jit.load(model_path)
+    with open(model_path, "rb") as s:
+        model_hash = hashlib.sha1(s.read()).hexdigest()
+    lookup = None
+    if export.get("substitute_min_similarity") is not None:
+        vectors, word_index = load_glove(os.path.join(folder, "glove.6B.50d.txt"))
+        lookup = SubstituteLookup(vocab, vectors, word_index, min_similarity=export["substitute_min_similarity"])
+    def scorer(corpus):
+        x, _ = encode_padded(corpus, vocab, export["seq_len"], export["n_oov_buckets"],
+                             substitutes=lookup and lookup.add)
+        x = torch.from_numpy(x.astype(np.int32))
+        if export["inputs"] == "padded":
+            return predict_logits(model, x, batch_size)
+        # Goes over the sentences from the shortest to the longest, so that each batch has sentences of similar
+        # lengths and needs little padding (or few time steps of the packed LSTM)
+        order = np.argsort(corpus.lengths, kind="stable")
+        if export["inputs"] == "lengths":
+            lengths = sequence_lengths(x).clamp(min=1)  # Empty sentences just get the padding, as when serving
+            sorted_logits = predict_logits(model, (x[order], lengths[order]), batch_size)
+        else:
+            sorted_logits = predict_logits(model, x[order], batch_size,
+                                           collate=lambda batch: (trim_padding(batch[0], sequence_lengths(batch[0])),))
+        logits = np.empty_like(sorted_logits)
+        logits[order] = sorted_logits
+        return logits
+    scorer.tokenizer = export["tokenizer"]
+    scorer.key = fingerprint(model_hash, prep_cache.manifest["vocab"]["key"], export)
+    return scorer
+
+
+# %% -------------------------------------- Bulk Scoring ---------------------------------------------------------------
+def score_file(scorer, tokenizer, input_path, output_path, chunk_size=100000, text_column="sentence", n_workers=None):
+    """ Scores every text of input_path (see streaming.read_text_chunks) with scorer (see load_scorer) and writes the
+    predicted label and the probability of the positive class of each of them to output_path, a line per input line
+    and in the same order, after a header. Only chunk_size texts are in memory at a time (plus the next chunk, which
+    the workers of a process pool tokenize while the model scores this one). After each chunk, the output is flushed to
+    disk and output_path + ".checkpoint" records how far both files got, so an interrupted run started again with the
+    same arguments resumes on the next chunk. The checkpoint also records the path, size and modification time of
+    input_path and the keys of the model and the tokenizer, and resuming with any of them changed raises a ValueError,
+    as the offsets and the scores so far would not belong to this run. Returns the number of texts scored by it """
+    checkpoint_path = output_path + ".checkpoint"
+    stat = os.stat(input_path)
+    run = {"input": [os.path.abspath(input_path), stat.st_size, stat.st_mtime_ns],
+           "model": scorer.key, "tokenizer": tokenizer_key(tokenizer)}
+    checkpoint = dict(run, input_offset=None, output_offset=0, n_rows=0)
+    if os.path.exists(checkpoint_path) and os.path.exists(output_path):
+        with open(checkpoint_path, "r") as s:
+            saved = json.load(s)
+        changed = [field for field in run if saved.get(field) != run[field]]
+        if changed:
+            raise ValueError("{} was left by a run with another {}. Remove it (and {}) to start over".format(
+                checkpoint_path, " and ".join(changed), output_path))
+        checkpoint = saved
+        print("Resuming after {} texts".format(checkpoint["n_rows"]))
+    n_workers = n_workers or os.cpu_count() or 1
+    # The workers are forked for the same reason as in tokenization.tokenize, and without fork they run serially
+    pool = (multiprocessing.get_context("fork").Pool(n_workers)
+            if n_workers > 1 and "fork" in multiprocessing.get_all_start_methods() else None)
+    def tokenize_async(texts):
+        if pool is None:
+            return [tokenizer(text) for text in texts]
+        return pool.map_async(tokenizer, texts, chunksize=max(1, min(512, len(texts)//(4*n_workers))))
+
+    def get(pending):
+        return pending if pool is None else pending.get()
+
+    n_scored, start = 0, time.time()
+    chunks = read_text_chunks(input_path, chunk_size, text_column, checkpoint["input_offset"])
+    try:
+        with open(output_path, "r+b" if checkpoint["output_offset"] else "wb") as out:
+            out.truncate(checkpoint["output_offset"])  # Drops whatever was written after the last checkpoint
+            out.seek(checkpoint["output_offset"])
+            if not checkpoint["output_offset"]:
+                out.write(b"label\tprobability\n")
+            pending = next(chunks, None)
+            pending = pending and (tokenize_async(pending[0]), pending[1])
+            while pending is not None:
+                tokenized, input_offset = get(pending[0]), pending[1]
+                following = next(chunks, None)  # Tokenized by the workers while the model goes over this chunk
+                pending = following and (tokenize_async(following[0]), following[1])
+                probs = torch.softmax(torch.from_numpy(scorer(to_corpus(tokenized))), dim=1).numpy()
+                out.write("".join("{}\t{:.4f}\n".format(label, p) for label, p in zip(probs.argmax(axis=1),
+                                                                                          probs[:, 1])).encode("utf-8"))
+                out.flush()
+                os.fsync(out.fileno())  # The results are on disk before the checkpoint says so
+                n_scored += len(tokenized)
+                checkpoint = dict(run, input_offset=input_offset, output_offset=out.tell(),
+                                  n_rows=checkpoint["n_rows"] + len(tokenized))
+                with atomic_open(checkpoint_path, "w") as s:
+                    json.dump(checkpoint, s)
+                print("{} texts scored ({:.0f} texts/sec)".format(checkpoint["n_rows"],
+                                                                   n_scored/(time.time() - start)))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return n_scored
@@ -0,0 +1,59 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+from itertools import product
+import numpy as np
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def margins(logits):
+    """ Difference between the two highest class probabilities of each row of logits (a NumPy array). A low margin
+    means the model is not sure about its prediction """
+    probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+    probs /= probs.sum(axis=1, keepdims=True)
+    top2 = np.partition(probs, -2, axis=1)[:, -2:]
+    return top2[:, 1] - top2[:, 0]
+
+
+def route(stage_margins, thresholds):
+    """ Stage that answers each example: the first one whose margin is at least its threshold, or the last stage.
+    stage_margins has the margins of every stage but the last one, with shape (n_stages - 1, n_examples) """
+    accepted = np.append(stage_margins >= np.asarray(thresholds)[:, None], np.ones((1, stage_margins.shape[1]), bool),
+                         axis=0)
+    return accepted.argmax(axis=0)
+
+
+def cascade_predict(corpus, stages, thresholds):
+    """ Runs the stages (functions that take a TokenizedCorpus and return its logits, from the cheapest to the most
+    expensive model) one after the other, each only on the sentences of corpus that all the previous stages were not
+    sure about, i.e. whose margin was lower than the threshold of that stage. The last stage takes all that is left.
+    Returns the predicted labels and the stage that answered each sentence """
+    labels, answered_by = np.zeros(len(corpus), dtype=np.int64), np.zeros(len(corpus), dtype=np.int64)
+    todo = np.arange(len(corpus))
+    for i, stage in enumerate(stages):
+        logits = stage(corpus.select(todo))
+        done = margins(logits) >= thresholds[i] if i < len(stages) - 1 else np.ones(len(todo), dtype=bool)
+        labels[todo[done]], answered_by[todo[done]] = logits[done].argmax(axis=1), i
+        todo = todo[~done]
+        if not len(todo):
+            break
+    return labels, answered_by
+
+
+def calibrate_thresholds(stage_logits, y, target_acc, stage_costs, n_candidates=50):
+    """ Picks the margin threshold of each stage but the last one so that the cascade gets at least target_acc (in %)
+    on (stage_logits, y) at the lowest expected cost. stage_logits has the logits of every stage on all the examples,
+    and stage_costs the cost (e.g. seconds per sentence) of each stage. The candidates are quantiles of the margins of
+    each stage plus infinity (that stage never answers), so sending everything to the last stage is always one of them.
+    Returns the thresholds, the accuracy they get, the fraction of examples that reach each stage and their cost,
+    or None if no thresholds get target_acc """
+    stage_margins = np.stack([margins(logits) for logits in stage_logits[:-1]])
+    stage_preds = np.stack([logits.argmax(axis=1) for logits in stage_logits])
+    candidates = [np.append(np.unique(np.quantile(m, np.linspace(0, 1, n_candidates))), np.inf) for m in stage_margins]
+    best = None
+    for thresholds in product(*candidates):
+        answered_by = route(stage_margins, thresholds)
+        acc = 100*np.mean(stage_preds[answered_by, np.arange(len(y))] == y)
+        reached = np.array([np.mean(answered_by >= i) for i in range(len(stage_logits))])  # All go through stage 0
+        cost = float(reached @ np.asarray(stage_costs))
+        if acc >= target_acc and (best is None or cost < best[3]):
+            best = (np.array(thresholds), acc, reached, cost)
+    return best
@@ -0,0 +1,64 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import copy
+import json
+import numpy as np
+import torch
+import torch.nn.functional as F
+from helpers.export import latency_ms
+from helpers.atomic import atomic_open
+from helpers.prep_cache import match_rows
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def predict_logits(model, inputs, batch_size, collate=None):
+    """ Logits of model on inputs (a tensor or a tuple of tensors with the examples on their first dimension), going
+    forward on batches of batch_size. collate is an optional function that prepares each batch (a tuple of tensors) """
+    inputs = inputs if isinstance(inputs, tuple) else (inputs,)
+    collate = collate or (lambda batch: batch)
+    logits = []
+    with torch.inference_mode():
+        for start in range(0, len(inputs[0]), batch_size):
+            logits.append(model(*collate(tuple(t[start:start + batch_size] for t in inputs))).float().cpu())
+    return torch.cat(logits).numpy()
+
+
+def cpu_latencies(model, inputs, batch_sizes=(1, 64), collate=None):
+    """ {batch_size: median latency (ms) of a forward on the CPU on the first batch_size examples of inputs}. collate
+    is an optional function that prepares each batch (a tuple of tensors) the way the model gets it when serving """
+    model = copy.deepcopy(model).cpu().eval()
+    inputs = tuple(t.cpu() for t in (inputs if isinstance(inputs, tuple) else (inputs,)))
+    collate = collate or (lambda batch: batch)
+    return {str(batch_size): latency_ms(model, collate(tuple(t[:batch_size] for t in inputs)))
+            for batch_size in batch_sizes}  # str keys, as they go through JSON
+
+
+def distillation_loss(student_logits, teacher_logits, y, temperature=2., alpha=0.5):
+    """ Knowledge distillation loss (Hinton et al., 2015): alpha times the KL divergence between the softened
+    probabilities of the teacher and of the student, both at temperature, plus 1 - alpha times the cross entropy with
+    the labels. The KL term is multiplied by temperature**2 so its gradients keep the same scale for any temperature """
+    soft = F.kl_div(F.log_softmax(student_logits/temperature, dim=1), F.log_softmax(teacher_logits/temperature, dim=1),
+                    reduction="batchmean", log_target=True)
+    return alpha*temperature**2*soft + (1 - alpha)*F.cross_entropy(student_logits, y)
+
+
+# %% ------------------------------------- Teacher Logits --------------------------------------------------------------
+def save_teacher_logits(path, hashes, logits, report):
+    """ Saves the logits of a teacher on a set of sentences together with the hash of each sentence (see
+    prep_cache.row_hashes), so that a student with another vocab and encoding can find the logits of its own rows.
+    report is a dictionary with what the teacher got on the dev set (accuracy, latencies), to compare the student """
+    with atomic_open(path) as s:
+        np.savez(s, row_hashes=hashes, logits=logits.astype(np.float32),
+                 report=np.frombuffer(json.dumps(report).encode("utf-8"), dtype=np.uint8))
+
+
+def load_teacher_logits(path, hashes):
+    """ Loads the teacher logits of the sentences whose row hashes are hashes, in the same order, and the report of the
+    teacher. Raises a ValueError if the teacher did not score some of them """
+    with np.load(path) as data:
+        teacher_hashes, logits = data["row_hashes"], data["logits"]
+        report = json.loads(data["report"].tobytes().decode("utf-8"))
+    rows, found = match_rows(teacher_hashes, hashes)
+    if not found.all():
+        raise ValueError("{} has no logits for {} of the {} sentences. Run the teacher on the same training set "
+                         "(e.g. the same train_level)".format(path, np.count_nonzero(~found), len(hashes)))
+    return logits[rows], report
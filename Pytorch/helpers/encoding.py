@@ -0,0 +1,66 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import numpy as np
+import nltk
+from helpers.vocab import oov_bucket, n_embeddings
+from helpers.tokenization import tokenize
+from helpers.binary_vocab import BinaryVocab
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def id_dtype(n_ids):
+    """ Smallest integer dtype that can hold the ids 0, ..., n_ids - 1 """
+    return np.int16 if n_ids <= np.iinfo(np.int16).max + 1 else np.int32
+
+
+def lookup_tokens(tokens, vocab_dict, n_oov_buckets=1, substitutes=None):
+    """ Maps a list of tokens to their vocab ids. 0 is the padding and the vocab ids go from 1 to len(vocab_dict), so
+    out-of-vocab tokens are hashed to the ids len(vocab_dict)+1, ..., len(vocab_dict)+n_oov_buckets. vocab_dict can
+    be a dict or a BinaryVocab, which looks up all the tokens at once. substitutes is an optional dictionary
+    {token: vocab id} of out-of-vocab tokens that take the id of a similar token instead (see glove_substitutes) """
+    substitutes = substitutes or {}
+    if isinstance(vocab_dict, BinaryVocab):
+        ids = vocab_dict.lookup(tokens)
+        for i in np.flatnonzero(ids < 0):
+            ids[i] = substitutes.get(tokens[i], len(vocab_dict) + 1 + oov_bucket(tokens[i], n_oov_buckets))
+        return ids
+    table = (vocab_dict[token] if token in vocab_dict else
+             substitutes.get(token, len(vocab_dict) + 1 + oov_bucket(token, n_oov_buckets)) for token in tokens)
+    return np.fromiter(table, dtype=np.int64, count=len(tokens))
+
+
+def lookup_types(corpus, vocab_dict, n_oov_buckets=1, substitutes=None):
+    """ Maps each unique token of a TokenizedCorpus to its vocab id """
+    # This is the only Python loop, and it runs once per unique token instead of once per token in the corpus
+    if callable(substitutes):  # e.g. glove.SubstituteLookup.add, which gets the substitutes of the new types
+        substitutes = substitutes(corpus.types)
+    return lookup_tokens(corpus.types, vocab_dict, n_oov_buckets, substitutes)
+
+
+def encode_ragged(corpus, vocab_dict, n_oov_buckets=1, dtype=None, substitutes=None):
+    """ Converts a TokenizedCorpus to the token ids of all the sentences one after the other plus their offsets.
+    Returns the ids, the offsets and the number of out-of-vocab tokens (not counting the substituted ones) """
+    # A single gather gets the ids of all the tokens
+    ids = lookup_types(corpus, vocab_dict, n_oov_buckets, substitutes)[corpus.ids]
+    n_oov = int(np.count_nonzero(ids > len(vocab_dict)))
+    return ids.astype(dtype or id_dtype(n_embeddings(vocab_dict, n_oov_buckets))), corpus.offsets, n_oov
+
+
+def encode_padded(corpus, vocab_dict, pad_to, n_oov_buckets=1, dtype=None, substitutes=None):
+    """ Converts a TokenizedCorpus to a (n_sentences, pad_to) array of token ids, zero-padded or truncated to pad_to.
+    Returns the array and the number of out-of-vocab tokens """
+    ids, offsets, n_oov = encode_ragged(corpus, vocab_dict, n_oov_buckets, dtype, substitutes)
+    lengths = np.diff(offsets)
+    rows = np.repeat(np.arange(len(lengths)), lengths)  # Sentence of each token
+    cols = np.arange(len(ids)) - np.repeat(offsets[:-1], lengths)  # Position of each token inside its sentence
+    keep = cols < pad_to  # Truncates the sentences longer than pad_to
+    x = np.zeros((len(lengths), pad_to), dtype=ids.dtype)
+    x[rows[keep], cols[keep]] = ids[keep]
+    return x, n_oov
+
+
+def encode_sentences(sentences, vocab_dict, pad_to, n_oov_buckets=1, tokenizer=nltk.word_tokenize, dtype=None,
+                     substitutes=None):
+    """ Tokenizes a few raw sentences (serially and without the cache, e.g. when serving a model) and converts them
+    to a (n_sentences, pad_to) array of token ids. Returns the array and the number of out-of-vocab tokens """
+    return encode_padded(tokenize(sentences, tokenizer, n_workers=1), vocab_dict, pad_to, n_oov_buckets, dtype,
+                         substitutes)
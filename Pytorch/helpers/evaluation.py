@@ -0,0 +1,59 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import numpy as np
+import torch
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def evaluate(model, inputs, y, batch_size, criterion=None):
+    """ Goes forward on the data in batches and returns the accuracy (%), the mean loss (None if criterion is None) and
+    the confusion matrix. The metrics are accumulated batch by batch, so the logits of the whole data are never kept
+    in memory. inputs is a tensor or a tuple of tensors (sliced on the first dim) that are the arguments of model """
+    if len(y) == 0:  # The number of classes comes from the logits, so there is nothing to build the metrics from
+        raise ValueError("Cannot evaluate on an empty dataset")
+    inputs = inputs if isinstance(inputs, (tuple, list)) else (inputs,)
+    loss_sum, confusion = 0, 0
+    with torch.inference_mode():  # Like torch.no_grad() but a bit faster, as the outputs can't be used by autograd
+        for start in range(0, len(y), batch_size):
+            inds = slice(start, start + batch_size)
+            logits = model(*[t[inds] for t in inputs])
+            n_classes = logits.shape[1]
+            if criterion is not None:  # criterion averages over the batch, so we weight it by the batch size
+                loss_sum = loss_sum + criterion(logits, y[inds])*len(logits)
+            # Each (true label, predicted label) pair is mapped to a single index and counted, which gives the
+            # confusion matrix of the batch (flattened) on the same device as the model
+            confusion = confusion + torch.bincount(y[inds]*n_classes + logits.argmax(dim=1), minlength=n_classes**2)
+    confusion = confusion.reshape(n_classes, n_classes).cpu().numpy()
+    loss = loss_sum.item()/len(y) if criterion is not None else None
+    return 100*np.trace(confusion)/confusion.sum(), loss, confusion
+
+
+# %% ------------------------------------- Running Metrics -------------------------------------------------------------
+class RunningMetrics:
+    """ Accumulates the loss and the accuracy of the training batches from the logits the training loop already
+    computes, instead of going forward again on all the training data after each epoch. Note that these are the
+    metrics of the model while it is learning (with dropout on, and with the weights changing from batch to batch),
+    which is why they are usually a bit worse than an exact evaluation at the end of the epoch """
+    def __init__(self):
+        self.loss_sum, self.n_correct, self.n = 0, 0, 0
+
+    def update(self, logits, y, loss):
+        if len(y) == 0:  # The mean loss of an empty batch is nan
+            return
+        # The sums stay on the device of the model, so there is no synchronization with it after each batch
+        self.loss_sum = self.loss_sum + loss.detach()*len(y)
+        self.n_correct = self.n_correct + (logits.detach().argmax(dim=1) == y).sum()
+        self.n += len(y)
+
+    @property
+    def loss(self):
+        return float(self.loss_sum)/self.n
+
+    @property
+    def accuracy(self):
+        return 100*float(self.n_correct)/self.n
+
+
+def fixed_subset(n, size, seed=0):
+    """ Sorted indices of a random subset of size examples out of n, always the same for the same seed. It is used to
+    evaluate exactly on a sample of the training data, which is much cheaper than on all of it """
+    return torch.from_numpy(np.sort(np.random.RandomState(seed).choice(n, min(size, n), replace=False)))
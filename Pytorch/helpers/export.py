@@ -0,0 +1,70 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import copy
+import time
+import warnings
+import numpy as np
+import torch
+import torch.nn as nn
+from helpers.evaluation import evaluate
+
+# Layers whose weights torch.ao.quantization.quantize_dynamic converts to int8. Their activations are quantized on the
+# fly on each forward, so no calibration data is needed. The embeddings and the convolutions stay in float32
+QUANTIZED_LAYERS = {nn.Linear, nn.LSTM}
+
+
+# %% ----------------------------------------- Export ------------------------------------------------------------------
+def export_torchscript(model, example_inputs, path, quantize=False):
+    """ Traces a copy of model on the CPU with example_inputs (a tuple of tensors) and saves it as TorchScript on path,
+    after quantizing it if quantize. Returns the module loaded back from path, which is what a server would run """
+    model = copy.deepcopy(model).cpu().eval()
+    example_inputs = tuple(t.cpu() for t in example_inputs)
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter("ignore", torch.jit.TracerWarning)  # The Python ints the forwards take from tensors
+        warnings.filterwarnings("ignore", ".*deprecated")  # Recent versions deprecate TorchScript and quantized tensors
+        if quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, QUANTIZED_LAYERS, dtype=torch.qint8)
+        traced = torch.jit.trace(model, example_inputs, check_trace=False)
+        traced = torch.jit.freeze(traced)  # Inlines the weights as constants, so the graph can be optimized around them
+        torch.jit.save(traced, path)
+        return torch.jit.load(path)
+
+
+def export_variants(model, example_inputs, name, state_dict_path):
+    """ Exports model as TorchScript with float32 weights (name + "_fp32.ts") and with int8 weights (name + "_int8.ts").
+    Returns a dictionary {variant: (module, file)}, which includes the eager float32 model and its state_dict file """
+    return {"eager fp32": (copy.deepcopy(model).cpu().eval(), state_dict_path),
+            "torchscript fp32": (export_torchscript(model, example_inputs, name + "_fp32.ts"), name + "_fp32.ts"),
+            "torchscript int8": (export_torchscript(model, example_inputs, name + "_int8.ts", quantize=True),
+                                 name + "_int8.ts")}
+
+
+# %% --------------------------------------- Benchmark -----------------------------------------------------------------
+def latency_ms(model, inputs, n_repeats=20):
+    """ Median time (in ms) of a forward on inputs, after a few warm-up forwards (the first TorchScript runs profile and
+    optimize the graph) """
+    with torch.inference_mode():
+        for _ in range(3):
+            model(*inputs)
+        times = []
+        for _ in range(n_repeats):
+            start = time.perf_counter()
+            model(*inputs)
+            times.append(time.perf_counter() - start)
+    return 1000*float(np.median(times))
+
+
+def benchmark_variants(variants, inputs, y, batch_sizes=(1, 8, 64, 512), n_repeats=20):
+    """ Compares the variants returned by export_variants on the CPU: file size, accuracy on (inputs, y) and, for each
+    batch size, the latency of a forward on the first batch_size examples and the throughput it gives """
+    inputs = tuple(t.cpu() for t in inputs)
+    y = y.cpu()
+    print("{:<18} {:>8} {:>8} {:>11} {:>12} {:>14}".format(
+        "Variant", "Size MB", "Dev Acc", "Batch Size", "Latency ms", "Sentences/sec"))
+    for variant, (model, file) in variants.items():
+        acc, _, _ = evaluate(model, inputs, y, max(batch_sizes))
+        for batch_size in batch_sizes:
+            batch = tuple(t[:batch_size] for t in inputs)
+            latency = latency_ms(model, batch, n_repeats)
+            print("{:<18} {:>8.2f} {:>8.2f} {:>11} {:>12.3f} {:>14.0f}".format(
+                variant, os.path.getsize(file)/1e6, acc, len(batch[0]), latency, 1000*len(batch[0])/latency))
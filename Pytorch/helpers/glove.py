@@ -0,0 +1,104 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import numpy as np
+import torch
+from helpers.vocab import n_embeddings
+from helpers.ann import IVFIndex
+from helpers.atomic import atomic_open
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def glove_paths(txt_path):
+    """ Paths of the binary store for a GloVe .txt file: a float32 .npy matrix and the words, one per line """
+    prefix = os.path.splitext(txt_path)[0]
+    return prefix + ".npy", prefix + ".words.txt"
+
+
+def convert_glove(txt_path, chunk_size=10000):
+    """ Parses a GloVe .txt file once and saves it as a float32 .npy matrix plus a word index """
+    npy_path, words_path = glove_paths(txt_path)
+    # A first pass gets the shape, so that the vectors are parsed straight into a preallocated float32 matrix
+    with open(txt_path, "r", encoding="utf-8") as s:
+        dim = len(s.readline().split(" ")) - 1
+        n_words = 1 + sum(1 for _ in s)
+    matrix = np.empty((n_words, dim), dtype=np.float32)
+    words, chunk = [], []
+    with open(txt_path, "r", encoding="utf-8") as s:  # Goes line by line instead of reading the whole file at once
+        for line in s:
+            word, vector = line.rstrip("\n").split(" ", 1)
+            words.append(word)
+            chunk.append(vector)
+            if len(chunk) == chunk_size or len(words) == n_words:
+                # Parses the numbers of a chunk of words in one go instead of creating a small array per word,
+                # so only chunk_size*dim Python strings exist at a time
+                matrix[len(words) - len(chunk):len(words)] = np.array(" ".join(chunk).split(),
+                                                                      dtype=np.float32).reshape(len(chunk), dim)
+                chunk = []
+    with atomic_open(words_path, "w", encoding="utf-8") as s:
+        s.write("\n".join(words))
+    with atomic_open(npy_path) as s:  # Last, as load_glove takes the .npy file as the sign of a finished conversion
+        np.save(s, matrix)
+
+
+def load_glove(txt_path="glove.6B.50d.txt"):
+    """ Memory-maps the GloVe vectors (converting the .txt file the first time) and returns them with a word index """
+    npy_path, words_path = glove_paths(txt_path)
+    if not os.path.exists(npy_path):
+        print("Converting {} to a binary matrix...".format(txt_path))
+        convert_glove(txt_path)
+    vectors = np.load(npy_path, mmap_mode="r")  # Only the rows we actually use will be read from disk
+    with open(words_path, "r", encoding="utf-8") as s:
+        word_index = {word: i for i, word in enumerate(s.read().split("\n"))}
+    return vectors, word_index
+
+
+def get_glove_table(vocab_dict, vectors, word_index, unk_value=0., n_oov_buckets=1):
+    """ Builds the (len(vocab_dict)+1+n_oov_buckets, embedding_dim) look-up table for nn.Embedding. Row 0 (padding) is
+    all zeros and the rows of the tokens without a GloVe vector and of the out-of-vocab buckets are set to unk_value """
+    lookup_table = np.full((n_embeddings(vocab_dict, n_oov_buckets), vectors.shape[1]), unk_value, dtype=np.float32)
+    token_ids = np.fromiter(vocab_dict.values(), dtype=np.int64, count=len(vocab_dict))
+    glove_rows = np.fromiter((word_index.get(token, -1) for token in vocab_dict), dtype=np.int64, count=len(vocab_dict))
+    found = glove_rows >= 0
+    lookup_table[token_ids[found]] = vectors[glove_rows[found]]  # A single gather for all the tokens
+    lookup_table[0] = 0
+    return torch.from_numpy(lookup_table)
+
+
+# %% ------------------------------------- OOV Substitution ------------------------------------------------------------
+def vocab_glove_index(vocab_dict, vectors, word_index, **index_kwargs):
+    """ IVFIndex (see ann.py) over the GloVe vectors of the vocab tokens that have one, returning their vocab ids """
+    token_ids = np.fromiter(vocab_dict.values(), dtype=np.int64, count=len(vocab_dict))
+    glove_rows = np.fromiter((word_index.get(token, -1) for token in vocab_dict), dtype=np.int64, count=len(vocab_dict))
+    found = glove_rows >= 0
+    return IVFIndex(vectors[glove_rows[found]], ids=token_ids[found], **index_kwargs)
+
+
+def glove_substitutes(tokens, vocab_dict, vectors, word_index, index, n_probe=8, min_similarity=0.5):
+    """ Gets a dictionary {token: vocab id} that maps the tokens that are not on the vocab but have a GloVe vector to
+    the token of the vocab with the most similar vector (on an index from vocab_glove_index), so that they share its
+    embedding instead of an out-of-vocab bucket. All of them are searched at once, and those whose nearest neighbour is
+    less similar than min_similarity are left out. The encoding functions take it as substitutes """
+    tokens = [token for token in dict.fromkeys(tokens) if token not in vocab_dict and token in word_index]
+    if not tokens:
+        return {}
+    ids, sims = index.search(vectors[[word_index[token] for token in tokens]], k=1, n_probe=n_probe)
+    return {token: int(i) for token, i, sim in zip(tokens, ids[:, 0], sims[:, 0]) if i > 0 and sim >= min_similarity}
+
+
+class SubstituteLookup:
+    """ glove_substitutes that grows with the tokens it is given: the index over the vocab is built once, and add only
+    searches the tokens it has never searched before (e.g. the new words of the sentences sent to a server). The
+    encoding functions take add itself as substitutes, and call it with the tokens of what they encode """
+    def __init__(self, vocab_dict, vectors, word_index, n_probe=8, min_similarity=0.5):
+        self.vocab_dict, self.vectors, self.word_index = vocab_dict, vectors, word_index
+        self.n_probe, self.min_similarity = n_probe, min_similarity
+        self.index = vocab_glove_index(vocab_dict, vectors, word_index)
+        self.searched, self.substitutes = set(), {}
+
+    def add(self, tokens):
+        """ Searches the substitutes of the new tokens and returns the {token: vocab id} of all of them so far """
+        new = [token for token in dict.fromkeys(tokens) if token not in self.searched]
+        self.searched.update(new)
+        self.substitutes.update(glove_substitutes(new, self.vocab_dict, self.vectors, self.word_index, self.index,
+                                                  self.n_probe, self.min_similarity))
+        return self.substitutes
@@ -0,0 +1,66 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import torch
+import torch.nn as nn
+
+
+# %% ------------------------------------- Multi Optimizer -------------------------------------------------------------
+class MultiOptimizer:
+    """ Steps several optimizers, each on its own parameters, as if they were a single one """
+    def __init__(self, *optimizers):
+        self.optimizers = optimizers
+
+    @property
+    def param_groups(self):
+        return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+    @property
+    def state(self):
+        return {p: s for optimizer in self.optimizers for p, s in optimizer.state.items()}
+
+    def zero_grad(self, set_to_none=True):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad(set_to_none=set_to_none)
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        for optimizer, state_dict in zip(self.optimizers, state_dicts):
+            optimizer.load_state_dict(state_dict)
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def build_optimizer(model, lr, sparse_embedding=False):
+    """ Adam on all the parameters of model, or, with sparse_embedding, SparseAdam on the embeddings (which must have
+    been created with sparse=True) and Adam on the rest. With sparse gradients, each step only reads and updates the
+    rows (and their Adam moments) of the token ids on the batch, instead of the whole vocab """
+    if not sparse_embedding:
+        return torch.optim.Adam(model.parameters(), lr=lr)
+    embeddings = [m for m in model.modules() if isinstance(m, (nn.Embedding, nn.EmbeddingBag))]
+    assert all(m.sparse for m in embeddings), "The embeddings need sparse=True to be trained with SparseAdam"
+    sparse_params = {id(p) for m in embeddings for p in m.parameters()}
+    return MultiOptimizer(torch.optim.SparseAdam([p for p in model.parameters() if id(p) in sparse_params], lr=lr),
+                          torch.optim.Adam([p for p in model.parameters() if id(p) not in sparse_params], lr=lr))
+
+
+def tensor_mb(tensors):
+    """ Size in MB of a list of tensors, counting only the stored values of the sparse ones """
+    size = 0
+    for t in tensors:
+        if t.is_sparse:
+            t = t.coalesce()
+            size += t.values().numel()*t.values().element_size() + t.indices().numel()*t.indices().element_size()
+        else:
+            size += t.numel()*t.element_size()
+    return size/1e6
+
+
+def optimizer_memory_mb(model, optimizer):
+    """ Memory (MB) taken by the optimizer state (e.g. the Adam moments) and by the gradients of the last step """
+    state = [v for s in optimizer.state.values() for v in s.values() if torch.is_tensor(v) and v.dim() > 0]
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    return tensor_mb(state), tensor_mb(grads)
@@ -0,0 +1,121 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import copy
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from helpers.ann import kmeans, nearest_rows
+from helpers.atomic import atomic_open
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def product_quantize(weight, n_subvectors, n_centroids=256, n_iter=20, seed=0):
+    """ Product quantization of the rows of a (n_rows, dim) matrix: each row is cut into n_subvectors pieces of
+    dim/n_subvectors dimensions, and each piece is replaced by the closest of the n_centroids (at most 256, so that
+    they fit on a uint8) k-means centroids of its subspace. Returns the (n_subvectors, n_centroids, dim/n_subvectors)
+    float32 codebooks and the (n_rows, n_subvectors) uint8 codes """
+    weight = np.asarray(weight, dtype=np.float32)
+    n_rows, dim = weight.shape
+    if dim % n_subvectors:
+        raise ValueError("The dimension ({}) must be a multiple of n_subvectors ({})".format(dim, n_subvectors))
+    n_centroids = min(n_centroids, 256, n_rows)
+    pieces = weight.reshape(n_rows, n_subvectors, dim//n_subvectors)
+    codebooks, codes = [], []
+    for i in range(n_subvectors):  # Each subspace is clustered on its own
+        centroids = kmeans(pieces[:, i], n_centroids, n_iter, seed + i)
+        codebooks.append(centroids)
+        codes.append(nearest_rows(pieces[:, i], centroids, -0.5*(centroids**2).sum(axis=1)))  # The closest one
+    return np.stack(codebooks).astype(np.float32), np.stack(codes, axis=1).astype(np.uint8)
+
+
+def embedding_memory_mb(module):
+    """ MB that the parameters and buffers of a module take """
+    return sum(t.numel()*t.element_size() for t in (*module.parameters(), *module.buffers()))/1e6
+
+
+# %% --------------------------------------- PQ Embedding --------------------------------------------------------------
+class PQEmbedding(nn.Module):
+    """ Drop-in replacement of a trained nn.Embedding (mode=None) or nn.EmbeddingBag (mode "sum", "mean" or "max")
+    that keeps its table product-quantized (see product_quantize): a uint8 code per row and subvector plus small
+    float32 codebooks. Only the rows of the ids of each batch are decoded, on the fly. The padding_idx row decodes to
+    zeros, and is left out of the bag reductions, like on the original layers. It is only for inference """
+    def __init__(self, codebooks, codes, padding_idx=None, mode=None):
+        super(PQEmbedding, self).__init__()
+        self.register_buffer("codebooks", torch.as_tensor(codebooks, dtype=torch.float32))
+        self.register_buffer("codes", torch.as_tensor(codes, dtype=torch.uint8))
+        self.padding_idx, self.mode = padding_idx, mode
+        self.embedding_dim = self.codebooks.shape[0]*self.codebooks.shape[2]
+
+    @classmethod
+    def from_embedding(cls, embedding, n_subvectors, n_centroids=256, n_iter=20):
+        """ Quantizes the table of a trained nn.Embedding or nn.EmbeddingBag """
+        weight = embedding.weight.detach()
+        codebooks, codes = product_quantize(weight.cpu().numpy(), n_subvectors, n_centroids, n_iter)
+        return cls(codebooks, codes, embedding.padding_idx, getattr(embedding, "mode", None)).to(weight.device)
+
+    def decode(self, ids):
+        """ Rows of the table for a 1D tensor of ids: the centroids of their codes, one subvector after the other """
+        subvectors = torch.arange(self.codebooks.shape[0], device=ids.device)
+        rows = self.codebooks[subvectors, self.codes[ids].long()].reshape(len(ids), self.embedding_dim)
+        return rows if self.padding_idx is None else rows*(ids != self.padding_idx).unsqueeze(1)
+
+    def forward(self, x, offsets=None):
+        if self.mode is None:
+            return self.decode(x.reshape(-1)).reshape(*x.shape, self.embedding_dim)
+        # A bag only decodes each different id of the batch once, and then reduces the rows of this small table
+        ids, inverse = torch.unique(x, return_inverse=True)
+        padding_idx = None
+        if self.padding_idx is not None and bool((ids == self.padding_idx).any()):
+            padding_idx = int(torch.searchsorted(ids, torch.tensor(self.padding_idx, device=ids.device)))
+        return F.embedding_bag(inverse, self.decode(ids), offsets, mode=self.mode, padding_idx=padding_idx)
+
+
+# %% ------------------------------------ Checkpoint Conversion --------------------------------------------------------
+def quantize_embeddings(model, n_subvectors, n_centroids=256, n_iter=20):
+    """ Replaces, in place, every nn.Embedding and nn.EmbeddingBag of model with a PQEmbedding of its table. Returns
+    {name: (dense MB, quantized MB)} of each of them """
+    report = {}
+    for name, module in list(model.named_modules()):
+        if isinstance(module, (nn.Embedding, nn.EmbeddingBag)):
+            quantized = PQEmbedding.from_embedding(module, n_subvectors, n_centroids, n_iter)
+            parent = model.get_submodule(name.rpartition(".")[0])
+            setattr(parent, name.rpartition(".")[2], quantized)
+            report[name] = (embedding_memory_mb(module), embedding_memory_mb(quantized))
+    return report
+
+
+def convert_checkpoint(model, state_dict_path, output_path, n_subvectors, n_centroids=256, n_iter=20):
+    """ Loads a trained checkpoint (a state_dict file) on a copy of model, quantizes its embeddings and saves the
+    state_dict of the quantized model on output_path, which load_quantized_checkpoint loads back. Returns the
+    quantized model (on eval mode) and the report of quantize_embeddings """
+    model = copy.deepcopy(model)
+    model.load_state_dict(torch.load(state_dict_path, map_location="cpu"))
+    report = quantize_embeddings(model.eval(), n_subvectors, n_centroids, n_iter)
+    with atomic_open(output_path) as s:
+        torch.save(model.state_dict(), s)
+    return model, report
+
+
+def load_quantized_checkpoint(model, path):
+    """ Loads a checkpoint saved by convert_checkpoint on model (built as usual, with the dense embeddings), replacing
+    its embeddings with PQEmbedding layers of the saved codebooks and codes """
+    state_dict = torch.load(path, map_location="cpu")
+    for name, module in list(model.named_modules()):
+        if isinstance(module, (nn.Embedding, nn.EmbeddingBag)):
+            quantized = PQEmbedding(state_dict[name + ".codebooks"], state_dict[name + ".codes"], module.padding_idx,
+                                    getattr(module, "mode", None)).to(module.weight.device)
+            setattr(model.get_submodule(name.rpartition(".")[0]), name.rpartition(".")[2], quantized)
+    model.load_state_dict(state_dict)
+    return model.eval()
+
+
+def print_quantization_report(report, acc, acc_quantized, state_dict_path, output_path):
+    """ Prints the memory of each embedding table and the size of the checkpoint before and after convert_checkpoint,
+    and the dev accuracy of both models """
+    for name, (dense_mb, quantized_mb) in report.items():
+        print("{} table {:.2f} MB -> {:.2f} MB ({:.1f}x smaller)".format(name, dense_mb, quantized_mb,
+                                                                        dense_mb/quantized_mb))
+    print("Checkpoint {:.2f} MB -> {:.2f} MB. Dev accuracy {:.2f} -> {:.2f} ({:+.2f})".format(
+        os.path.getsize(state_dict_path)/1e6, os.path.getsize(output_path)/1e6, acc, acc_quantized,
+        acc_quantized - acc))
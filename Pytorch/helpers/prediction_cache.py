@@ -0,0 +1,69 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import json
+from collections import OrderedDict
+import numpy as np
+
+
+# %% ------------------------------------- Prediction Cache ------------------------------------------------------------
+class PredictionCache:
+    """ LRU cache of the predictions of a model, keyed by the token ids of each sentence without the padding. These are
+    exactly what the model sees, so sentences that only differ on e.g. their spacing, or on out-of-vocab tokens that
+    fall on the same bucket, share the same entry, and a hit always returns what the model would have predicted. Holds
+    at most max_entries predictions, dropping the least recently used one to make room for a new one """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # Goes from the least to the most recently used entry
+        self.hits, self.misses, self.evictions, self.n_bytes = 0, 0, 0, 0
+
+    @staticmethod
+    def keys(x):
+        """ Bytes of the token ids of each row of a padded array, without the padding and as int32 whatever its dtype """
+        x = np.asarray(x, dtype=np.int32)
+        return [row[:n].tobytes() for row, n in zip(x, np.count_nonzero(x, axis=1))]  # The padding is at the end
+
+    @staticmethod
+    def entry_bytes(key, prediction):
+        # Rough memory taken by an entry: its key plus its prediction as JSON, which is what the server sends
+        return len(key) + len(json.dumps(prediction))
+
+    def get(self, key):
+        prediction = self.entries.get(key)
+        if prediction is not None:
+            self.entries.move_to_end(key)
+        return prediction
+
+    def put(self, key, prediction):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = prediction
+        self.n_bytes += self.entry_bytes(key, prediction)
+        while len(self.entries) > self.max_entries:
+            old_key, old_prediction = self.entries.popitem(last=False)
+            self.n_bytes -= self.entry_bytes(old_key, old_prediction)
+            self.evictions += 1
+
+    def predict(self, x, predict_ids):
+        """ Predictions of the rows of x (a padded array of token ids). Only the rows that are not cached go through
+        predict_ids (a function that takes a padded array of token ids and returns a list with the prediction of each
+        row), and only once even if they are repeated on x """
+        keys = self.keys(x)
+        predictions = [self.get(key) for key in keys]
+        missing = {}  # First row of each key that is not cached, in order
+        for i, (key, prediction) in enumerate(zip(keys, predictions)):
+            if prediction is None:
+                missing.setdefault(key, i)
+        self.hits += len(keys) - len(missing)  # The repeats of a missing row on x also skip the model
+        self.misses += len(missing)
+        if missing:
+            new = dict(zip(missing, predict_ids(x[list(missing.values())])))
+            for key, prediction in new.items():
+                self.put(key, prediction)
+            predictions = [new[key] if prediction is None else prediction for key, prediction in zip(keys, predictions)]
+        return predictions
+
+    def summary(self):
+        n_lookups = self.hits + self.misses
+        return {"n_entries": len(self.entries), "max_entries": self.max_entries, "hits": self.hits,
+                "misses": self.misses, "hit_rate": self.hits/n_lookups if n_lookups else None,
+                "evictions": self.evictions, "memory_mb": self.n_bytes/1e6}
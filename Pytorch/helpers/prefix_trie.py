@@ -0,0 +1,50 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import numpy as np
+import torch
+
+
+# %% -------------------------------------- Prefix Trie ----------------------------------------------------------------
+class PrefixTrie:
+    """ Token trie of a batch of zero-padded sequences of token ids: each node is a distinct prefix, so the sequences
+    that start the same way (like the phrases of a parse tree that start where their parent does, or the many phrases
+    that start with "the") share the nodes of their common prefix. The nodes are kept by depth: tokens[depth] has the
+    last token of each node at that depth and parents[depth] the index of its parent on the previous depth. ends[depth]
+    has the (rows, nodes) of the sequences that end at that depth. Empty sequences are taken as a single padding token,
+    as when serving """
+    def __init__(self, x, lengths):
+        x, lengths = np.asarray(x), np.maximum(np.asarray(lengths), 1)
+        self.n_rows, self.n_tokens = len(x), int(lengths.sum())
+        self.tokens, self.parents, self.ends = [], [], []
+        n_ids = int(x.max()) + 1 if x.size else 1
+        node = np.zeros(len(x), dtype=np.int64)  # Node of each sequence on the current depth
+        for depth in range(int(lengths.max()) if len(x) else 0):
+            rows = np.flatnonzero(lengths > depth)
+            # Two sequences share a node if they share its parent and its token. Sorting these keys numbers the nodes
+            nodes, node[rows] = np.unique(node[rows]*n_ids + x[rows, depth], return_inverse=True)
+            self.tokens.append(nodes % n_ids)
+            self.parents.append(nodes // n_ids)
+            ending = lengths[rows] == depth + 1
+            self.ends.append((rows[ending], node[rows][ending]))
+
+    @property
+    def n_nodes(self):
+        """ Number of LSTM steps the trie takes, against n_tokens when going over each sequence on its own """
+        return sum(len(tokens) for tokens in self.tokens)
+
+
+def trie_lstm_levels(embedding, lstm, trie):
+    """ Goes through the nodes of a PrefixTrie with a unidirectional nn.LSTM one depth at a time, starting from zero
+    states. Each node takes one step from the states of its parent, so every shared prefix runs only once. Yields the
+    depth, the parent of each node (a LongTensor) and the outputs of the last layer for the nodes of each depth, which
+    are those of every sequence that goes through them at that time step. Only the states of one depth are kept """
+    device = embedding.weight.device
+    h = c = None
+    for depth, (tokens, parents) in enumerate(zip(trie.tokens, trie.parents)):
+        parents = torch.from_numpy(parents).to(device)
+        inputs = embedding(torch.from_numpy(tokens).to(device)).unsqueeze(0)  # A single time step
+        if h is None:
+            h = c = inputs.new_zeros(lstm.num_layers, len(tokens), lstm.hidden_size)
+        else:
+            h, c = h[:, parents], c[:, parents]
+        outputs, (h, c) = lstm(inputs, (h, c))
+        yield depth, parents, outputs[0]
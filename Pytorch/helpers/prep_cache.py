@@ -0,0 +1,156 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import json
+import hashlib
+import numpy as np
+from helpers.vocab import n_embeddings
+from helpers.encoding import id_dtype, encode_padded, lookup_tokens
+from helpers.binary_vocab import BinaryVocab, save_binary_vocab, vocab_buffer
+from helpers.tokenization import tokenizer_key
+from helpers.atomic import atomic_path, atomic_open
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def fingerprint(*parts):
+    """ Hashes strings, numbers, None, dicts, arrays and functions (with tokenizer_key, like corpus_key does: their
+    name, the source of their module and the versions of their package and nltk) """
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(part.tobytes())
+        elif callable(part):
+            h.update(tokenizer_key(part).encode("utf-8"))
+        else:  # sort_keys, so that the same dict always gives the same hash
+            h.update(json.dumps(part, sort_keys=True).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def row_hashes(sentences):
+    """ 64-bit hash of each sentence, which is how the cached rows are matched to the current ones """
+    return np.fromiter((int.from_bytes(hashlib.blake2b(sentence.encode("utf-8"), digest_size=8).digest(), "little")
+                        for sentence in sentences), dtype=np.uint64, count=len(sentences))
+
+
+def match_rows(source_hashes, hashes):
+    """ Finds each of hashes on source_hashes (both from row_hashes) with a sort and a binary search. Returns the row of
+    source_hashes of each of them and whether it was there at all (the rows of those that were not are meaningless) """
+    if not len(source_hashes):
+        return np.zeros(len(hashes), dtype=np.int64), np.zeros(len(hashes), dtype=bool)
+    order = np.argsort(source_hashes, kind="stable")
+    pos = np.minimum(np.searchsorted(source_hashes[order], hashes), len(order) - 1)
+    return order[pos], source_hashes[order][pos] == hashes
+
+
+def _from_buffer(buffer):
+    text = buffer.tobytes().decode("utf-8")
+    return text.split("\n") if text else []
+
+
+# %% --------------------------------------- Prep Cache ----------------------------------------------------------------
+class PrepCache:
+    """ Cache of the preprocessed data of an example. manifest.json has an entry per name ("vocab", "train", ...) with
+    the key the cached file was built for (the hashes of the source sentences, the tokenizer, the vocab and the
+    settings), so a file is only served if it was built from exactly the same inputs. The encoded sentences are cached
+    together with the hash of each row, so that when some rows are added or changed only those are encoded again """
+    def __init__(self, cache_dir="example_prep_data"):
+        self.cache_dir = cache_dir
+        self.manifest_path = os.path.join(cache_dir, "manifest.json")
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as s:
+                self.manifest = json.load(s)
+
+    def _path(self, file):
+        return os.path.join(self.cache_dir, file)
+
+    def _save(self, name, entry, save_file):
+        """ Saves a file with save_file(path) and points the manifest entry of name to it, removing the old file """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with atomic_path(self._path(entry["file"])) as path:
+            save_file(path)
+        old = self.manifest.get(name)
+        if old and old["file"] != entry["file"] and os.path.exists(self._path(old["file"])):
+            os.remove(self._path(old["file"]))
+        self.manifest[name] = entry
+        self._write_manifest()
+
+    def _write_manifest(self):
+        with atomic_open(self.manifest_path, "w") as s:
+            json.dump(self.manifest, s, indent=2)
+
+    def _valid(self, name, **fields):
+        """ Whether the entry of name exists, has the given fields and its file is there """
+        entry = self.manifest.get(name)
+        return (entry is not None and all(entry.get(field) == value for field, value in fields.items())
+                and os.path.exists(self._path(entry["file"])))
+
+    def get_vocab(self, name, key=None):
+        """ Returns the vocab cached as name (memory-mapped as a BinaryVocab) and the dictionary of extra fields it was
+        saved with, if it was built for key (or whatever it was built for, if key is None), otherwise None """
+        if not self._valid(name, **({"key": key} if key is not None else {})):
+            print("Prep cache miss: {}".format(name))
+            return None
+        print("Prep cache hit: {}".format(name))
+        return BinaryVocab(self._path(self.manifest[name]["file"])), self.manifest[name]["extra"]
+
+    def put_vocab(self, name, key, vocab_dict, extra=None):
+        """ Caches a vocab dict in the binary format of binary_vocab.py, with a dictionary of extra JSON serializable
+        fields (e.g. the maximum sequence length) """
+        self._save(name, {"key": key, "file": "{}_{}.bvocab".format(name, key[:12]), "extra": extra or {}},
+                   lambda path: save_binary_vocab(vocab_dict, path))
+
+    def update_extra(self, name, **fields):
+        """ Adds (or replaces) extra fields of the cached vocab name, without saving the vocab again, e.g. how the
+        model trained on it was exported """
+        self.manifest[name]["extra"].update(fields)
+        self._write_manifest()
+
+    def encode_padded(self, name, sentences, corpus, vocab_dict, pad_to, n_oov_buckets=1, tokenizer=None,
+                      substitutes=None):
+        """ Cached encoding.encode_padded of corpus, which are the tokenized sentences. The rows that were already
+        encoded for the same tokenizer, pad_to, n_oov_buckets and substitutes (a dict, see glove.py) are reused, even
+        with a different vocab: their ids are mapped to the new vocab, except for the rows with out-of-vocab ids, as
+        their tokens are unknown. Only the new and changed rows, and these, are encoded. Returns the array and its
+        number of out-of-vocab ids """
+        hashes = row_hashes(sentences)
+        settings = fingerprint(tokenizer, pad_to, n_oov_buckets, substitutes or {})
+        vocab = vocab_buffer(vocab_dict)  # The tokens in id order, to map the ids later
+        vocab_key, source_key = fingerprint(vocab), fingerprint(hashes)
+        if self._valid(name, settings=settings, vocab=vocab_key, source=source_key):
+            print("Prep cache hit: {}".format(name))
+            return np.load(self._path(self.manifest[name]["file"]))["x"], self.manifest[name]["n_oov"]
+
+        x = np.zeros((len(sentences), pad_to), dtype=id_dtype(n_embeddings(vocab_dict, n_oov_buckets)))
+        todo = np.ones(len(sentences), dtype=bool)
+        if self._valid(name, settings=settings):
+            with np.load(self._path(self.manifest[name]["file"])) as cached:
+                cached_x, cached_hashes = cached["x"], cached["row_hashes"]
+                cached_vocab = _from_buffer(cached["vocab"]) if self.manifest[name]["vocab"] != vocab_key else None
+            rows, found = match_rows(cached_hashes, hashes)  # The cached row of each sentence
+            reused = cached_x[rows[found]]
+            if cached_vocab is not None:  # Maps the old ids to the new ones, and the out-of-vocab ids to -1
+                table = np.full(max(cached_x.max(initial=0), len(cached_vocab)) + 1, -1, dtype=np.int64)
+                table[1:len(cached_vocab) + 1] = lookup_tokens(cached_vocab, vocab_dict, n_oov_buckets)
+                table[0] = 0
+                reused = table[reused]
+                ok = (reused >= 0).all(axis=1)
+                found[found] = ok
+                reused = reused[ok]
+            x[found], todo = reused, ~found
+            print("Prep cache partial hit: {} ({} rows reused{}, {} encoded)".format(
+                name, len(reused), " and mapped to the new vocab" if cached_vocab is not None else "", todo.sum()))
+        else:
+            print("Prep cache miss: {} (encoding {} rows)".format(name, len(sentences)))
+        if todo.any():
+            x[todo], _ = encode_padded(corpus.select(np.flatnonzero(todo)), vocab_dict, pad_to, n_oov_buckets, x.dtype,
+                                       substitutes)
+        n_oov = int(np.count_nonzero(x > len(vocab_dict)))
+
+        entry = {"file": "{}_{}.npz".format(name, fingerprint(settings, vocab_key, source_key)[:12]),
+                 "settings": settings, "vocab": vocab_key, "source": source_key, "n_oov": n_oov}
+        def save_file(path):
+            with open(path, "wb") as s:  # np.savez would add .npz to a path without it
+                np.savez(s, x=x, row_hashes=hashes, vocab=vocab)
+        self._save(name, entry, save_file)
+        return x, n_oov
@@ -0,0 +1,196 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import json
+import time
+import asyncio
+import functools
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Upper edges (in ms) of the buckets of the latency histogram. The last bucket has all the slower requests
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+# %% -------------------------------------- Serving Stats --------------------------------------------------------------
+class ServingStats:
+    """ Latency (from the moment a request is queued until its prediction is ready) and batch size statistics. The
+    percentiles are computed over the last n_recent requests and the histograms count all of them. extra_stats is an
+    optional function that returns a dictionary with more stats to add to the summary (e.g. those of a cache) """
+    def __init__(self, n_recent=10000, extra_stats=None):
+        self.extra_stats = extra_stats
+        self.recent_latencies = deque(maxlen=n_recent)
+        self.latency_counts = np.zeros(len(LATENCY_BUCKETS_MS) + 1, dtype=np.int64)
+        self.batch_sizes = Counter()
+
+    def add_batch(self, latencies_ms):
+        self.recent_latencies.extend(latencies_ms)
+        self.latency_counts += np.bincount(np.searchsorted(LATENCY_BUCKETS_MS, latencies_ms),
+                                           minlength=len(self.latency_counts))
+        self.batch_sizes[len(latencies_ms)] += 1
+
+    def summary(self):
+        n_requests, n_batches = int(self.latency_counts.sum()), sum(self.batch_sizes.values())
+        p50, p99 = np.percentile(self.recent_latencies, (50, 99)) if self.recent_latencies else (None, None)
+        names = ["<={}".format(edge) for edge in LATENCY_BUCKETS_MS] + [">{}".format(LATENCY_BUCKETS_MS[-1])]
+        summary = {"n_requests": n_requests, "n_batches": n_batches,
+                   "mean_batch_size": n_requests/n_batches if n_batches else None,
+                   "latency_p50_ms": p50, "latency_p99_ms": p99,
+                   "latency_histogram_ms": dict(zip(names, self.latency_counts.tolist())),
+                   "batch_size_histogram": {size: self.batch_sizes[size] for size in sorted(self.batch_sizes)}}
+        if self.extra_stats is not None:
+            summary.update(self.extra_stats())
+        return summary
+
+
+# %% -------------------------------------- Micro-Batcher --------------------------------------------------------------
+class MicroBatcher:
+    """ Collects the sentences that are sent concurrently and predicts them together. A batch is run as soon as it has
+    max_batch_size sentences or its first sentence has waited for max_latency_ms. predict_batch takes a list of
+    sentences and returns a list with a JSON serializable prediction for each of them """
+    def __init__(self, predict_batch, max_batch_size=64, max_latency_ms=5., extra_stats=None):
+        self.predict_batch, self.max_batch_size, self.max_latency = predict_batch, max_batch_size, max_latency_ms/1000
+        self.queue = asyncio.Queue()
+        self.stats = ServingStats(extra_stats=extra_stats)
+        # The model runs on its own thread so that the server keeps taking requests (for the next batch) meanwhile
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def predict(self, sentence):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sentence, future, time.perf_counter()))
+        return await future
+
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = batch[0][2] + self.max_latency
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():  # Takes what is already waiting even if the deadline is over, which
+                batch.append(self.queue.get_nowait())  # happens when the previous batch took longer than it
+                continue
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            try:
+                predictions = await loop.run_in_executor(self.executor, self.predict_batch, [s for s, _, _ in batch])
+            except Exception as e:  # Fails the requests of this batch but keeps serving
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            for (_, future, _), prediction in zip(batch, predictions):
+                if not future.done():  # The client may have disconnected
+                    future.set_result(prediction)
+            self.stats.add_batch([1000*(done - start) for _, _, start in batch])
+
+
+# %% ---------------------------------------- HTTP Server --------------------------------------------------------------
+async def read_request(reader):
+    """ Reads the request line, headers and body of the next request. Returns None when the client is done, and raises
+    ValueError when the request is malformed """
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    parts = request_line.decode("latin-1").split()
+    if len(parts) < 2:
+        raise ValueError("Malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        if b":" not in line:
+            raise ValueError("Malformed header")
+        name, value = line.decode("latin-1").split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+    content_length = int(headers.get("content-length", 0))  # A ValueError too if it is not an integer
+    if content_length < 0:
+        raise ValueError("Negative Content-Length")
+    return parts[0], parts[1], headers, await reader.readexactly(content_length)
+
+
+def write_response(writer, status, response):
+    payload = json.dumps(response).encode("utf-8")
+    writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(
+        status, REASONS[status], len(payload)).encode("latin-1"))
+    writer.write(payload)
+
+
+async def handle_http(reader, writer, batcher):
+    """ Minimal HTTP/1.1 (with keep-alive) handler: POST /predict with {"sentence": "..."} returns the prediction of
+    the sentence and GET /stats returns ServingStats.summary(). Malformed requests get a 400 and close the
+    connection, as the rest of the stream can not be trusted after them """
+    try:
+        while True:
+            try:
+                request = await read_request(reader)
+            except ValueError as e:
+                write_response(writer, 400, {"error": "Bad request: {}".format(e)})
+                await writer.drain()
+                break
+            if request is None:
+                break
+            method, path, headers, body = request
+            if method == "POST" and path == "/predict":
+                try:
+                    sentence = json.loads(body)["sentence"]
+                    if not isinstance(sentence, str):  # Otherwise it would break the whole batch
+                        raise TypeError
+                except (ValueError, KeyError, TypeError):
+                    status, response = 400, {"error": 'The body must be a JSON object like {"sentence": "..."}'}
+                else:
+                    try:
+                        status, response = 200, await batcher.predict(sentence)
+                    except Exception as e:  # The model failed on the batch of this sentence
+                        status, response = 500, {"error": repr(e)}
+            elif method == "GET" and path == "/stats":
+                status, response = 200, batcher.stats.summary()
+            else:
+                status, response = 404, {"error": "Use POST /predict or GET /stats"}
+            write_response(writer, status, response)
+            await writer.drain()
+            if headers.get("connection", "").lower() == "close":
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_async(predict_batch, host="127.0.0.1", port=8000, unix_socket=None, max_batch_size=64,
+                      max_latency_ms=5., extra_stats=None):
+    batcher = MicroBatcher(predict_batch, max_batch_size, max_latency_ms, extra_stats)
+    batching = asyncio.create_task(batcher.run())
+    handler = functools.partial(handle_http, batcher=batcher)
+    if unix_socket:
+        server = await asyncio.start_unix_server(handler, unix_socket)
+    else:
+        server = await asyncio.start_server(handler, host, port)
+    print("Serving on {} (POST /predict, GET /stats). Press Ctrl+C to stop".format(
+        unix_socket or "http://{}:{}".format(host, port)))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batching.cancel()
+        print(json.dumps(batcher.stats.summary(), indent=2))
+
+
+def serve(predict_batch, host="127.0.0.1", port=8000, unix_socket=None, max_batch_size=64, max_latency_ms=5.,
+          extra_stats=None):
+    """ Serves the predictions of predict_batch over HTTP (on host:port, or on a Unix socket if unix_socket is a path)
+    until the process is interrupted, and then prints the stats (plus those returned by extra_stats, if given) """
+    try:
+        asyncio.run(serve_async(predict_batch, host, port, unix_socket, max_batch_size, max_latency_ms, extra_stats))
+    except KeyboardInterrupt:
+        pass
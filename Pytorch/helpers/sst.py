@@ -0,0 +1,171 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import hashlib
+import numpy as np
+from helpers.atomic import atomic_path
+
+# The Stanford Sentiment Treebank ships with the RNN example, so the SST-2 examples build their data from it offline
+SST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "RNN", "2_TextClassification", "SST-2")
+SPLITS = {"1": "train", "2": "test", "3": "dev"}  # splitset_label on datasetSplit.txt
+GLUE_FILES = {"train": "train.tsv", "dev": "dev.tsv"}  # The GLUE files with labels (test.tsv has none)
+CACHE_VERSION = 2  # Part of the cache key, so that changing how the tables are built rebuilds them
+LEVELS = ("sentence", "phrase")
+COLUMNS = ("text", "sentence_index", "sentiment", "label")
+
+
+# %% ------------------------------------- Streaming Parsers -----------------------------------------------------------
+def _read_lines(path, skip_header=False):
+    with open(path, "r", encoding="utf-8") as s:  # Goes line by line instead of reading the whole file at once
+        if skip_header:
+            next(s)
+        for line in s:
+            yield line.rstrip("\n")
+
+
+def read_sentences(original_dir):
+    """ Yields the (sentence_index, split, tokens) of each sentence, joining datasetSentences.txt, datasetSplit.txt
+    and SOStr.txt, which have the sentences in the same order. The tokens come from SOStr.txt, as the text of
+    datasetSentences.txt has some broken accents (i.e. "Ã©" instead of "é") """
+    sentences = _read_lines(os.path.join(original_dir, "datasetSentences.txt"), skip_header=True)
+    splits = _read_lines(os.path.join(original_dir, "datasetSplit.txt"), skip_header=True)
+    tokens = _read_lines(os.path.join(original_dir, "SOStr.txt"))
+    for sentence, split, sentence_tokens in zip(sentences, splits, tokens):
+        sentence_index, split_index, split_label = sentence.split("\t", 1)[0], *split.split(",")
+        assert sentence_index == split_index, "datasetSentences.txt and datasetSplit.txt are not aligned"
+        yield int(sentence_index), SPLITS[split_label], sentence_tokens.split("|")
+
+
+def read_phrase_spans(original_dir):
+    """ Yields the (start, stop) token spans of all the nodes of the parse tree of each sentence on STree.txt, from
+    the root (the whole sentence) down to the single tokens """
+    for line in _read_lines(os.path.join(original_dir, "STree.txt")):
+        # The tree is in parent pointer format: the nodes 1, ..., n_tokens are the tokens, the rest are phrases, and
+        # each node is followed by the (1-based) index of its parent, with 0 for the root. As the parents always come
+        # after their children, a single pass over the nodes expands the span of each parent to cover its children
+        parents = [int(parent) for parent in line.split("|")]
+        n_tokens = (len(parents) + 1)//2
+        starts = list(range(n_tokens)) + [n_tokens]*(n_tokens - 1)  # The phrases start empty
+        stops = list(range(1, n_tokens + 1)) + [0]*(n_tokens - 1)
+        for node, parent in enumerate(parents):
+            if parent:
+                starts[parent - 1] = min(starts[parent - 1], starts[node])
+                stops[parent - 1] = max(stops[parent - 1], stops[node])
+        yield list(zip(starts, stops))[::-1]
+
+
+def read_sentiments(original_dir):
+    """ Gets the sentiment value (from 0, very negative, to 1, very positive) of each phrase id """
+    lines = _read_lines(os.path.join(original_dir, "sentiment_labels.txt"), skip_header=True)
+    return np.array([float(line.split("|")[1]) for line in lines], dtype=np.float32)
+
+
+def read_phrase_ids(original_dir):
+    """ Gets a dictionary {phrase: phrase id} from dictionary.txt """
+    phrase_ids = {}
+    for line in _read_lines(os.path.join(original_dir, "dictionary.txt")):
+        phrase, phrase_id = line.rsplit("|", 1)  # The phrases can contain "|"
+        phrase_ids.setdefault(to_sst2_text(phrase), int(phrase_id))
+    return phrase_ids
+
+
+def read_sst2_labels(sst_dir):
+    """ Gets a dictionary {split: {text: binary label}}, each split with the labels of its own GLUE file only. The
+    test split gets no labels, as test.tsv has none """
+    labels = {split: {} for split in SPLITS.values()}
+    for split, file in GLUE_FILES.items():
+        for line in _read_lines(os.path.join(sst_dir, file), skip_header=True):
+            text, label = line.rsplit("\t", 1)
+            labels[split][text.strip()] = int(label)
+    return labels
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def to_sst2_text(text):
+    """ Formats a sentence or phrase of the treebank like the GLUE SST-2 data: lowercase and without escaped slashes """
+    return text.replace("\\/", "/").lower()
+
+
+def binary_label(sentiment):
+    """ SST-2 leaves out the neutral sentiments (0.4, 0.6], and the rest are negative (0) or positive (1). -1 means
+    neutral or unknown """
+    return np.where(sentiment <= 0.4, 0, np.where(sentiment > 0.6, 1, -1)).astype(np.int8)
+
+
+def source_key(sst_dir):
+    """ Hashes the names, sizes and modification times of the files the data is built from (and CACHE_VERSION) """
+    h = hashlib.sha1(str(CACHE_VERSION).encode("utf-8"))
+    for root in (sst_dir, os.path.join(sst_dir, "original")):
+        for file in sorted(os.listdir(root)):
+            if file.endswith((".txt", ".tsv")):
+                stat = os.stat(os.path.join(root, file))
+                h.update("{}:{}:{}\n".format(file, stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+    return h.hexdigest()
+
+
+def build_sst2(cache_dir, sst_dir=SST_DIR):
+    """ Streams the treebank files on sst_dir/original and saves a table for each level and split on cache_dir, with a
+    .npy file per column: the texts (as a single "\\n" separated utf-8 buffer), the index of the sentence they come
+    from, their sentiment value (NaN if unknown) and their binary label (-1 if neutral or unknown). The phrase-level
+    tables have every phrase of the parse trees of the sentences of each split once (the whole sentences included).
+    Like on the GLUE files, the rows are shuffled (always in the same way), as the examples go over them in order
+
+    The sentiments come from dictionary.txt and sentiment_labels.txt. If dictionary.txt is not there (it is not
+    bundled with this repo), the binary labels are looked up on the GLUE file of each split instead: train.tsv for
+    train (its phrases and sentences), dev.tsv for dev (only its whole sentences), and all the test rows are -1 """
+    original_dir = os.path.join(sst_dir, "original")
+    if os.path.exists(os.path.join(original_dir, "dictionary.txt")):
+        phrase_ids, sentiments, sst2_labels = read_phrase_ids(original_dir), read_sentiments(original_dir), None
+    else:
+        phrase_ids, sentiments, sst2_labels = None, None, read_sst2_labels(sst_dir)
+    tables = {(level, split): {"text": [], "sentence_index": []} for level in LEVELS for split in SPLITS.values()}
+    seen = {split: set() for split in SPLITS.values()}  # Many phrases appear on several sentences
+    for (sentence_index, split, tokens), spans in zip(read_sentences(original_dir), read_phrase_spans(original_dir)):
+        for start, stop in spans:
+            text = to_sst2_text(" ".join(tokens[start:stop]))
+            if stop - start == len(tokens):
+                tables["sentence", split]["text"].append(text)
+                tables["sentence", split]["sentence_index"].append(sentence_index)
+            if text not in seen[split]:
+                seen[split].add(text)
+                tables["phrase", split]["text"].append(text)
+                tables["phrase", split]["sentence_index"].append(sentence_index)
+
+    rng = np.random.RandomState(42)
+    with atomic_path(cache_dir) as tmp_dir:  # All the tables show up at once
+        for (level, split), table in tables.items():
+            order = rng.permutation(len(table["text"]))  # Otherwise the phrases of a sentence would be next to each other
+            table = {name: [column[i] for i in order] for name, column in table.items()}
+            if phrase_ids is not None:
+                sentiment = np.array([sentiments[phrase_ids[text]] if text in phrase_ids else np.nan
+                                      for text in table["text"]], dtype=np.float32)
+                label = binary_label(sentiment)
+            else:
+                sentiment = np.full(len(table["text"]), np.nan, dtype=np.float32)
+                label = np.array([sst2_labels[split].get(text, -1) for text in table["text"]], dtype=np.int8)
+            columns = {"text": np.frombuffer("\n".join(table["text"]).encode("utf-8"), dtype=np.uint8),
+                       "sentence_index": np.array(table["sentence_index"], dtype=np.int32),
+                       "sentiment": sentiment, "label": label}
+            os.makedirs(os.path.join(tmp_dir, level + "_" + split))
+            for name, column in columns.items():
+                np.save(os.path.join(tmp_dir, level + "_" + split, name + ".npy"), column)
+
+
+def load_sst2_table(split="train", level="sentence", sst_dir=SST_DIR):
+    """ Loads all the columns of a table, building the cache from the treebank files the first time """
+    cache_dir = os.path.join(sst_dir, "cache", source_key(sst_dir))
+    if not os.path.exists(cache_dir):
+        print("Building the SST-2 data from {}...".format(os.path.join(sst_dir, "original")))
+        build_sst2(cache_dir, sst_dir)
+    table_dir = os.path.join(cache_dir, level + "_" + split)
+    table = {name: np.load(os.path.join(table_dir, name + ".npy")) for name in COLUMNS}
+    text = table["text"].tobytes().decode("utf-8")
+    table["text"] = np.array(text.split("\n") if text else [], dtype=object)
+    return table
+
+
+def load_sst2(split="train", level="sentence", sst_dir=SST_DIR, drop_neutral=True):
+    """ Gets the texts and binary labels of a split ("train", "dev" or "test") at the sentence or phrase level.
+    With drop_neutral the texts whose label is neutral or unknown are left out, as on the GLUE SST-2 data """
+    table = load_sst2_table(split, level, sst_dir)
+    keep = table["label"] >= 0 if drop_neutral else slice(None)
+    return table["text"][keep], table["label"][keep].astype(np.int64)
@@ -0,0 +1,96 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import numpy as np
+import nltk
+from helpers.tokenization import tokenize
+from helpers.vocab import count_tokens
+
+
+# %% ------------------------------------- Chunked Reader --------------------------------------------------------------
+def read_tsv_chunks(path, chunk_size=10000, text_column="sentence", label_column="label"):
+    """ Streams a GLUE-style .tsv file (a header, then one example per line with its tab separated columns) and yields
+    (texts, labels) chunks of up to chunk_size examples, so the file is never fully in memory. labels is None if the
+    file has no label_column (e.g. test.tsv) """
+    with open(path, "r", encoding="utf-8") as s:
+        header = next(s).rstrip("\n").split("\t")
+        text_idx = header.index(text_column)
+        label_idx = header.index(label_column) if label_column in header else None
+        texts, labels = [], []
+        for line in s:
+            columns = line.rstrip("\n").split("\t")
+            texts.append(columns[text_idx].strip())
+            if label_idx is not None:
+                labels.append(int(columns[label_idx]))
+            if len(texts) == chunk_size:
+                yield texts, np.array(labels, dtype=np.int64) if label_idx is not None else None
+                texts, labels = [], []
+        if texts:
+            yield texts, np.array(labels, dtype=np.int64) if label_idx is not None else None
+
+
+def read_text_chunks(path, chunk_size=10000, text_column="sentence", offset=None):
+    """ Streams the texts of a .tsv file (its text_column) or of any other text file (one text per line) and yields
+    (texts, offset) chunks of up to chunk_size texts, where offset is the byte offset on the file right after the chunk.
+    Passing that offset back resumes the reading on the next chunk. Every line gives a text, the empty ones included,
+    so each text is on the same line of the file as its result on an output written in the same order """
+    with open(path, "rb") as s:  # Binary, so that the position on the file can be tracked and seeked to
+        text_idx = None
+        if path.endswith(".tsv"):
+            header = next(s).decode("utf-8").rstrip("\r\n").split("\t")
+            text_idx = header.index(text_column)
+        if offset is not None:
+            s.seek(offset)
+        position, texts = s.tell(), []
+        for line in s:
+            position += len(line)
+            line = line.decode("utf-8").rstrip("\r\n")
+            texts.append((line.split("\t")[text_idx] if text_idx is not None else line).strip())
+            if len(texts) == chunk_size:
+                yield texts, position
+                texts = []
+        if texts:
+            yield texts, position
+
+
+# %% -------------------------------------- Heavy Hitters --------------------------------------------------------------
+class HeavyHitters:
+    """ Misra-Gries frequency sketch with at most capacity counters. Each chunk of counts is merged in, and when there
+    are more than capacity tokens, the (capacity+1)-th largest count is subtracted from all of them and those that
+    are left at 0 or less are dropped. Every count is thus underestimated by at most max_error <= n_total/(capacity+1),
+    so all the tokens that appear more than that are kept, and when the corpus has less than capacity different
+    tokens the counts are exact. Memory is bounded by capacity plus the different tokens of a single chunk """
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.counts = {}
+        self.n_total, self.max_error = 0, 0
+
+    def update(self, counts):
+        """ Merges a dictionary {token: count} (e.g. the counts of a chunk) into the sketch """
+        for token, count in counts.items():
+            self.counts[token] = self.counts.get(token, 0) + count
+        self.n_total += sum(counts.values())
+        if len(self.counts) > self.capacity:
+            values = np.fromiter(self.counts.values(), dtype=np.int64, count=len(self.counts))
+            threshold = int(np.partition(values, -(self.capacity + 1))[-(self.capacity + 1)])
+            self.counts = {token: count - threshold for token, count in self.counts.items() if count > threshold}
+            self.max_error += threshold
+
+    def vocab(self, min_freq=1, max_size=None):
+        """ Same as vocab.build_vocab, but from the (approximate) counts of the sketch """
+        tokens = sorted((t for t, count in self.counts.items() if count >= min_freq),
+                        key=lambda t: (-self.counts[t], t))
+        return {token: i for i, token in enumerate(tokens[:max_size], 1)}
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def stream_vocab(text_chunks, tokenizer=nltk.word_tokenize, capacity=100000, min_freq=1, max_size=None,
+                 n_workers=None):
+    """ Builds the vocab and gets the maximum sequence length of the texts yielded in chunks by text_chunks (lists of
+    raw texts, e.g. from read_tsv_chunks), tokenizing and counting one chunk at a time, so memory does not grow with
+    the size of the corpus. Returns the vocab, the maximum sequence length and the sketch, whose max_error bounds how
+    much the count of any token might have been underestimated """
+    sketch, msl = HeavyHitters(capacity), 0
+    for texts in text_chunks:
+        corpus = tokenize(texts, tokenizer, n_workers)
+        sketch.update(count_tokens([corpus]))
+        msl = max(msl, corpus.max_len())
+    return sketch.vocab(min_freq, max_size), msl, sketch
@@ -0,0 +1,131 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import os
+import sys
+import inspect
+import hashlib
+import multiprocessing
+from functools import lru_cache
+from itertools import chain
+import numpy as np
+import nltk
+from helpers.fast_tokenizer import fast_word_tokenize
+from helpers.atomic import atomic_open
+
+# Tokenizers the examples can pick from. "fast" gives the same tokens as "nltk" on SST-2 (see benchmark_tokenizer.py)
+TOKENIZERS = {"nltk": nltk.word_tokenize, "fast": fast_word_tokenize}
+# All the examples share the same cache, so each corpus is only tokenized once no matter which script runs first
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, ".token_cache")
+
+
+# %% ----------------------------------- Tokenized Corpus --------------------------------------------------------------
+class TokenizedCorpus:
+    """ Ragged array of tokenized sentences. The tokens of sentence i are types[ids[offsets[i]:offsets[i+1]]] """
+    def __init__(self, types, ids, offsets):
+        self.types = types  # List with the unique tokens of the corpus, in order of first appearance
+        self.ids = ids  # int32 array with the index (on types) of every token of every sentence, one after the other
+        self.offsets = offsets  # int32 array of length n_sentences + 1 with the start of each sentence on ids
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return [self.types[i] for i in self.ids[self.offsets[idx]:self.offsets[idx+1]]]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    @property
+    def lengths(self):
+        """ Number of tokens of each sentence """
+        return np.diff(self.offsets)
+
+    def max_len(self):
+        return int(self.lengths.max()) if len(self) else 0
+
+    def select(self, rows):
+        """ TokenizedCorpus with only the sentences on rows (an array of indices), sharing the types of this one """
+        lengths = self.lengths[rows]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int32)
+        np.cumsum(lengths, out=offsets[1:])
+        # Position of each token of the selected sentences on self.ids, without looping over the sentences
+        positions = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - self.offsets[:-1][rows], lengths)
+        return TokenizedCorpus(self.types, self.ids[positions], offsets)
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def tokenize(sentences, tokenizer=nltk.word_tokenize, n_workers=None, chunksize=512):
+    """ Tokenizes all the sentences with a process pool and returns them as a TokenizedCorpus """
+    sentences = list(sentences)
+    n_workers = n_workers or os.cpu_count() or 1
+    # The workers are forked so that they do not re-run the calling script, which is what would happen with "spawn"
+    # as none of the examples has an if __name__ == "__main__" guard. If fork is not available we just go serial
+    if n_workers > 1 and len(sentences) > chunksize and "fork" in multiprocessing.get_all_start_methods():
+        with multiprocessing.get_context("fork").Pool(n_workers) as pool:
+            tokenized = pool.map(tokenizer, sentences, chunksize=chunksize)
+    else:
+        tokenized = [tokenizer(sentence) for sentence in sentences]
+    return to_corpus(tokenized)
+
+
+def to_corpus(tokenized):
+    """ Converts a list with the list of tokens of each sentence to a TokenizedCorpus """
+    offsets = np.zeros(len(tokenized) + 1, dtype=np.int32)
+    np.cumsum([len(tokens) for tokens in tokenized], out=offsets[1:])
+    types = {}  # Interns every token, so that each sentence is stored as a sequence of int32 ids instead of strings
+    ids = np.fromiter((types.setdefault(token, len(types)) for token in chain.from_iterable(tokenized)),
+                      dtype=np.int32, count=offsets[-1])
+    return TokenizedCorpus(list(types), ids, offsets)
+
+
+@lru_cache(maxsize=None)
+def tokenizer_key(tokenizer):
+    """ Hashes the qualified name of a tokenizer, the source of the module it is defined in and the versions of its
+    package and of nltk (which both tokenizers run on), so that editing a tokenizer (e.g. the regexes of
+    fast_tokenizer.py) or upgrading nltk changes the keys of everything cached with it """
+    module = sys.modules.get(tokenizer.__module__)
+    package = sys.modules.get(tokenizer.__module__.split(".")[0])
+    h = hashlib.sha1("{}.{}".format(tokenizer.__module__, tokenizer.__qualname__).encode("utf-8"))
+    try:
+        h.update(inspect.getsource(module).encode("utf-8"))
+    except (TypeError, OSError):  # Built-in modules have no source, so only their versions count
+        pass
+    h.update("{}\0{}".format(getattr(package, "__version__", ""), nltk.__version__).encode("utf-8"))
+    return h.hexdigest()
+
+
+def corpus_key(sentences, tokenizer=nltk.word_tokenize):
+    """ Hashes the sentences and the tokenizer used (see tokenizer_key), so that a cached corpus is never served for
+    different inputs """
+    h = hashlib.sha1(tokenizer_key(tokenizer).encode("utf-8"))
+    for sentence in sentences:
+        h.update(sentence.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def save_tokenized_corpus(corpus, path):
+    # The types are saved as a single "\n" separated utf-8 buffer (tokens never contain whitespace) instead of an
+    # array of strings, which NumPy would pad to the length of the longest token
+    types = np.frombuffer("\n".join(corpus.types).encode("utf-8"), dtype=np.uint8)
+    with atomic_open(path) as s:
+        np.savez(s, types=types, ids=corpus.ids, offsets=corpus.offsets)
+
+
+def load_saved_corpus(path):
+    with np.load(path, allow_pickle=False) as data:
+        types = data["types"].tobytes().decode("utf-8")
+        return TokenizedCorpus(types.split("\n") if types else [], data["ids"], data["offsets"])
+
+
+def load_tokenized_corpus(sentences, tokenizer=nltk.word_tokenize, cache_dir=CACHE_DIR, n_workers=None):
+    """ Loads the tokenized sentences from the cache or tokenizes them in parallel and caches them """
+    sentences = list(sentences)
+    path = os.path.join(cache_dir, corpus_key(sentences, tokenizer) + ".npz")
+    if os.path.exists(path):
+        return load_saved_corpus(path)
+    print("Tokenizing {} sentences...".format(len(sentences)))
+    corpus = tokenize(sentences, tokenizer, n_workers)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_tokenized_corpus(corpus, path)
+    return corpus
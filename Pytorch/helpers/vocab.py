@@ -0,0 +1,33 @@
+# %% --------------------------------------- Imports -------------------------------------------------------------------
+import zlib
+from collections import Counter
+import numpy as np
+
+
+# %% ----------------------------------- Helper Functions --------------------------------------------------------------
+def count_tokens(corpora):
+    """ Counts how many times each token appears on a list of TokenizedCorpus """
+    counts = Counter()
+    for corpus in corpora:  # bincount counts all the tokens at once, so we only loop over the unique ones
+        counts.update(dict(zip(corpus.types, np.bincount(corpus.ids, minlength=len(corpus.types)).tolist())))
+    return counts
+
+
+def build_vocab(corpora, min_freq=1, max_size=None):
+    """ Gets a dictionary {token: id} of the tokens that appear at least min_freq times on the corpora, keeping only
+    the max_size most frequent ones. The ids start at 1, as we reserve the 0 id for padded 0s """
+    counts = count_tokens(corpora)
+    # Sorts by frequency (and alphabetically to break ties), so that the vocab is always the same for the same corpora
+    tokens = sorted((token for token, count in counts.items() if count >= min_freq), key=lambda t: (-counts[t], t))
+    return {token: i for i, token in enumerate(tokens[:max_size], 1)}
+
+
+def oov_bucket(token, n_oov_buckets):
+    """ Assigns an out-of-vocab token to one of n_oov_buckets buckets. zlib.crc32 is used instead of hash(),
+    which changes from run to run for strings """
+    return zlib.crc32(token.encode("utf-8")) % n_oov_buckets
+
+
+def n_embeddings(vocab_dict, n_oov_buckets=1):
+    """ Number of rows the embedding table needs: the padding, the tokens on the vocab and the out-of-vocab buckets """
+    return 1 + len(vocab_dict) + n_oov_buckets